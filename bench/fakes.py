@@ -0,0 +1,671 @@
+"""Local stand-ins for the services konbini talks to, for benchmarking.
+
+Each fake runs on its own port on 127.0.0.1 in a background thread and
+answers just enough of the real API for konbini's routes and webhooks to
+go through: Stripe, EasyPost, ShipBob, RPI, USPS and an SMTP server.
+Every request waits `latency` seconds before it's answered, so upstream
+latency can be dialed in (or left at 0 to see konbini's own overhead),
+and is counted by service and operation.
+
+    with Fakes(latency={'stripe': 0.05, 'easypost': 0.2}) as fakes:
+        ...
+        fakes.counts()  # {'stripe': 12, 'easypost': 3, ...}
+"""
+import re
+import json
+import time
+import uuid
+import random
+import threading
+import socketserver
+from collections import Counter
+from urllib.parse import urlparse, parse_qsl
+from xml.etree import ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICES = ['stripe', 'easypost', 'shipbob', 'rpi', 'usps', 'smtp']
+
+# Path segments that are ids, to group requests by operation
+ID_SEGMENT = re.compile(r'^(\d+|[a-z]+_(?=[A-Za-z0-9_]*[A-Z0-9])[A-Za-z0-9_]+)$')
+
+
+def new_id(prefix):
+    return '{}_{}'.format(prefix, uuid.uuid4().hex[:16])
+
+
+class NotFound(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Otherwise responses sent in more than one write wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, content, content_type = self.server.upstream.dispatch(self.command, self.path, self.headers, body)
+        content = content.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Upstream:
+    """A fake HTTP API. Subclasses implement `handle()`"""
+    name = None
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self._server = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.upstream = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def count(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _record(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def dispatch(self, method, path, headers, body):
+        url = urlparse(path)
+        segments = [s for s in url.path.split('/') if s]
+        self._record('{} /{}'.format(method, '/'.join('{id}' if ID_SEGMENT.match(s) else s for s in segments)))
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            status, data = self.handle(method, segments, dict(parse_qsl(url.query)), headers, body)
+        except NotFound as err:
+            status, data = self.not_found(str(err))
+        return status, json.dumps(data), 'application/json'
+
+    def handle(self, method, segments, query, headers, body):
+        raise NotImplementedError
+
+    def not_found(self, message):
+        return 404, {'error': message}
+
+
+def _parse_form(pairs):
+    """Stripe's form encoding (`line_items[0][name]=...`) into nested dicts and lists"""
+    data = {}
+    for key, value in pairs:
+        parts = [key.split('[', 1)[0]] + re.findall(r'\[([^\]]*)\]', key)
+        node = data
+        for i, part in enumerate(parts):
+            if part == '':
+                part = str(len(node))
+            if i == len(parts) - 1:
+                node[part] = value
+            else:
+                node = node.setdefault(part, {})
+    return _lists(data)
+
+def _lists(node):
+    if isinstance(node, dict):
+        node = {k: _lists(v) for k, v in node.items()}
+        if node and all(k.isdigit() for k in node):
+            return [node[k] for k in sorted(node, key=int)]
+    return node
+
+
+def _list(data, url):
+    return {'object': 'list', 'data': data, 'has_more': False, 'url': url}
+
+
+class Stripe(Upstream):
+    """Products (with SKUs), a subscription plan, tax rates, customers,
+    Checkout sessions, payment intents, subscriptions and invoices.
+    Each customer's latest Checkout session is kept (by email),
+    so that completed checkouts can be handed to the webhooks.
+
+    If `lenient`, customers, subscriptions, invoices, payment intents
+    and products that don't exist are made up when they're asked for,
+    for replaying events recorded elsewhere"""
+    name = 'stripe'
+
+    def __init__(self, latency=0, products=8, lenient=False):
+        super().__init__(latency)
+        self.objects = {}
+        self.sessions = {}
+        self.lenient = lenient
+        self._seed(products)
+
+    def _add(self, obj):
+        self.objects[obj['id']] = obj
+        return obj
+
+    def _seed(self, n_products):
+        now = int(time.time())
+        self.products, self.skus = [], []
+        for i in range(n_products):
+            # Mostly EasyPost, with one product for each of the other shippers
+            metadata = {'length': '9', 'width': '6', 'height': '1', 'weight': str(10 + i)}
+            if i == 1:
+                metadata.update(shipper='shipbob', shipbob_inventory_id=str(500 + i))
+            elif i == 2:
+                metadata.update(shipper='rpi', sku='BOOK-{}'.format(i), pagecount='120',
+                                guts_pdf='https://example.com/guts.pdf', cover_pdf='https://example.com/cover.pdf')
+            self.add_product('prod_bench{:04d}'.format(i), 'Product {}'.format(i), metadata, created=now - i)
+
+        self.plan_product = self._add({
+            'id': 'prod_BenchPlan', 'object': 'product', 'type': 'service',
+            'name': 'Subscription', 'description': 'A subscription for benchmarking', 'caption': None,
+            'active': True, 'images': [], 'metadata': {'shipped': 'true'}, 'default_price': None,
+            'created': now, 'updated': now,
+        })
+        self.plan = self._add({
+            'id': 'price_BenchPlan', 'object': 'price', 'product': self.plan_product['id'],
+            'unit_amount': 2000, 'currency': 'usd', 'active': True, 'type': 'recurring',
+            'recurring': {'interval': 'month', 'interval_count': 1}, 'metadata': {}, 'created': now,
+        })
+        self.tax_rates = [self._add({
+            'id': 'txr_BenchNY', 'object': 'tax_rate', 'active': True, 'jurisdiction': 'NY',
+            'percentage': 8.875, 'inclusive': False, 'display_name': 'Sales tax', 'created': now,
+        })]
+
+    def _listing(self, kind, query, url):
+        objs = [o for o in self.objects.values() if o['object'] == kind]
+        if query.get('active') == 'true':
+            objs = [o for o in objs if o.get('active')]
+        ids = [v for k, v in query.items() if k.startswith('ids[')]
+        if ids:
+            objs = [o for o in objs if o['id'] in ids]
+        if 'email' in query:
+            objs = [o for o in objs if o.get('email') == query['email']]
+        return 200, _list(objs, url)
+
+    def add_product(self, id, name='Product', metadata=None, created=None):
+        """A good, with a paperback and a hardcover SKU"""
+        created = created or int(time.time())
+        if metadata is None:
+            metadata = {'length': '9', 'width': '6', 'height': '1', 'weight': '12'}
+        product = self._add({
+            'id': id, 'object': 'product', 'type': 'good', 'name': name,
+            'description': 'A product for benchmarking', 'caption': None, 'active': True,
+            'images': ['https://example.com/{}.jpg'.format(id)], 'metadata': metadata,
+            'default_price': None, 'created': created, 'updated': created,
+        })
+        self.products.append(product)
+        for j, fmt in enumerate(['paperback', 'hardcover']):
+            self.skus.append(self._add({
+                'id': 'sku_{}{}'.format(id[len('prod_'):], j), 'object': 'sku', 'product': id,
+                'price': 1500 + 1000*j, 'currency': 'usd', 'active': True,
+                'attributes': {'format': fmt}, 'image': None, 'metadata': {},
+                'created': created, 'updated': created,
+            }))
+        return product
+
+    def _get(self, id, kind=None):
+        obj = self.objects.get(id)
+        if obj is None and self.lenient:
+            obj = self._make_up(id)
+        if obj is None or (kind is not None and obj['object'] != kind):
+            raise NotFound('No such {}: {}'.format(kind or 'object', id))
+        return obj
+
+    def _make_up(self, id):
+        prefix = id.split('_', 1)[0]
+        with self._lock:
+            if id in self.objects:
+                return self.objects[id]
+            if prefix == 'cus':
+                return self._customer('{}@example.com'.format(id), 'A Customer', {
+                    'name': 'A Customer',
+                    'address': {'line1': '1 Main St', 'line2': None, 'city': 'New York',
+                                'state': 'NY', 'postal_code': '10001', 'country': 'US'},
+                }, id=id)
+            if prefix == 'sub':
+                return self._add({
+                    'id': id, 'object': 'subscription', 'customer': new_id('cus'),
+                    'plan': {'id': self.plan['id'], 'product': self.plan_product['id']}, 'metadata': {},
+                })
+            if prefix == 'in':
+                return self._add({
+                    'id': id, 'object': 'invoice', 'status': 'draft', 'customer': new_id('cus'),
+                    'subscription': new_id('sub'), 'metadata': {},
+                })
+            if prefix == 'pi':
+                return self._add({
+                    'id': id, 'object': 'payment_intent', 'amount': 1500, 'status': 'succeeded',
+                    'charges': _list([{'id': new_id('ch'), 'object': 'charge', 'refunded': False}], '/v1/charges'),
+                    'metadata': {},
+                })
+        if prefix == 'prod':
+            return self.add_product(id)
+        return None
+
+    def adopt(self, event):
+        """Take in the object of a recorded event (and any products it refers to),
+        so that the event can be replayed"""
+        obj = dict(event['data']['object'])
+        if obj.get('object') == 'checkout.session':
+            obj['_line_items'] = [{'id': new_id('li'), 'object': 'item', 'description': 'Item',
+                                   'quantity': 1, 'amount_total': obj.get('amount_total') or 1500}]
+            for key, value in (obj.get('metadata') or {}).items():
+                if key.startswith('rpi_product_'):
+                    product = json.loads(value)
+                    if product['id'] not in self.objects:
+                        self.add_product(product['id'])
+        elif obj.get('object') == 'invoice':
+            obj['status'] = 'draft'
+        self._add(obj)
+
+    def not_found(self, message):
+        return 404, {'error': {'type': 'invalid_request_error', 'message': message}}
+
+    def handle(self, method, segments, query, headers, body):
+        params = _parse_form(parse_qsl(body.decode('utf8'))) if body else {}
+        path = segments[1:]  # after `v1`
+        listings = {'products': 'product', 'prices': 'price', 'skus': 'sku',
+                    'tax_rates': 'tax_rate', 'customers': 'customer'}
+
+        if method == 'GET' and len(path) == 1 and path[0] in listings:
+            return self._listing(listings[path[0]], query, '/v1/' + path[0])
+
+        if path[:2] == ['checkout', 'sessions']:
+            if method == 'POST' and len(path) == 2:
+                return 200, self.create_session(params)
+            if len(path) == 4 and path[3] == 'line_items':
+                session = self._get(path[2], 'checkout.session')
+                return 200, _list(session['_line_items'], '/v1/checkout/sessions/{}/line_items'.format(path[2]))
+            return 200, self._get(path[2], 'checkout.session')
+
+        if len(path) == 2:
+            obj = self._get(path[1])
+            if method == 'POST':
+                metadata = params.pop('metadata', None)
+                if metadata:
+                    obj.setdefault('metadata', {}).update(metadata)
+                params.pop('expand', None)
+                obj.update(params)
+            return 200, obj
+
+        if method == 'POST' and path == ['invoiceitems']:
+            return 200, self._add(dict(params, id=new_id('ii'), object='invoiceitem'))
+        raise NotFound('Unrecognized request URL: /{}'.format('/'.join(segments)))
+
+    def _customer(self, email, name=None, shipping=None, id=None):
+        return self._add({
+            'id': id or new_id('cus'), 'object': 'customer', 'email': email, 'name': name,
+            'shipping': shipping, 'default_source': new_id('card'), 'metadata': {},
+            'subscriptions': _list([], '/v1/subscriptions'),
+        })
+
+    def create_session(self, params):
+        customer = params.get('customer') or self._customer(params.get('customer_email'))['id']
+        email = self.objects[customer]['email']
+        session = {
+            'id': new_id('cs_test'), 'object': 'checkout.session', 'customer': customer,
+            'metadata': params.get('metadata') or {}, 'subscription': None, 'payment_intent': None,
+            'display_items': [], 'mode': 'payment',
+            '_line_items': [{
+                'id': new_id('li'), 'object': 'item', 'description': item['name'],
+                'quantity': int(item['quantity']), 'amount_total': int(item['amount']) * int(item['quantity']),
+            } for item in params.get('line_items') or []],
+        }
+        if 'subscription_data' in params:
+            plan = params['subscription_data']['items'][0]['plan']
+            sub = self._add({
+                'id': new_id('sub'), 'object': 'subscription', 'customer': customer,
+                'plan': {'id': plan, 'product': self._get(plan)['product']},
+                'metadata': params['subscription_data'].get('metadata') or {},
+            })
+            session.update(mode='subscription', subscription=sub['id'])
+        else:
+            amount = sum(li['amount_total'] for li in session['_line_items'])
+            pi = self._add({
+                'id': new_id('pi'), 'object': 'payment_intent', 'amount': amount, 'status': 'succeeded',
+                'charges': _list([{'id': new_id('ch'), 'object': 'charge', 'refunded': False}], '/v1/charges'),
+                'metadata': {},
+            })
+            session['payment_intent'] = pi['id']
+        with self._lock:
+            self.sessions[email] = session['id']
+        return self._add(session)
+
+    def session(self, email):
+        """The customer's latest Checkout session, as it's sent
+        in a `checkout.session.completed` event"""
+        return {k: v for k, v in self.objects[self.sessions[email]].items() if not k.startswith('_')}
+
+    def create_invoice(self):
+        """A draft invoice for a shipped subscription of a customer with an address,
+        as it's sent in an `invoice.created` event"""
+        customer = self._customer('subscriber-{}@example.com'.format(uuid.uuid4().hex[:8]), 'A Subscriber', {
+            'name': 'A Subscriber',
+            'address': {'line1': '1 Main St', 'line2': None, 'city': 'New York',
+                        'state': 'NY', 'postal_code': '10001', 'country': 'US'},
+        })
+        sub = self._add({
+            'id': new_id('sub'), 'object': 'subscription', 'customer': customer['id'],
+            'plan': {'id': self.plan['id'], 'product': self.plan_product['id']}, 'metadata': {},
+        })
+        return dict(self._add({
+            'id': new_id('in'), 'object': 'invoice', 'status': 'draft',
+            'customer': customer['id'], 'subscription': sub['id'], 'metadata': {},
+        }))
+
+
+class EasyPost(Upstream):
+    """Shipments and orders, with two rates each, and customs.
+    If `lenient`, shipments and orders that don't exist
+    are made up (not yet bought) when they're asked for"""
+    name = 'easypost'
+
+    def __init__(self, latency=0, lenient=False):
+        super().__init__(latency)
+        self.objects = {}
+        self.lenient = lenient
+
+    def not_found(self, message):
+        return 404, {'error': {'code': 'NOT_FOUND', 'message': message}}
+
+    def _rates(self, shipment_id, weight):
+        return [{
+            'id': new_id('rate'), 'object': 'Rate', 'carrier': 'USPS', 'service': service,
+            'rate': '{:.2f}'.format(base + 0.05 * float(weight or 0)), 'currency': 'USD',
+            'shipment_id': shipment_id,
+        } for service, base in [('GroundAdvantage', 4.5), ('Priority', 9.0)]]
+
+    def _shipment(self, params):
+        id = new_id('shp')
+        return {
+            'id': id, 'object': 'Shipment', 'mode': 'test', 'parcel': params.get('parcel'),
+            'to_address': params.get('to_address'), 'from_address': params.get('from_address'),
+            'customs_info': params.get('customs_info'), 'tracking_code': None,
+            'postage_label': None, 'tracker': None,
+            'rates': self._rates(id, (params.get('parcel') or {}).get('weight')),
+        }
+
+    def _buy(self, shipment):
+        shipment.update(tracking_code='9400{}'.format(random.randint(10**17, 10**18)),
+                        postage_label={'object': 'PostageLabel',
+                                       'label_url': 'https://example.com/labels/{}.png'.format(shipment['id'])},
+                        tracker={'object': 'Tracker',
+                                 'public_url': 'https://example.com/track/{}'.format(shipment['id'])})
+        return shipment
+
+    def _order(self, id, shipments):
+        rates = [dict(rate, id=new_id('rate'), shipment_id=None,
+                      rate='{:.2f}'.format(sum(float(s['rates'][i]['rate']) for s in shipments)))
+                 for i, rate in enumerate(shipments[0]['rates'])]
+        self.objects[id] = {'id': id, 'object': 'Order', 'mode': 'test', 'shipments': shipments, 'rates': rates}
+        return self.objects[id]
+
+    def _get(self, id):
+        if id not in self.objects and self.lenient:
+            parcel = {'length': 9, 'width': 6, 'height': 2, 'weight': 24}
+            if id.startswith('shp_'):
+                self.objects[id] = dict(self._shipment({'parcel': parcel}), id=id)
+            elif id.startswith('order_'):
+                self._order(id, [self._shipment({'parcel': parcel})])
+        if id not in self.objects:
+            raise NotFound('The requested resource could not be found.')
+        return self.objects[id]
+
+    def handle(self, method, segments, query, headers, body):
+        params = json.loads(body) if body else {}
+        path = segments[1:]  # after `v2`
+
+        if method == 'POST' and path == ['shipments']:
+            shipment = self._shipment(params['shipment'])
+            self.objects[shipment['id']] = shipment
+            return 200, shipment
+
+        if method == 'POST' and path == ['orders']:
+            order = params['order']
+            shipments = [self._shipment(dict(s, to_address=order.get('to_address'),
+                                             from_address=order.get('from_address')))
+                         for s in order['shipments']]
+            return 200, self._order(new_id('order'), shipments)
+
+        if method == 'POST' and path in (['customs_items'], ['customs_infos']):
+            kind = 'CustomsItem' if path[0] == 'customs_items' else 'CustomsInfo'
+            obj = dict(params[path[0][:-1]], id=new_id('cstitem' if kind == 'CustomsItem' else 'cstinfo'), object=kind)
+            self.objects[obj['id']] = obj
+            return 200, obj
+
+        if len(path) >= 2 and path[0] in ('shipments', 'orders'):
+            obj = self._get(path[1])
+            if method == 'POST' and path[2:] == ['buy']:
+                if obj['object'] == 'Order':
+                    for shipment in obj['shipments']:
+                        self._buy(shipment)
+                else:
+                    self._buy(obj)
+            return 200, obj
+        raise NotFound('The requested resource could not be found.')
+
+
+class ShipBob(Upstream):
+    """Products (the same in every channel), estimates and orders"""
+    name = 'shipbob'
+
+    def __init__(self, latency=0, inventory_ids=range(500, 520)):
+        super().__init__(latency)
+        self.products = [{
+            'id': 1000 + inv, 'sku': 'SB-{}'.format(inv), 'name': 'Item {}'.format(inv),
+            'fulfillable_inventory_items': [{'id': inv}],
+        } for inv in inventory_ids]
+        self.orders = []
+
+    def _page(self, items, query):
+        limit = int(query.get('Limit', 50))
+        page = int(query.get('Page', 1))
+        return items[(page - 1) * limit:page * limit]
+
+    def handle(self, method, segments, query, headers, body):
+        params = json.loads(body) if body else {}
+        path = segments[1:]  # after `1.0`
+
+        if path == ['product']:
+            if method == 'POST':
+                return 201, dict(params, id=random.randint(10**6, 10**7))
+            return 200, self._page(self.products, query)
+
+        if path == ['order', 'estimate']:
+            return 200, {'estimates': [
+                {'shipping_method': 'Standard', 'estimated_price': 5.25},
+                {'shipping_method': 'Expedited', 'estimated_price': 11.5},
+            ]}
+
+        if path == ['order']:
+            if method == 'POST':
+                order = dict(params, id=random.randint(10**6, 10**7),
+                             created_date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             shipments=[{'tracking': None}])
+                with self._lock:
+                    self.orders.append(order)
+                return 201, order
+            return 200, self._page(self.orders, query)
+
+        if len(path) == 2 and path[0] == 'order':
+            for order in self.orders:
+                if str(order['id']) == path[1]:
+                    return 200, order
+        raise NotFound('Not found')
+
+
+class RPI(Upstream):
+    """Shipping estimates and print orders"""
+    name = 'rpi'
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.orders = {}
+
+    def handle(self, method, segments, query, headers, body):
+        params = json.loads(body) if body else {}
+        if segments == ['orders', 'shipping', 'estimate']:
+            return 200, [{'price': '3.99', 'shippingClassification': 'economy'},
+                         {'price': '8.99', 'shippingClassification': 'priority'}]
+        if segments == ['orders', 'create']:
+            order = dict(params, id=new_id('rpi'), customerOrderId=uuid.uuid4().hex, status='created')
+            self.orders[order['id']] = order
+            return 200, order
+        if len(segments) == 2 and segments[0] == 'orders' and segments[1] in self.orders:
+            return 200, self.orders[segments[1]]
+        raise NotFound('Not found')
+
+
+class USPS(Upstream):
+    """Address verification, which echoes addresses back in upper case.
+    Addresses with "invalid" in them aren't found"""
+    name = 'usps'
+
+    def dispatch(self, method, path, headers, body):
+        self._record('{} verify'.format(method))
+        if self.latency:
+            time.sleep(self.latency)
+        request = ElementTree.fromstring(dict(parse_qsl(urlparse(path).query))['XML'])
+        response = ElementTree.Element('AddressValidateResponse')
+        for address in request.findall('Address'):
+            result = ElementTree.SubElement(response, 'Address', ID=address.get('ID'))
+            fields = {el.tag: (el.text or '').upper() for el in address}
+            if 'INVALID' in fields.get('Address2', ''):
+                error = ElementTree.SubElement(result, 'Error')
+                ElementTree.SubElement(error, 'Number').text = '-2147219401'
+                ElementTree.SubElement(error, 'Description').text = 'Address Not Found.'
+                continue
+            for tag in ['Address1', 'Address2', 'City', 'State', 'Zip5']:
+                if fields.get(tag):
+                    ElementTree.SubElement(result, tag).text = fields[tag]
+            ElementTree.SubElement(result, 'Zip4').text = '0001'
+        return 200, ElementTree.tostring(response, encoding='unicode'), 'text/xml'
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def _reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf8'))
+
+    def handle(self):
+        upstream = self.server.upstream
+        self._reply('220 localhost ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf8', 'replace').strip().split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self._reply('250 localhost')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                upstream._record('send')
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTP(Upstream):
+    """Accepts and drops every message"""
+    name = 'smtp'
+
+    def start(self):
+        self._server = _SMTPServer(('127.0.0.1', 0), _SMTPHandler)
+        self._server.upstream = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+
+class Fakes:
+    """All the fakes together. `latency` is either seconds for every
+    service, or a dict of service -> seconds. See `Stripe` and
+    `EasyPost` for `lenient`"""
+    def __init__(self, latency=0, products=8, lenient=False):
+        if not isinstance(latency, dict):
+            latency = {name: latency for name in SERVICES}
+        self.stripe = Stripe(latency.get('stripe', 0), products=products, lenient=lenient)
+        self.easypost = EasyPost(latency.get('easypost', 0), lenient=lenient)
+        self.shipbob = ShipBob(latency.get('shipbob', 0))
+        self.rpi = RPI(latency.get('rpi', 0))
+        self.usps = USPS(latency.get('usps', 0))
+        self.smtp = SMTP(latency.get('smtp', 0))
+
+    def services(self):
+        return {name: getattr(self, name) for name in SERVICES}
+
+    def start(self):
+        for upstream in self.services().values():
+            upstream.start()
+        return self
+
+    def stop(self):
+        for upstream in self.services().values():
+            upstream.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def counts(self):
+        """Requests received so far, by service"""
+        return {name: upstream.count() for name, upstream in self.services().items()}
+
+
+def parse_latency(spec):
+    """Parse `0.05` or `stripe=0.05,easypost=0.2` (in seconds)"""
+    if not spec:
+        return 0
+    if '=' not in spec:
+        return float(spec)
+    latency = {}
+    for part in spec.split(','):
+        name, seconds = part.split('=')
+        if name.strip() not in SERVICES:
+            raise ValueError('Unknown service "{}", expected one of {}'.format(name, ', '.join(SERVICES)))
+        latency[name.strip()] = float(seconds)
+    return latency
@@ -0,0 +1,194 @@
+"""A konbini app wired up to the fakes in `bench.fakes`, and the shopper
+and Stripe steps the benchmarks are made of.
+
+The app is set up the way a site using konbini as an extension would be
+(Flask-WTF, Flask-Mail and `Konbini(app)`, mounted at `/shop`), with
+every upstream pointed at its fake.
+"""
+import os
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import stripe
+import logging
+import threading
+from flask import Flask
+from flask_mail import Mail
+from flask_wtf.csrf import CSRFProtect
+from flask_konbini import Konbini
+from pyusps import address_information
+from werkzeug.serving import make_server
+
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), '..', 'konbini', 'static')
+
+WEBHOOK_SECRET = 'whsec_bench'
+
+
+def make_app(fakes, db_path=None, **config):
+    """A konbini app using `fakes` (which should already be started).
+    `config` overrides the defaults below"""
+    app = Flask('konbini_bench', static_folder=STATIC_FOLDER, static_url_path='/assets')
+    app.config.update(
+        SECRET_KEY='bench',
+        SALT='bench',
+        SHOP_NAME='Bench',
+        WTF_CSRF_ENABLED=False,
+        STRIPE_PUBLIC_KEY='pk_test_bench',
+        STRIPE_SECRET_KEY='sk_test_bench',
+        STRIPE_WEBHOOK_SECRETS={
+            'checkout.session.completed': WEBHOOK_SECRET,
+            'invoice.created': WEBHOOK_SECRET,
+            'sync': WEBHOOK_SECRET,
+        },
+        EASYPOST_API_KEY='EZTK_bench',
+        EASYPOST_API_BASE=fakes.easypost.url + '/v2',
+        SHIPBOB_API_KEY='bench',
+        SHIPBOB_API_URL=fakes.shipbob.url + '/1.0',
+        SHIPBOB_CHANNEL_ID='1',
+        SHIPBOB_DEFAULT_CHANNEL_ID='2',
+        RPI_URL=fakes.rpi.url,
+        RPI_AUTH_HEADER='Basic bench',
+        USPS_USER_ID='bench',
+        KONBINI_SHIPPERS=['easypost', 'shipbob', 'rpi'],
+        KONBINI_DEFAULT_SHIPPER='easypost',
+        KONBINI_SHIPPING_FROM={
+            'name': 'Bench', 'street1': '1 Warehouse Way', 'city': 'Brooklyn',
+            'state': 'NY', 'zip': '11201', 'country': 'US',
+        },
+        NEW_ORDER_RECIPIENTS=['orders@example.com'],
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=fakes.smtp.port,
+        MAIL_DEFAULT_SENDER='shop@example.com',
+        MAIL_REPLY_TO='shop@example.com',
+        TAXES=[],
+    )
+    if db_path:
+        app.config['KONBINI_DB_PATH'] = db_path
+    app.config.update(config)
+
+    app.csrf_protect = CSRFProtect(app)
+    Mail(app)
+    Konbini(app)
+
+    # Stripe and USPS are configured through their libraries
+    stripe.api_base = fakes.stripe.url
+    address_information.api_url = fakes.usps.url + '/ShippingAPI.dll'
+    return app
+
+
+def serve(app):
+    """Serve the app from a threaded server (as a single worker) in the
+    background. Returns the server, to shut down when done, and its URL"""
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def address(n):
+    """A shopper's address. Each `n` is a different address,
+    so its verification isn't already cached"""
+    return {
+        'line1': '{} Main St'.format(n + 1),
+        'line2': '',
+        'city': 'New York',
+        'state': 'NY',
+        'postal_code': '10001',
+        'country': 'US',
+    }
+
+
+def shipping_form(n):
+    form = {'name': 'Shopper {}'.format(n), 'email': 'shopper-{}@example.com'.format(n)}
+    for k, v in address(n).items():
+        form['address-{}'.format(k)] = v
+    return form
+
+
+class Shopper:
+    """One visitor going through the shop. `client` is either a Flask test
+    client or anything else with the same `get`/`post` (see `bench.load`)"""
+    def __init__(self, client, fakes, n=0, prefix='/shop'):
+        self.client = client
+        self.fakes = fakes
+        self.n = n
+        self.prefix = prefix
+
+    def get(self, path, **kwargs):
+        return self.client.get(self.prefix + path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.client.post(self.prefix + path, **kwargs)
+
+    def browse(self):
+        return self.get('/')
+
+    def view(self, product):
+        return self.get('/product/{}'.format(product['id'][len('prod_'):]))
+
+    def add_to_cart(self, sku):
+        product = self.fakes.stripe.objects[sku['product']]
+        return self.post('/cart', data={'sku': sku['id'], 'name': product['name']})
+
+    def view_cart(self):
+        return self.get('/cart')
+
+    def submit_shipping(self):
+        return self.post('/checkout', data=shipping_form(self.n))
+
+    def pay(self):
+        return self.get('/checkout/pay')
+
+    def choose_plan(self, price):
+        return self.post('/subscribe', data={'sku': price['id'], 'name': 'Subscription'})
+
+    def submit_subscription_address(self):
+        return self.post('/subscribe/address', data=shipping_form(self.n))
+
+    def subscribe(self):
+        return self.get('/subscribe')
+
+    def fill_cart(self):
+        """One item from each shipper"""
+        skus = {sku['product']: sku for sku in self.fakes.stripe.skus}
+        for product in self.fakes.stripe.products[:3]:
+            self.add_to_cart(skus[product['id']])
+
+
+def sign(payload, secret=WEBHOOK_SECRET, timestamp=None):
+    """A `Stripe-Signature` header for the payload"""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode('utf8'), '{}.{}'.format(timestamp, payload).encode('utf8'),
+                         hashlib.sha256).hexdigest()
+    return 't={},v1={}'.format(timestamp, signature)
+
+
+def event(type, obj):
+    return {
+        'id': 'evt_{}'.format(uuid.uuid4().hex[:24]),
+        'object': 'event',
+        'type': type,
+        'created': int(time.time()),
+        'livemode': False,
+        'data': {'object': obj},
+    }
+
+
+def post_event(client, path, event, secret=WEBHOOK_SECRET, prefix='/shop'):
+    """Deliver a webhook event, signed as Stripe would"""
+    payload = json.dumps(event)
+    return client.post(prefix + path, data=payload, headers={
+        'Stripe-Signature': sign(payload, secret),
+        'Content-Type': 'application/json',
+    })
+
+
+def completed_checkout(fakes, shopper):
+    """The event for the shopper's checkout being completed"""
+    return event('checkout.session.completed', fakes.stripe.session(shipping_form(shopper.n)['email']))
+
+
+def created_invoice(fakes):
+    return event('invoice.created', fakes.stripe.create_invoice())
@@ -0,0 +1,210 @@
+"""Load test of the checkout funnel.
+
+Serves konbini from a threaded server (as a single worker) against the
+local fakes in `bench.fakes`, and has `--concurrency` shoppers at a time go
+through the funnel over HTTP: browse the index, view a product, add one item
+from each shipper to the cart, submit shipping, reach `/checkout/pay`, and
+then Stripe's `checkout.session.completed` webhook for their checkout.
+Reports throughput, latency percentiles and error rates for each step,
+and how many checkouts were completed per second overall.
+
+With `--db`, completed checkouts are queued and fulfilled by
+`--job-workers` background job workers running alongside.
+The shoppers, fakes and konbini all share one process, so the
+throughput it reports is a lower bound for a real worker.
+
+    python bench/load.py [--concurrency 8] [--shoppers 200 | --duration 30] [--latency 0.05] [--think 0] [--db]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import itertools
+import requests
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bench import fakes as fakes_
+from bench import harness
+from bench.routes import percentile
+from konbini import db, jobs
+
+STEPS = ['browse', 'view_product', 'add_to_cart', 'submit_shipping', 'pay', 'checkout_completed_hook']
+
+# Seconds before a request is given up on (and counted as an error)
+TIMEOUT = 30
+
+
+class Client:
+    """A shopper's browser: keeps its cookies, doesn't follow redirects"""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path, **kwargs):
+        return self.session.get(self.base_url + path, allow_redirects=False, timeout=TIMEOUT, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.base_url + path, allow_redirects=False, timeout=TIMEOUT, **kwargs)
+
+
+class Results:
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.messages = defaultdict(int)
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, error=None):
+        with self._lock:
+            self.times[step].append(seconds * 1000)
+            if error is not None:
+                self.errors[step] += 1
+                self.messages['{}: {}'.format(step, error)] += 1
+
+    def checkout_completed(self):
+        with self._lock:
+            self.completed += 1
+
+
+def step(results, name, fn):
+    """Make one request of the funnel. Returns whether it went through"""
+    start = time.perf_counter()
+    error = None
+    try:
+        resp = fn()
+        if resp.status_code >= 400:
+            error = 'HTTP {}'.format(resp.status_code)
+    except requests.RequestException as err:
+        error = type(err).__name__
+    results.record(name, time.perf_counter() - start, error)
+    return error is None
+
+
+def funnel(shopper, fakes, results, think):
+    """One shopper's way through to a completed checkout.
+    Stops at the first step that fails"""
+    products = fakes.stripe.products
+    skus = {sku['product']: sku for sku in fakes.stripe.skus}
+    steps = [('browse', shopper.browse),
+             ('view_product', lambda: shopper.view(random.choice(products)))]
+
+    # One item from each shipper
+    for product in products[:3]:
+        steps.append(('add_to_cart', lambda product=product: shopper.add_to_cart(skus[product['id']])))
+    steps += [('submit_shipping', shopper.submit_shipping),
+              ('pay', shopper.pay),
+              ('checkout_completed_hook', lambda: harness.post_event(
+                  shopper.client, '/checkout/completed', harness.completed_checkout(fakes, shopper)))]
+
+    for name, fn in steps:
+        if not step(results, name, fn):
+            return
+        if think:
+            time.sleep(random.uniform(0, 2 * think))
+    results.checkout_completed()
+
+
+def work_jobs(app, stop):
+    with app.app_context():
+        while not stop.is_set():
+            if not jobs.run_once():
+                time.sleep(0.1)
+
+
+def pending_jobs(app):
+    with app.app_context():
+        return db.connect().execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+
+def report(results, elapsed, concurrency):
+    print('{} shoppers at a time, {:.1f}s'.format(concurrency, elapsed))
+    print('{:<24} {:>7} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}'.format(
+        'step', 'count', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    summary = {}
+    for name in STEPS:
+        times = results.times.get(name, [])
+        errors = results.errors.get(name, 0)
+        summary[name] = {
+            'count': len(times),
+            'throughput': len(times) / elapsed,
+            'errors': errors,
+            'error_rate': errors / len(times) if times else 0,
+            'p50': percentile(times, 50),
+            'p90': percentile(times, 90),
+            'p99': percentile(times, 99),
+            'max': max(times) if times else 0,
+        }
+        s = summary[name]
+        print('{:<24} {:>7} {:>8.1f} {:>6.1f}% {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            name, s['count'], s['throughput'], s['error_rate'] * 100, s['p50'], s['p90'], s['p99'], s['max']))
+    print()
+    print('completed checkouts: {} ({:.2f}/s)'.format(results.completed, results.completed / elapsed))
+    for message, count in sorted(results.messages.items(), key=lambda m: -m[1]):
+        print('  {:>5}x {}'.format(count, message))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test konbini\'s checkout funnel against local fakes')
+    parser.add_argument('--concurrency', type=int, default=8, help='shoppers going through the funnel at a time')
+    parser.add_argument('--shoppers', type=int, default=200, help='total shoppers (unless --duration is given)')
+    parser.add_argument('--duration', type=float, help='seconds to keep sending shoppers for')
+    parser.add_argument('--think', type=float, default=0, help='average seconds a shopper waits between steps')
+    parser.add_argument('--latency', default='0', help='seconds added by every fake, or e.g. "stripe=0.1,easypost=0.3"')
+    parser.add_argument('--db', action='store_true', help='use a (temporary) database, i.e. set KONBINI_DB_PATH')
+    parser.add_argument('--job-workers', type=int, default=1, help='with --db, job workers fulfilling checkouts')
+    parser.add_argument('--json', help='save the results to this file')
+    args = parser.parse_args()
+
+    with fakes_.Fakes(latency=fakes_.parse_latency(args.latency)) as fakes, \
+            tempfile.TemporaryDirectory() as tmp:
+        app = harness.make_app(fakes, db_path=os.path.join(tmp, 'konbini.db') if args.db else None)
+        server, base_url = harness.serve(app)
+
+        stop_jobs = threading.Event()
+        if args.db:
+            for _ in range(args.job_workers):
+                threading.Thread(target=work_jobs, args=(app, stop_jobs), daemon=True).start()
+
+        results = Results()
+        shoppers = itertools.count()
+        deadline = time.time() + args.duration if args.duration else None
+
+        def shop():
+            while True:
+                n = next(shoppers)
+                if (deadline is None and n >= args.shoppers) or (deadline is not None and time.time() >= deadline):
+                    return
+                funnel(harness.Shopper(Client(base_url), fakes, n=n), fakes, results, args.think)
+
+        start = time.time()
+        threads = [threading.Thread(target=shop) for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        summary = report(results, elapsed, args.concurrency)
+        backlog = None
+        if args.db:
+            stop_jobs.set()
+            backlog = pending_jobs(app)
+            print('jobs still queued: {}'.format(backlog))
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'latency': args.latency, 'db': args.db,
+                       'elapsed': elapsed, 'completed': results.completed,
+                       'jobs_queued': backlog, 'steps': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
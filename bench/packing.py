@@ -0,0 +1,89 @@
+"""Benchmark for `konbini.packing`.
+
+Packs random carts of up to 50 items into a typical set of boxes and
+reports latency percentiles, both for new carts and for carts that
+have been packed before. Exits with an error if the 99th percentile
+for new carts is over the budget.
+
+    python bench/packing.py [--carts 500] [--items 50] [--budget-ms 10]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from konbini import packing
+
+BOXES = [
+    {'name': 'mailer', 'length': 12, 'width': 9, 'height': 2, 'weight': 2},
+    {'name': 'small', 'length': 12, 'width': 12, 'height': 6, 'weight': 6, 'max_weight': 640},
+    {'name': 'medium', 'length': 16, 'width': 12, 'height': 8, 'weight': 10, 'max_weight': 960},
+    {'name': 'large', 'length': 18, 'width': 14, 'height': 12, 'weight': 12, 'max_weight': 1120},
+    {'name': 'tube', 'length': 38, 'width': 4, 'height': 4, 'weight': 6},
+]
+
+# (length, width, height, weight) in inches and ounces
+PRODUCTS = [
+    (9, 6, 1, 12),      # paperback
+    (11, 8.5, 1.5, 30), # hardcover
+    (8.5, 5.5, 0.2, 3), # zine
+    (10, 8, 4, 20),     # boxed item
+    (36, 3, 3, 10),     # rolled poster
+    (6, 6, 6, 16),      # mug
+    (30, 20, 10, 200),  # too big for any box
+]
+
+
+def random_cart(n_items):
+    cart, total = [], 0
+    products = random.sample(PRODUCTS, random.randint(1, len(PRODUCTS)))
+    for i, dims in enumerate(products):
+        q = n_items - total if i == len(products) - 1 else random.randint(0, n_items - total)
+        if q:
+            cart.append((dims, q))
+            total += q
+    return cart
+
+
+def percentiles(times):
+    times = sorted(times)
+    pick = lambda p: times[min(len(times) - 1, int(p * len(times)))] * 1000
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': times[-1] * 1000}
+
+
+def run(carts, items):
+    random.seed(0)
+    carts = [random_cart(random.randint(1, items)) for _ in range(carts)]
+    packing._pack.cache_clear()
+
+    cold, warm = [], []
+    for cart in carts:
+        start = time.perf_counter()
+        packing.pack(cart, BOXES)
+        cold.append(time.perf_counter() - start)
+    for cart in carts:
+        start = time.perf_counter()
+        packing.pack(cart, BOXES)
+        warm.append(time.perf_counter() - start)
+    return percentiles(cold), percentiles(warm)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--carts', type=int, default=500)
+    parser.add_argument('--items', type=int, default=50, help='most items in a cart')
+    parser.add_argument('--budget-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    # Warm up numpy
+    packing.pack(random_cart(args.items), BOXES)
+
+    cold, warm = run(args.carts, args.items)
+    for name, stats in (('new carts', cold), ('repeat carts', warm)):
+        print('{:<14} {}'.format(name, '  '.join('{} {:.3f}ms'.format(k, v) for k, v in stats.items())))
+
+    if cold['p99'] > args.budget_ms:
+        print('p99 for new carts is over the {}ms budget'.format(args.budget_ms))
+        sys.exit(1)
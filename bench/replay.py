@@ -0,0 +1,245 @@
+"""Replays Stripe webhook deliveries against a local instance, to see how
+the webhooks hold up under a given rate of events.
+
+The deliveries are either ones recorded from a real site (see
+`KONBINI_WEBHOOK_RECORD_DIR` in the readme), or made up here with
+`--synthesize`, e.g. `--synthesize checkout.session.completed=50,invoice.created=50`.
+They're re-signed with the local webhook secret and sent at `--rate` events
+a second (0 for as fast as they can be handled), from up to `--concurrency`
+at a time, to konbini served against the local fakes in `bench.fakes`. The
+fakes make up whatever customers, payment intents, shipments etc. recorded
+events refer to.
+
+Unless `--keep-ids`, every event (and the checkout session, invoice and
+payment intent it's about) gets a new id each time it's sent, so that
+repeats aren't skipped as duplicates and do the whole of their work again.
+
+Reports, for each webhook, latency percentiles, how far behind schedule
+events were sent, the outbound calls each event made (from its
+`X-Outbound-Calls` header) and how many deliveries took longer than
+Stripe waits for a webhook (`--timeout`), which Stripe would count as
+failed and retry.
+
+    python bench/replay.py recordings/ [--rate 20] [--concurrency 4] [--repeat 1] [--latency 0.05] [--db]
+    python bench/replay.py --synthesize checkout.session.completed=50,invoice.created=50 [--scrub]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bench import fakes as fakes_
+from bench import harness
+from bench.routes import percentile
+from konbini import recording
+
+# Where each webhook is mounted, under `/shop`
+HOOKS = {
+    'checkout_completed_hook': '/checkout/completed',
+    'subscribe_invoice_hook': '/subscribe/bill',
+    'sync_hook': '/sync',
+}
+
+# Which webhook each synthesized event type goes to
+SYNTHESIZED = {
+    'checkout.session.completed': 'checkout_completed_hook',
+    'invoice.created': 'subscribe_invoice_hook',
+}
+
+# Seconds Stripe waits for a webhook to respond
+STRIPE_TIMEOUT = 10
+
+
+def load(paths):
+    """Recorded deliveries, from files and directories of them, in the order they were received"""
+    recorded = []
+    for path in paths:
+        fnames = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.json')] \
+            if os.path.isdir(path) else [path]
+        for fname in fnames:
+            with open(fname) as f:
+                recorded.append(json.load(f))
+    return sorted(recorded, key=lambda r: r['received'])
+
+
+def synthesize(app, fakes, spec):
+    """Deliveries made by going through the shop, e.g. for
+    `checkout.session.completed=50,invoice.created=50`"""
+    recorded = []
+    for i, part in enumerate(spec.split(',')):
+        type, n = part.split('=')
+        if type not in SYNTHESIZED:
+            raise Exception('Can\'t synthesize "{}" events, only {}'.format(type, ', '.join(SYNTHESIZED)))
+        for j in range(int(n)):
+            if type == 'checkout.session.completed':
+                shopper = harness.Shopper(app.test_client(), fakes, n=i * 100000 + j)
+                shopper.fill_cart()
+                shopper.submit_shipping()
+                shopper.pay()
+                event = harness.completed_checkout(fakes, shopper)
+            else:
+                event = harness.created_invoice(fakes)
+            recorded.append({'hook': SYNTHESIZED[type], 'received': time.time(), 'payload': json.dumps(event)})
+    return recorded
+
+
+def prepare(recorded, fakes, keep_ids=False):
+    """A delivery ready to be sent: the webhook it goes to and its payload.
+    Has the fakes take in what the event refers to"""
+    event = json.loads(recorded['payload'])
+    obj = event['data']['object']
+    if not keep_ids:
+        event['id'] = fakes_.new_id('evt')
+        if obj.get('object') == 'checkout.session':
+            obj['id'] = fakes_.new_id('cs_test')
+            if obj.get('payment_intent'):
+                obj['payment_intent'] = fakes_.new_id('pi')
+        elif obj.get('object') == 'invoice':
+            obj['id'] = fakes_.new_id('in')
+
+    # Otherwise old ShipBob quotes would be quoted again
+    metadata = obj.get('metadata') or {}
+    if 'shipbob_quoted_at' in metadata:
+        metadata['shipbob_quoted_at'] = str(int(time.time()))
+
+    fakes.stripe.adopt(event)
+    return recorded['hook'], json.dumps(event)
+
+
+class Results:
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.lags = defaultdict(list)
+        self.calls = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, hook, seconds, lag, status, calls):
+        with self._lock:
+            self.times[hook].append(seconds * 1000)
+            self.lags[hook].append(lag * 1000)
+            self.statuses[hook][status] += 1
+            if calls is not None:
+                self.calls[hook].append(calls)
+
+
+def send(session, base_url, hook, payload, scheduled, results, timeout):
+    lag = max(0, time.perf_counter() - scheduled)
+    start = time.perf_counter()
+    calls = None
+    try:
+        resp = session.post(base_url + '/shop' + HOOKS[hook], data=payload, timeout=max(30, 3 * timeout), headers={
+            'Stripe-Signature': harness.sign(payload),
+            'Content-Type': 'application/json',
+        })
+        status = resp.status_code
+        calls = int(resp.headers.get('X-Outbound-Calls', 0))
+    except requests.RequestException as err:
+        status = type(err).__name__
+    results.record(hook, time.perf_counter() - start, lag, status, calls)
+
+
+def replay(deliveries, base_url, results, rate, concurrency, timeout):
+    """Send the deliveries at `rate` a second (or as fast as possible, if 0)"""
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, (hook, payload) in enumerate(deliveries):
+            scheduled = start + i / rate if rate else time.perf_counter()
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(lambda *args: send(session(), *args),
+                        base_url, hook, payload, scheduled, results, timeout)
+    return time.perf_counter() - start
+
+
+def report(results, upstream, elapsed, timeout):
+    total = sum(len(times) for times in results.times.values())
+    print('{} events in {:.1f}s ({:.1f}/s)'.format(total, elapsed, total / elapsed if elapsed else 0))
+    print('{:<24} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>6} {:>9}'.format(
+        'hook', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'lag ms', 'calls', 'timeouts'))
+    summary = {}
+    for hook, times in results.times.items():
+        calls = results.calls[hook]
+        summary[hook] = {
+            'count': len(times),
+            'p50': percentile(times, 50),
+            'p90': percentile(times, 90),
+            'p99': percentile(times, 99),
+            'max': max(times),
+            'lag_p99': percentile(results.lags[hook], 99),
+            'calls': sum(calls) / len(calls) if calls else 0,
+            'timeouts': sum(1 for t in times if t > timeout * 1000),
+            'statuses': {str(status): n for status, n in results.statuses[hook].items()},
+        }
+        s = summary[hook]
+        print('{:<24} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6.1f} {:>9}'.format(
+            hook, s['count'], s['p50'], s['p90'], s['p99'], s['max'], s['lag_p99'], s['calls'], s['timeouts']))
+    print()
+    print('upstream calls per event: ' + ', '.join(
+        '{} {:.1f}'.format(name, count / total if total else 0) for name, count in upstream.items()))
+    for hook, s in summary.items():
+        print('{} responses: {}'.format(hook, ', '.join(
+            '{} x{}'.format(status, n) for status, n in sorted(s['statuses'].items()))))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Stripe webhook deliveries against konbini and local fakes')
+    parser.add_argument('recordings', nargs='*', help='recorded deliveries, or directories of them')
+    parser.add_argument('--synthesize', help='make up deliveries instead, e.g. "checkout.session.completed=50,invoice.created=50"')
+    parser.add_argument('--rate', type=float, default=10, help='events sent a second (0 for as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=4, help='events being delivered at a time, at most')
+    parser.add_argument('--repeat', type=int, default=1, help='times to send each delivery')
+    parser.add_argument('--keep-ids', action='store_true', help='send events with their recorded ids')
+    parser.add_argument('--scrub', action='store_true', help='scrub personal details from the events before sending')
+    parser.add_argument('--latency', default='0', help='seconds added by every fake, or e.g. "stripe=0.1,easypost=0.3"')
+    parser.add_argument('--db', action='store_true', help='use a (temporary) database, i.e. set KONBINI_DB_PATH')
+    parser.add_argument('--timeout', type=float, default=STRIPE_TIMEOUT, help='seconds Stripe waits for a webhook')
+    parser.add_argument('--json', help='save the results to this file')
+    args = parser.parse_args()
+    if not args.recordings and not args.synthesize:
+        parser.error('Give recorded deliveries to replay, or --synthesize')
+
+    with fakes_.Fakes(latency=fakes_.parse_latency(args.latency), lenient=True) as fakes, \
+            tempfile.TemporaryDirectory() as tmp:
+        app = harness.make_app(fakes, db_path=os.path.join(tmp, 'konbini.db') if args.db else None)
+        recorded = synthesize(app, fakes, args.synthesize) if args.synthesize else load(args.recordings)
+        for hook in set(r['hook'] for r in recorded) - set(HOOKS):
+            parser.error('Don\'t know where to send deliveries to "{}"'.format(hook))
+        if args.scrub:
+            recorded = [dict(r, payload=json.dumps(recording.scrub(json.loads(r['payload'])))) for r in recorded]
+
+        deliveries = [prepare(r, fakes, args.keep_ids) for _ in range(args.repeat) for r in recorded]
+        server, base_url = harness.serve(app)
+        results = Results()
+        before = fakes.counts()
+        elapsed = replay(deliveries, base_url, results, args.rate, args.concurrency, args.timeout)
+        after = fakes.counts()
+        server.shutdown()
+
+    upstream = {name: after[name] - before[name] for name in before}
+    summary = report(results, upstream, elapsed, args.timeout)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rate': args.rate, 'concurrency': args.concurrency, 'latency': args.latency,
+                       'db': args.db, 'timeout': args.timeout, 'elapsed': elapsed,
+                       'upstream': upstream, 'hooks': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Benchmark for konbini's routes and webhooks.
+
+Runs each route against the local fakes in `bench.fakes` (so it needs no
+network or credentials) and reports latency percentiles, the outbound calls
+each request made (from its `X-Outbound-Calls` header) and how many of those
+went to each service. With the default of no upstream latency, the times are
+konbini's own overhead; use `--latency` to see how it holds up against slow
+upstreams, e.g. `--latency stripe=0.1,easypost=0.3`. With `--db`,
+`checkout_completed_hook` only queues the order for the job worker,
+so it doesn't include fulfilling it.
+
+Save the results with `--json` and compare a later run against them with
+`--compare`, e.g. before and after a change:
+
+    python bench/routes.py --json before.json
+    python bench/routes.py --compare before.json [--max-regression 20]
+
+    python bench/routes.py [--requests 50] [--warmup 5] [--latency 0] [--db] [--routes pay,checkout]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bench import fakes as fakes_
+from bench import harness
+
+_shoppers = itertools.count()
+
+
+def _shopper(app, fakes):
+    return harness.Shopper(app.test_client(), fakes, n=next(_shoppers))
+
+
+def scenarios(app, fakes):
+    """For each route, a function that sets up a request to it
+    and returns a function that makes the request"""
+    products, skus = fakes.stripe.products, fakes.stripe.skus
+
+    def index(i):
+        return _shopper(app, fakes).browse
+
+    def product(i):
+        shopper = _shopper(app, fakes)
+        return lambda: shopper.view(products[i % len(products)])
+
+    def cart(i):
+        shopper = _shopper(app, fakes)
+        return lambda: shopper.add_to_cart(skus[i % len(skus)])
+
+    def checkout(i):
+        shopper = _shopper(app, fakes)
+        shopper.fill_cart()
+        return shopper.submit_shipping
+
+    def pay(i):
+        shopper = _shopper(app, fakes)
+        shopper.fill_cart()
+        shopper.submit_shipping()
+        return shopper.pay
+
+    def subscribe(i):
+        shopper = _shopper(app, fakes)
+        shopper.choose_plan(fakes.stripe.plan)
+        shopper.submit_subscription_address()
+        return shopper.subscribe
+
+    def checkout_completed_hook(i):
+        shopper = _shopper(app, fakes)
+        shopper.fill_cart()
+        shopper.submit_shipping()
+        shopper.pay()
+        event = harness.completed_checkout(fakes, shopper)
+        return lambda: harness.post_event(shopper.client, '/checkout/completed', event)
+
+    def subscribe_invoice_hook(i):
+        client = app.test_client()
+        event = harness.created_invoice(fakes)
+        return lambda: harness.post_event(client, '/subscribe/bill', event)
+
+    return {
+        'index': index,
+        'product': product,
+        'cart': cart,
+        'checkout': checkout,
+        'pay': pay,
+        'subscribe': subscribe,
+        'checkout_completed_hook': checkout_completed_hook,
+        'subscribe_invoice_hook': subscribe_invoice_hook,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_route(setup, fakes, requests, warmup):
+    times, calls, errors = [], [], 0
+    upstream = {name: 0 for name in fakes.services()}
+    for i in range(warmup + requests):
+        make_request = setup(i)
+        before = fakes.counts()
+        start = time.perf_counter()
+        resp = make_request()
+        elapsed = time.perf_counter() - start
+        after = fakes.counts()
+        if i < warmup:
+            continue
+        if resp.status_code >= 400:
+            errors += 1
+        times.append(elapsed * 1000)
+        calls.append(int(resp.headers.get('X-Outbound-Calls', 0)))
+        for name in upstream:
+            upstream[name] += after[name] - before[name]
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50': percentile(times, 50),
+        'p90': percentile(times, 90),
+        'p99': percentile(times, 99),
+        'max': max(times),
+        'calls': sum(calls) / len(calls),
+        'upstream': {name: count / requests for name, count in upstream.items()},
+    }
+
+
+def report(results, baseline=None):
+    services = fakes_.SERVICES
+    header = '{:<26} {:>5} {:>8} {:>8} {:>8} {:>8} {:>6}'.format(
+        'route', 'err', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'calls')
+    header += ''.join(' {:>8}'.format(s) for s in services)
+    print(header)
+    for route, r in results.items():
+        line = '{:<26} {:>5} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6.1f}'.format(
+            route, r['errors'], r['p50'], r['p90'], r['p99'], r['max'], r['calls'])
+        line += ''.join(' {:>8.1f}'.format(r['upstream'][s]) for s in services)
+        print(line)
+
+    if baseline is None:
+        return
+    print()
+    print('{:<26} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8} {:>7}'.format(
+        'route', 'p50 was', 'p50 now', 'change', 'p99 was', 'p99 now', 'change', 'calls'))
+    for route, r in results.items():
+        if route not in baseline:
+            continue
+        b = baseline[route]
+        print('{:<26} {:>10.1f} {:>10.1f} {:>+7.0f}% {:>10.1f} {:>10.1f} {:>+7.0f}% {:>+7.1f}'.format(
+            route, b['p50'], r['p50'], change(b['p50'], r['p50']),
+            b['p99'], r['p99'], change(b['p99'], r['p99']), r['calls'] - b['calls']))
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark konbini\'s routes against local fakes')
+    parser.add_argument('--requests', type=int, default=50, help='requests measured per route')
+    parser.add_argument('--warmup', type=int, default=5, help='requests made per route before measuring')
+    parser.add_argument('--latency', default='0', help='seconds added by every fake, or e.g. "stripe=0.1,easypost=0.3"')
+    parser.add_argument('--routes', help='comma-separated routes to run (default all)')
+    parser.add_argument('--products', type=int, default=8, help='products in the fake catalog')
+    parser.add_argument('--db', action='store_true', help='use a (temporary) database, i.e. set KONBINI_DB_PATH')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare against results saved with --json')
+    parser.add_argument('--max-regression', type=float,
+                        help='with --compare, exit with an error if any p50 got slower by more than this percent')
+    args = parser.parse_args()
+
+    with fakes_.Fakes(latency=fakes_.parse_latency(args.latency), products=args.products) as fakes, \
+            tempfile.TemporaryDirectory() as tmp:
+        app = harness.make_app(fakes, db_path=os.path.join(tmp, 'konbini.db') if args.db else None)
+        routes = scenarios(app, fakes)
+        selected = args.routes.split(',') if args.routes else list(routes)
+        for route in selected:
+            if route not in routes:
+                parser.error('Unknown route "{}", expected one of {}'.format(route, ', '.join(routes)))
+
+        results = {}
+        for route in selected:
+            results[route] = run_route(routes[route], fakes, args.requests, args.warmup)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['routes']
+    report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency': args.latency, 'db': args.db, 'requests': args.requests,
+                       'routes': results}, f, indent=2)
+
+    if any(r['errors'] for r in results.values()):
+        sys.exit('Some requests failed')
+    if baseline is not None and args.max_regression is not None:
+        regressed = [route for route, r in results.items()
+                     if route in baseline and change(baseline[route]['p50'], r['p50']) > args.max_regression]
+        if regressed:
+            sys.exit('p50 regressed by more than {:.0f}%: {}'.format(args.max_regression, ', '.join(regressed)))
+
+
+if __name__ == '__main__':
+    main()
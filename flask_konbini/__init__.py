@@ -1,7 +1,7 @@
 import stripe
-import easypost
-from konbini import core
+from konbini import core, metrics, shipping
 from konbini.routes import bp
+from konbini.cli import cli
 
 class Konbini:
     def __init__(self, app=None):
@@ -13,14 +13,18 @@ class Konbini:
         self.app = app
 
         app.csrf_protect.exempt('konbini.routes.checkout_completed_hook')
+        app.csrf_protect.exempt('konbini.routes.sync_hook')
 
         stripe.api_key = app.config['STRIPE_SECRET_KEY']
-        easypost.client = easypost.EasyPostClient(app.config['EASYPOST_API_KEY'])
+        shipping.init_app(app)
+        metrics.install()
 
         url_prefix = app.config.get('KONBINI_URL_PREFIX', '/shop')
         app.register_blueprint(bp, url_prefix=url_prefix)
+        app.cli.add_command(cli)
 
         self.app.get_products = core.get_products
+        self.app.catalog_stats = core.catalog_stats
 
         if app.config.get('KONBINI_INVOICE_SUB_SHIPPING') and 'KONBINI_SHIPPING_FROM' not in app.config:
             raise Exception('If you specify "KONBINI_INVOICE_SUB_SHIPPING", "KONBINI_SHIPPING_FROM" must also be set')
@@ -0,0 +1,129 @@
+"""Normalization of domestic (US) addresses through USPS.
+
+Results are memoized in an in-process LRU cache and, if `KONBINI_DB_PATH`
+is set, in the database too, so they're shared across workers and survive
+restarts. Addresses USPS rejects are cached as well (for a shorter time),
+so resubmitting one doesn't go back to USPS either.
+"""
+import json
+import time
+import threading
+from . import db, metrics
+from flask import current_app
+from collections import OrderedDict
+from pyusps import address_information
+
+USPS_ADDRESS_KEYS = {
+    'address': 'line1',
+    'address_extended': 'line2',
+    'state': 'state',
+    'city': 'city',
+    'zip5': 'postal_code'
+}
+
+# Defaults for how many addresses to keep in memory,
+# and for how many seconds to keep valid/invalid results
+CACHE_SIZE = 2048
+CACHE_TTL = 7 * 24 * 60 * 60
+INVALID_TTL = 24 * 60 * 60
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS addresses (
+    key TEXT PRIMARY KEY,
+    address TEXT,
+    expires REAL NOT NULL
+);
+''')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _canonical(address):
+    """Addresses that only differ in case, spacing or punctuation
+    get the same key"""
+    def norm(val):
+        val = (val or '').upper().replace('.', ' ').replace(',', ' ')
+        return ' '.join(val.split())
+    return json.dumps([norm(address.get(k)) for k in ['line1', 'line2', 'city', 'state', 'postal_code']])
+
+
+def _get(key):
+    now = time.time()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                _cache.move_to_end(key)
+                return True, entry[0]
+            del _cache[key]
+
+    if db.enabled():
+        row = db.connect().execute('SELECT address, expires FROM addresses WHERE key = ? AND expires > ?',
+                                   (key, now)).fetchone()
+        if row is not None:
+            address = json.loads(row['address']) if row['address'] is not None else None
+            _remember(key, address, row['expires'])
+            return True, address
+    return False, None
+
+
+def _remember(key, address, expires):
+    with _lock:
+        _cache[key] = (address, expires)
+        _cache.move_to_end(key)
+        while len(_cache) > current_app.config.get('KONBINI_ADDRESS_CACHE_SIZE', CACHE_SIZE):
+            _cache.popitem(last=False)
+
+
+def _set(key, address):
+    config = current_app.config
+    if address is None:
+        ttl = config.get('KONBINI_ADDRESS_INVALID_TTL', INVALID_TTL)
+    else:
+        ttl = config.get('KONBINI_ADDRESS_CACHE_TTL', CACHE_TTL)
+    expires = time.time() + ttl
+    _remember(key, address, expires)
+    if db.enabled():
+        db.connect().execute('INSERT OR REPLACE INTO addresses (key, address, expires) VALUES (?, ?, ?)',
+                             (key, json.dumps(address) if address is not None else None, expires))
+
+
+def _verify(address):
+    """Ask USPS for the normalized address, `None` if it's invalid"""
+    addr = {
+        'zip_code': address['postal_code'],
+        'state': address['state'],
+        'city': address['city'],
+        'address': address['line1']
+    }
+    line2 = address.get('line2')
+    if line2:
+        addr['address_extended'] = line2
+    try:
+        with metrics.timed('usps', 'verify'):
+            usps_addr = address_information.verify(current_app.config['USPS_USER_ID'], addr)
+    except ValueError:
+        return None
+    norm_addr = {k_to: usps_addr.get(k_frm) for k_frm, k_to in USPS_ADDRESS_KEYS.items()}
+    norm_addr['country'] = 'US'
+    return norm_addr
+
+
+def normalize_address(address):
+    """Normalize a domestic (US) address"""
+    if address['country'] != 'US':
+        return address, False
+
+    key = _canonical(address)
+    found, norm_addr = _get(key)
+    if not found:
+        norm_addr = _verify(address)
+        _set(key, norm_addr)
+
+    if norm_addr is None:
+        return None, True
+
+    changed = any((norm_addr[k] or '').lower() != (address[k] or '').lower()
+                  for k in USPS_ADDRESS_KEYS.values())
+    return dict(norm_addr), changed
@@ -1,17 +1,13 @@
 import config
 import stripe
-import sentry_sdk
 from flask import Flask
 from flask_mail import Mail
+from . import metrics, shipping
+from .cli import cli as konbini_cli
 from .routes import bp as shop_bp
-from sentry_sdk.integrations.flask import FlaskIntegration
 
 stripe.api_key = config.STRIPE_SECRET_KEY
 
-if 'EASYPOST_API_KEY' in dir(config):
-    import easypost
-    easypost.client = easypost.EasyPostClient(config.EASYPOST_API_KEY)
-
 def create_app(package_name=__name__, static_folder='static', template_folder='templates', **config_overrides):
     app = Flask(package_name,
                 static_url_path='/assets',
@@ -24,8 +20,14 @@ def create_app(package_name=__name__, static_folder='static', template_folder='t
 
     app.mail = Mail(app)
     app.register_blueprint(shop_bp)
+    app.cli.add_command(konbini_cli)
+    shipping.init_app(app)
+    metrics.install()
 
     if not app.debug:
+        # Imported here so that workers that don't report errors don't pay for it
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
         sentry_sdk.init(
             dsn=config.SENTRY_DSN,
             integrations=[FlaskIntegration()]
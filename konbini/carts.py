@@ -0,0 +1,223 @@
+"""Server-side storage for carts and checkout details.
+
+The session cookie only holds an opaque `cart_id`. The cart itself (its
+lines, subtotal and size, and checkout details like the email, shipping
+address, subscription plan and Stripe Checkout session id) is kept in a
+store, picked with `KONBINI_CART_STORE`:
+
+    'sqlite'    in the local database (the default if `KONBINI_DB_PATH` is set)
+    'session'   compactly in the session cookie (the default otherwise)
+    'memory'    in process memory, which is only shared within one process
+
+or any object with `load(id)`, `save(id, data)` and `delete(id)` methods.
+Carts in the database that haven't been touched for `KONBINI_CART_TTL`
+seconds (default 30 days) are ignored, and can be removed with
+`flask konbini prune-carts`.
+"""
+import json
+import time
+import uuid
+import threading
+from . import db, core, pricing
+from collections import namedtuple
+from flask import g, session, current_app
+
+CART_TTL = 30*24*60*60
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS carts (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS carts_updated ON carts (updated);
+''')
+
+Line = namedtuple('Line', ['id', 'quantity', 'price', 'product_id', 'name',
+                           'interval', 'interval_count', 'exclude_tax'])
+
+
+class Cart:
+    """A cart's lines and checkout details.
+    Each line is kept as a list of its `Line` fields after the id"""
+    def __init__(self, id, lines=None, checkout=None, subtotal=0, size=0):
+        self.id = id
+        self.lines = lines or {}
+        self.checkout = checkout or {}
+        self.subtotal = subtotal
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, id, data):
+        return cls(id, data.get('l'), data.get('c'), data.get('t', 0), data.get('n', 0))
+
+    def to_dict(self):
+        return {'l': self.lines, 'c': self.checkout, 't': self.subtotal, 'n': self.size}
+
+    def __len__(self):
+        return len(self.lines)
+
+    def items(self):
+        for id, line in self.lines.items():
+            yield Line(id, *line)
+
+    def get(self, id):
+        line = self.lines.get(id)
+        return Line(id, *line) if line is not None else None
+
+    def quantity(self, id):
+        line = self.lines.get(id)
+        return line[0] if line is not None else 0
+
+    def set(self, id, quantity, price, product_id, name, interval=None, interval_count=None, exclude_tax=False):
+        if not quantity:
+            self.remove(id)
+        else:
+            self.lines[id] = [quantity, price, product_id, name, interval, interval_count, exclude_tax]
+
+    def set_quantity(self, id, quantity):
+        if not quantity:
+            self.remove(id)
+        else:
+            self.lines[id][0] = quantity
+
+    def remove(self, id):
+        self.lines.pop(id, None)
+
+    def update_totals(self):
+        self.subtotal = sum(line[0] * line[1] for line in self.lines.values())
+        self.size = sum(line[0] for line in self.lines.values())
+
+
+def line_details(id):
+    """Price, product, recurrence and tax exemption for a SKU or price.
+    These come from the local price index; only SKUs and prices
+    that aren't in it are looked up in Stripe"""
+    obj = pricing.find(id)
+    if obj is None:
+        if id.startswith('sku_'):
+            obj = core.get_sku(id)
+        elif id.startswith('price_'):
+            obj = core.get_price(id)
+        else:
+            raise ValueError('Not a SKU or price: {}'.format(id))
+        # Not in the synced catalog mirror
+        if obj is None:
+            raise ValueError('Unknown SKU or price: {}'.format(id))
+
+    recurring = obj.get('recurring')
+    return {
+        'price': obj['price'] if obj['object'] == 'sku' else obj['unit_amount'],
+        'product_id': obj['product'],
+        'interval': recurring['interval'] if recurring else None,
+        'interval_count': recurring['interval_count'] if recurring else None,
+        'exclude_tax': obj['metadata'].get('exclude_tax') == 'true',
+    }
+
+
+class SQLiteStore:
+    def load(self, id):
+        ttl = current_app.config.get('KONBINI_CART_TTL', CART_TTL)
+        row = db.connect().execute('SELECT data FROM carts WHERE id = ? AND updated >= ?',
+                                   (id, time.time() - ttl)).fetchone()
+        return json.loads(row['data']) if row is not None else None
+
+    def save(self, id, data):
+        db.connect().execute('INSERT OR REPLACE INTO carts (id, data, updated) VALUES (?, ?, ?)',
+                             (id, json.dumps(data, separators=(',', ':')), time.time()))
+
+    def delete(self, id):
+        db.connect().execute('DELETE FROM carts WHERE id = ?', (id,))
+
+    def prune(self):
+        ttl = current_app.config.get('KONBINI_CART_TTL', CART_TTL)
+        cur = db.connect().execute('DELETE FROM carts WHERE updated < ?', (time.time() - ttl,))
+        return cur.rowcount
+
+
+class SessionStore:
+    """Keeps the cart in the session itself,
+    for when there's nowhere else to keep it"""
+    def load(self, id):
+        data = session.get('konbini_cart')
+        return data if data is not None and data.get('id') == id else None
+
+    def save(self, id, data):
+        session['konbini_cart'] = dict(data, id=id)
+
+    def delete(self, id):
+        session.pop('konbini_cart', None)
+
+
+class MemoryStore:
+    def __init__(self):
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def load(self, id):
+        with self._lock:
+            data = self._carts.get(id)
+        return json.loads(data) if data is not None else None
+
+    def save(self, id, data):
+        with self._lock:
+            self._carts[id] = json.dumps(data)
+
+    def delete(self, id):
+        with self._lock:
+            self._carts.pop(id, None)
+
+
+STORES = {
+    'sqlite': SQLiteStore,
+    'session': SessionStore,
+    'memory': MemoryStore,
+}
+
+_lock = threading.Lock()
+
+def get_store():
+    app = current_app._get_current_object()
+    with _lock:
+        if 'konbini_carts' not in app.extensions:
+            store = app.config.get('KONBINI_CART_STORE')
+            if store is None:
+                store = 'sqlite' if db.enabled() else 'session'
+            if isinstance(store, str):
+                store = STORES[store]()
+            app.extensions['konbini_carts'] = store
+    return app.extensions['konbini_carts']
+
+
+def get_cart():
+    """The current visitor's cart. A new cart isn't stored
+    (and doesn't get a cookie) until it's first saved"""
+    if 'konbini_cart' not in g:
+        id = session.get('cart_id')
+        data = get_store().load(id) if id else None
+        if data is None:
+            g.konbini_cart = Cart(uuid.uuid4().hex)
+        else:
+            g.konbini_cart = Cart.from_dict(id, data)
+    return g.konbini_cart
+
+
+def save_cart(cart):
+    cart.update_totals()
+    get_store().save(cart.id, cart.to_dict())
+    session['cart_id'] = cart.id
+
+
+def clear_cart():
+    """Start a new cart after a checkout is completed,
+    keeping the email so it doesn't have to be entered again"""
+    cart = get_cart()
+    get_store().delete(cart.id)
+    new_cart = Cart(uuid.uuid4().hex)
+    if cart.checkout.get('email'):
+        new_cart.checkout['email'] = cart.checkout['email']
+        save_cart(new_cart)
+    else:
+        session.pop('cart_id', None)
+    g.konbini_cart = new_cart
+    return new_cart
@@ -0,0 +1,58 @@
+import click
+from . import db, jobs, carts, ledger, mirror, orders, customers
+from flask.cli import AppGroup
+
+cli = AppGroup('konbini', help='Konbini maintenance commands.')
+
+
+def require_db():
+    if not db.enabled():
+        raise click.ClickException('Set KONBINI_DB_PATH to use this command.')
+
+
+@cli.command('sync-catalog')
+def sync_catalog():
+    """Mirror products, prices, SKUs and tax rates from Stripe."""
+    require_db()
+    counts = mirror.sync()
+    for kind, count in counts.items():
+        click.echo('{}: {}'.format(kind, count))
+
+
+@cli.command('backfill-customers')
+def backfill_customers():
+    """Index all Stripe customers by email."""
+    require_db()
+    count = customers.backfill()
+    click.echo('customers: {}'.format(count))
+
+
+@cli.command('worker')
+@click.option('--interval', default=1.0, help='Seconds to wait between polls when idle.')
+@click.option('--burst', is_flag=True, help='Exit once there are no jobs left.')
+def worker(interval, burst):
+    """Run background jobs (e.g. order fulfillment)."""
+    require_db()
+    jobs.work(interval=interval, burst=burst)
+
+
+@cli.command('requeue-dead-jobs')
+def requeue_dead_jobs():
+    """Retry jobs that ran out of attempts."""
+    require_db()
+    click.echo('requeued: {}'.format(jobs.requeue_dead()))
+
+
+@cli.command('prune-carts')
+def prune_carts():
+    """Delete carts that haven't been touched in KONBINI_CART_TTL seconds."""
+    require_db()
+    click.echo('pruned: {}'.format(carts.SQLiteStore().prune()))
+
+
+@cli.command('prune-events')
+@click.option('--days', default=30, help='Keep handled events for this many days.')
+def prune_events(days):
+    """Forget webhook events that were handled more than --days ago."""
+    require_db()
+    click.echo('pruned: {}'.format(ledger.prune(days)))
@@ -1,15 +1,257 @@
+import time
 import stripe
+import threading
+from . import db, taxes, mirror, pricing, customers
+from flask import g, current_app, has_app_context
+
+# Default number of seconds a catalog entry is considered fresh,
+# and for how many seconds past that a stale entry may still be served
+# while it is refreshed in the background.
+CATALOG_TTL = 60
+CATALOG_STALE_TTL = 600
+
+
+class CatalogCache:
+    """In-process cache of Stripe catalog objects (products, prices, SKUs).
+
+    Fresh entries are served straight from memory. Entries past their TTL
+    are still served while a background thread refetches them
+    (stale-while-revalidate); entries past the stale TTL are refetched inline.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._generation = None
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, ttl, stale_ttl):
+        """Returns whether the entry for `key` is fresh, stale or missing,
+        and its value if it is usable"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.time() - fetched_at
+            if age < ttl:
+                self.hits += 1
+                return 'fresh', value
+            if age < ttl + stale_ttl:
+                self.stale_hits += 1
+                return 'stale', value
+        self.misses += 1
+        return 'missing', None
+
+    def get(self, key, loader, ttl, stale_ttl):
+        state, value = self._lookup(key, ttl, stale_ttl)
+        if state == 'stale':
+            self._revalidate([key], lambda keys: {key: loader()})
+        elif state == 'missing':
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def get_many(self, keys, loader, ttl, stale_ttl):
+        """Get several entries at once. `loader` is called (at most once)
+        with the list of missing keys and should return a dict of key -> value"""
+        values, stale, missing = {}, [], []
+        for key in keys:
+            state, value = self._lookup(key, ttl, stale_ttl)
+            if state == 'missing':
+                missing.append(key)
+            else:
+                values[key] = value
+                if state == 'stale':
+                    stale.append(key)
+        if stale:
+            self._revalidate(stale, loader)
+        if missing:
+            loaded = loader(missing)
+            for key in missing:
+                values[key] = loaded.get(key)
+                self.set(key, values[key])
+        return values
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+
+    def _revalidate(self, keys, loader):
+        with self._lock:
+            keys = [k for k in keys if k not in self._refreshing]
+            if not keys:
+                return
+            self._refreshing.update(keys)
+
+        app = current_app._get_current_object()
+        def refresh():
+            try:
+                with app.app_context():
+                    loaded = loader(keys)
+                for key in keys:
+                    self.set(key, loaded.get(key))
+            except Exception:
+                # Keep serving the stale values, we'll try again on the next hit
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.difference_update(keys)
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def check_generation(self, generation):
+        """Drop everything if the catalog mirror
+        has been written to since we last looked"""
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+        }
+
+catalog = CatalogCache()
+
+
+def _cache_args(loader, mirror_loader):
+    """Check the cache against the catalog mirror and pick a loader.
+    If the mirror has been synced, entries are loaded from it
+    instead of from Stripe"""
+    config = current_app.config
+    generation = mirror.generation()
+    catalog.check_generation(generation)
+    if generation is not None:
+        loader = mirror_loader
+    return (loader,
+            config.get('KONBINI_CATALOG_TTL', CATALOG_TTL),
+            config.get('KONBINI_CATALOG_STALE_TTL', CATALOG_STALE_TTL))
+
+def _cached(key, loader, mirror_loader):
+    return catalog.get(key, *_cache_args(loader, mirror_loader))
+
+def _request_products():
+    """Products already looked up while handling the current request"""
+    return g.setdefault('konbini_products', {}) if has_app_context() else {}
 
 def get_products():
-    return stripe.Product.list(expand=['data.default_price'], limit=100, active=True)['data']
+    return _cached(('products',),
+        lambda: stripe.Product.list(expand=['data.default_price'], limit=100, active=True)['data'],
+        mirror.products)
 
 def get_product(id):
-    return stripe.Product.retrieve('prod_{}'.format(id), expand=['default_price'])
+    if not id.startswith('prod_'):
+        id = 'prod_{}'.format(id)
+    memo = _request_products()
+    if id not in memo:
+        memo[id] = _cached(('product', id),
+            lambda: stripe.Product.retrieve(id, expand=['default_price']),
+            lambda: mirror.get(id))
+    return memo[id]
+
+def _fetch_products(keys):
+    products = {}
+    ids = [id for _, id in keys]
+    for i in range(0, len(ids), 100):
+        resp = stripe.Product.list(ids=ids[i:i+100], limit=100, expand=['data.default_price'])
+        products.update({('product', p.id): p for p in resp['data']})
+    return products
+
+def _mirror_products(keys):
+    products = mirror.products_by_id([id for _, id in keys])
+    return {('product', id): p for id, p in products.items()}
+
+def get_products_by_id(ids):
+    """Get several products at once, as a dict of id -> product.
+    Products that aren't cached are fetched together in one list call
+    (per 100 products), and every product is memoized
+    for the rest of the request"""
+    memo = _request_products()
+    missing = [id for id in dict.fromkeys(ids) if id not in memo]
+    if missing:
+        products = catalog.get_many([('product', id) for id in missing],
+                                    *_cache_args(_fetch_products, _mirror_products))
+        for (_, id), product in products.items():
+            memo[id] = product
+    return {id: memo.get(id) for id in ids}
+
+def get_prices(product_id):
+    return pricing.prices(product_id)
+
+def get_skus(product_id):
+    return pricing.skus(product_id)
+
+def get_price(id):
+    return _cached(('price', id), lambda: stripe.Price.retrieve(id), lambda: mirror.get(id))
+
+def get_sku(id):
+    return _cached(('sku', id), lambda: stripe.SKU.retrieve(id), lambda: mirror.get(id))
+
+def catalog_stats():
+    return catalog.stats()
+
+def sync_catalog(event):
+    """Apply a `product.*`, `price.*`, `sku.*` or `tax_rate.*`
+    webhook event to the catalog mirror (if enabled)
+    and invalidate any cached entries it affects"""
+    obj = event['data']['object']
+    kind = event['type'].split('.', 1)[0]
+    if kind not in mirror.KINDS:
+        return False
+
+    if db.enabled():
+        mirror.apply_event(event)
+
+    if kind == 'product':
+        product_id = obj['id']
+    elif kind in ('price', 'sku'):
+        product_id = obj['product']
+        catalog.invalidate((kind, obj['id']))
+    else:
+        taxes.invalidate()
+        return True
+    pricing.invalidate()
+
+    # Products are listed with their default price expanded,
+    # so any change can affect both the product and the listing
+    catalog.invalidate(('product', product_id), ('products',))
+    return True
+
+
+def sync(event):
+    """Apply a webhook event sent to the `/sync` endpoint"""
+    if sync_catalog(event):
+        return True
+    if db.enabled():
+        return customers.apply_event(event)
+    return False
+
 
 def get_customers(email):
+    # Try the local customer index first
+    if db.enabled():
+        matches = customers.lookup(email)
+        if matches:
+            return matches
+
     resp = stripe.Customer.list(email=email, limit=100)
-    customers = resp['data']
+    matches = resp['data']
     while resp.has_more:
-        resp = stripe.Customer.list(email=email, starting_after=customers[-1], limit=100)
-        customers += resp['data']
-    return customers
+        resp = stripe.Customer.list(email=email, starting_after=matches[-1], limit=100)
+        matches += resp['data']
+
+    if db.enabled():
+        customers.add(matches)
+    return matches
@@ -0,0 +1,80 @@
+"""Local index of Stripe customers by email.
+
+Filled by `flask konbini backfill-customers` and kept current
+by `customer.created`, `customer.updated` and `customer.deleted`
+webhook events sent to the `/sync` endpoint.
+"""
+import json
+import time
+import stripe
+from . import db
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS customers (
+    id TEXT PRIMARY KEY,
+    email TEXT,
+    created INTEGER,
+    event_created INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customers_email ON customers (email, created);
+''')
+
+
+def _upsert(conn, customer, event_created):
+    conn.execute('''INSERT INTO customers (id, email, created, event_created, data)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        email = excluded.email,
+                        event_created = excluded.event_created,
+                        data = excluded.data
+                    WHERE excluded.event_created >= customers.event_created''',
+                 (customer['id'], customer.get('email'), customer.get('created'),
+                  event_created, json.dumps(customer)))
+
+def lookup(email):
+    """Customers with this email, newest first
+    (matching the order `stripe.Customer.list` returns them in)"""
+    rows = db.connect().execute(
+        'SELECT data FROM customers WHERE email = ? ORDER BY created DESC', (email,))
+    return [stripe.util.convert_to_stripe_object(json.loads(r['data']), stripe.api_key) for r in rows]
+
+def add(customers, event_created=None):
+    if event_created is None:
+        event_created = int(time.time())
+    with db.transaction() as conn:
+        for customer in customers:
+            _upsert(conn, customer, event_created)
+
+def apply_event(event):
+    """Apply a `customer.created`, `customer.updated` or `customer.deleted` event"""
+    if event['type'].startswith('customer.subscription.'):
+        # Indexed customers carry their subscriptions, so drop everyone
+        # sharing this customer's email and let the next lookup
+        # fetch them fresh from Stripe
+        sub = event['data']['object']
+        db.connect().execute('''DELETE FROM customers WHERE email =
+                                (SELECT email FROM customers WHERE id = ?)''', (sub['customer'],))
+        return True
+    if event['type'] not in ('customer.created', 'customer.updated', 'customer.deleted'):
+        return False
+    customer = event['data']['object']
+    with db.transaction() as conn:
+        if event['type'] == 'customer.deleted':
+            conn.execute('DELETE FROM customers WHERE id = ?', (customer['id'],))
+        else:
+            _upsert(conn, customer, event['created'])
+    return True
+
+def backfill():
+    """Index every customer in Stripe"""
+    started = int(time.time())
+    count, batch = 0, []
+    for customer in stripe.Customer.list(limit=100).auto_paging_iter():
+        batch.append(customer)
+        if len(batch) >= 100:
+            add(batch, started)
+            count += len(batch)
+            batch = []
+    add(batch, started)
+    return count + len(batch)
@@ -0,0 +1,84 @@
+"""Local SQLite storage shared by all worker processes.
+
+Everything that lives here is opt-in: set `KONBINI_DB_PATH` to enable it.
+Modules declare their tables with `schema()` at import time;
+tables are created the first time a connection is opened.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from flask import current_app
+
+_local = threading.local()
+_schemas = []
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def schema(sql):
+    _schemas.append(sql)
+    return sql
+
+schema(SCHEMA)
+
+
+def enabled():
+    return bool(current_app.config.get('KONBINI_DB_PATH'))
+
+
+def connect(path=None):
+    """Get this thread's connection to the database"""
+    path = path or current_app.config['KONBINI_DB_PATH']
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    if path not in conns:
+        # Autocommit mode; use `transaction()` to group statements
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        # WAL lets readers in other processes keep going while we write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conns[path] = [conn, 0]
+
+    # Create any tables declared since this connection was opened
+    entry = conns[path]
+    conn, applied = entry
+    if applied < len(_schemas):
+        for sql in _schemas[applied:]:
+            conn.executescript(sql)
+        entry[1] = len(_schemas)
+    return conn
+
+
+@contextmanager
+def transaction(conn=None):
+    """Run statements in a single write transaction.
+    `BEGIN IMMEDIATE` takes the write lock up front,
+    so concurrent read-modify-writes are serialized."""
+    conn = conn or connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def get_meta(key, default=None, conn=None):
+    conn = conn or connect()
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row is not None else default
+
+
+def set_meta(key, value, conn=None):
+    conn = conn or connect()
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
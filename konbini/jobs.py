@@ -0,0 +1,133 @@
+"""Durable background jobs, stored in the database.
+
+Jobs are enqueued with `enqueue(kind, payload)` and run by
+`flask konbini worker`, which calls the handler registered for
+their kind with `@handler(kind)`. Failed jobs are retried with
+exponential backoff; once they run out of attempts they're moved
+to the `dead_jobs` table (see `flask konbini requeue-dead-jobs`).
+"""
+import json
+import time
+import traceback
+from . import db, metrics
+from flask import current_app
+
+# Defaults for how many times a job is tried, how many seconds to wait
+# before the first retry (doubled for each one after that), and for how
+# many seconds a worker may hold a job before it's handed to another worker
+MAX_ATTEMPTS = 5
+BACKOFF = 30
+LEASE = 600
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_run_at ON jobs (run_at);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    created REAL NOT NULL,
+    failed REAL NOT NULL,
+    last_error TEXT
+);
+''')
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue(kind, payload, delay=0):
+    now = time.time()
+    cur = db.connect().execute('INSERT INTO jobs (kind, payload, run_at, created) VALUES (?, ?, ?, ?)',
+                               (kind, json.dumps(payload), now + delay, now))
+    return cur.lastrowid
+
+
+def _claim():
+    """Take the next job that's due, if any"""
+    now = time.time()
+    lease = current_app.config.get('KONBINI_JOB_LEASE', LEASE)
+    with db.transaction() as conn:
+        job = conn.execute('''SELECT * FROM jobs WHERE run_at <= ? AND locked_until <= ?
+                              ORDER BY run_at, id LIMIT 1''', (now, now)).fetchone()
+        if job is None:
+            return None
+        conn.execute('UPDATE jobs SET attempts = attempts + 1, locked_until = ? WHERE id = ?',
+                     (now + lease, job['id']))
+    job = dict(job)
+    job['attempts'] += 1
+    return job
+
+
+def _fail(job, error):
+    config = current_app.config
+    now = time.time()
+    with db.transaction() as conn:
+        if job['attempts'] >= config.get('KONBINI_JOB_MAX_ATTEMPTS', MAX_ATTEMPTS):
+            conn.execute('''INSERT INTO dead_jobs (id, kind, payload, attempts, created, failed, last_error)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (job['id'], job['kind'], job['payload'], job['attempts'], job['created'], now, error))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+        else:
+            delay = config.get('KONBINI_JOB_BACKOFF', BACKOFF) * 2**(job['attempts'] - 1)
+            conn.execute('UPDATE jobs SET run_at = ?, locked_until = 0, last_error = ? WHERE id = ?',
+                         (now + delay, error, job['id']))
+
+
+def run_once():
+    """Run the next job that's due.
+    Returns `False` if there was nothing to do"""
+    job = _claim()
+    if job is None:
+        return False
+
+    # Each job gets a fresh app context, so nothing
+    # (e.g. memoized products) carries over between jobs
+    app = current_app._get_current_object()
+    with app.app_context():
+        metrics.start('job:{}'.format(job['kind']))
+        try:
+            HANDLERS[job['kind']](json.loads(job['payload']))
+        except Exception:
+            error = traceback.format_exc()
+            app.logger.error('Job {} ({}) failed on attempt {}:\n{}'.format(
+                job['id'], job['kind'], job['attempts'], error))
+            _fail(job, error)
+        else:
+            db.connect().execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+    return True
+
+
+def work(interval=1, burst=False):
+    """Run jobs until stopped, polling every `interval` seconds when idle.
+    With `burst`, stop once there's nothing left to do"""
+    while True:
+        if not run_once():
+            if burst:
+                return
+            time.sleep(interval)
+
+
+def requeue_dead():
+    now = time.time()
+    with db.transaction() as conn:
+        cur = conn.execute('''INSERT INTO jobs (kind, payload, run_at, created, last_error)
+                              SELECT kind, payload, ?, created, last_error FROM dead_jobs''', (now,))
+        conn.execute('DELETE FROM dead_jobs')
+    return cur.rowcount
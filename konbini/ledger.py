@@ -0,0 +1,166 @@
+"""Ledger of Stripe webhook events, keyed by event id.
+
+Stripe retries deliveries that fail or time out, and may deliver the same
+event more than once. Each event moves through these states:
+
+    received    handed off to the job queue, which will handle it
+    processing  being handled, by whoever holds the claim (until its lease runs out)
+    done        handled
+    failed      the last attempt failed, the next delivery tries again
+
+Deliveries of events that are `received` or `done` are answered straight
+away. A delivery that arrives while another one is `processing` the same
+event waits up to `KONBINI_LEDGER_WAIT` seconds (default 5) for it to finish.
+
+Events are kept in the database if `KONBINI_DB_PATH` is set, otherwise
+in memory (which only covers deliveries to the same process).
+"""
+import time
+import uuid
+import traceback
+import threading
+from . import db
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app
+
+# Defaults for how many seconds a delivery waits for another one handling the
+# same event, and for how many seconds a claim holds before someone else can take over
+WAIT = 5
+LEASE = 120
+
+# How many events to remember when there's no database
+MEMORY_EVENTS = 10000
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    type TEXT,
+    state TEXT NOT NULL,
+    owner TEXT,
+    locked_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    received REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS events_updated ON events (updated);
+''')
+
+_events = OrderedDict()
+_changed = threading.Condition()
+
+
+def _try_claim(event_id, event_type, token, lease):
+    """Take the event if it's free. Returns the token if we got it,
+    otherwise the event's state"""
+    now = time.time()
+    if db.enabled():
+        with db.transaction() as conn:
+            row = conn.execute('SELECT state, locked_until FROM events WHERE id = ?', (event_id,)).fetchone()
+            if row is None:
+                conn.execute('''INSERT INTO events (id, type, state, owner, locked_until, attempts, received, updated)
+                                VALUES (?, ?, 'processing', ?, ?, 1, ?, ?)''',
+                             (event_id, event_type, token, now + lease, now, now))
+                return token
+            if row['state'] in ('done', 'received') or (row['state'] == 'processing' and row['locked_until'] > now):
+                return row['state']
+            conn.execute('''UPDATE events SET state = 'processing', owner = ?, locked_until = ?,
+                            attempts = attempts + 1, updated = ? WHERE id = ?''',
+                         (token, now + lease, now, event_id))
+            return token
+
+    with _changed:
+        entry = _events.get(event_id)
+        if entry is not None and (entry['state'] in ('done', 'received') or
+                                  (entry['state'] == 'processing' and entry['locked_until'] > now)):
+            return entry['state']
+        _events[event_id] = {'state': 'processing', 'owner': token, 'locked_until': now + lease}
+        _events.move_to_end(event_id)
+        while len(_events) > MEMORY_EVENTS:
+            _events.popitem(last=False)
+        return token
+
+
+def claim(event):
+    """Claim a webhook event for handling. Returns a token for `handling()`
+    if this delivery should handle it, `'done'` if it's already been
+    handled (or queued to be), or `'busy'` if another delivery is still
+    handling it after waiting"""
+    config = current_app.config
+    lease = config.get('KONBINI_LEDGER_LEASE', LEASE)
+    deadline = time.time() + config.get('KONBINI_LEDGER_WAIT', WAIT)
+    token = uuid.uuid4().hex
+    while True:
+        result = _try_claim(event['id'], event.get('type'), token, lease)
+        if result == token:
+            return token
+        if result != 'processing':
+            return 'done'
+        if time.time() >= deadline:
+            return 'busy'
+        with _changed:
+            _changed.wait(0.1)
+
+
+def _set(event_id, state, owner=None, error=None, lease=0):
+    """Set the event's state. If `owner` is given,
+    only if they still hold the claim"""
+    now = time.time()
+    if db.enabled():
+        query = '''INSERT INTO events (id, state, owner, locked_until, attempts, received, updated, error)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET state = excluded.state, owner = excluded.owner,
+                       locked_until = excluded.locked_until, attempts = attempts + excluded.attempts,
+                       updated = excluded.updated, error = excluded.error'''
+        params = [event_id, state, owner if state == 'processing' else None, now + lease,
+                  int(state == 'processing'), now, now, error]
+        if owner is not None and state != 'processing':
+            query += ' WHERE events.owner = ?'
+            params.append(owner)
+        db.connect().execute(query, params)
+        return
+
+    with _changed:
+        entry = _events.get(event_id)
+        if entry is None or owner is None or state == 'processing' or entry['owner'] == owner:
+            _events[event_id] = {'state': state, 'owner': owner if state == 'processing' else None,
+                                 'locked_until': now + lease}
+        _changed.notify_all()
+
+
+def queued(event_id):
+    """The event has been put on the job queue,
+    which takes over from whoever claimed it"""
+    _set(event_id, 'received')
+
+
+@contextmanager
+def handling(event_id, token=None):
+    """Mark the event as done once the block finishes, or as failed if it raises.
+    Without a `token` from `claim()`, the event is taken over
+    (e.g. by the job worker it was queued for)"""
+    if token is None:
+        token = uuid.uuid4().hex
+        _set(event_id, 'processing', owner=token,
+             lease=current_app.config.get('KONBINI_LEDGER_LEASE', LEASE))
+    try:
+        yield
+    except Exception:
+        _set(event_id, 'failed', owner=token, error=traceback.format_exc())
+        raise
+    _set(event_id, 'done', owner=token)
+
+
+def state(event_id):
+    if db.enabled():
+        row = db.connect().execute('SELECT state FROM events WHERE id = ?', (event_id,)).fetchone()
+        return row['state'] if row is not None else None
+    entry = _events.get(event_id)
+    return entry['state'] if entry is not None else None
+
+
+def prune(days):
+    cur = db.connect().execute("DELETE FROM events WHERE state = 'done' AND updated < ?",
+                               (time.time() - days*24*60*60,))
+    return cur.rowcount
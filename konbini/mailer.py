@@ -0,0 +1,182 @@
+"""Asynchronous email dispatch.
+
+Messages are put on a bounded queue and sent by a small pool of background
+threads. Each thread takes up to `KONBINI_MAIL_BATCH` queued messages
+at a time and sends them over a single SMTP connection.
+
+If the mail server can't be reached, the messages are kept and the
+connection is retried with backoff. A message is only given up on
+once sending it has failed `KONBINI_MAIL_ATTEMPTS` times.
+"""
+import time
+import queue
+import atexit
+import smtplib
+import threading
+from . import metrics
+from flask import current_app
+from flask_mail import Connection
+
+# Defaults for the most messages waiting to be sent,
+# how many threads send them, and how many are sent per connection
+QUEUE_SIZE = 1000
+WORKERS = 2
+BATCH = 20
+
+# How many seconds to wait for queued messages to go out at exit
+FLUSH_TIMEOUT = 10
+
+# Defaults for how many seconds to wait on the mail server, how many times
+# to try sending a message, and how long to wait before retrying
+# (doubling up to the max while the server keeps failing)
+SMTP_TIMEOUT = 30
+ATTEMPTS = 3
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Default for how many seconds `enqueue()` waits for room in a full queue
+ENQUEUE_TIMEOUT = 30
+
+
+class _Connection(Connection):
+    """Flask-Mail's connection, with a timeout on the mail server"""
+    def __init__(self, mail, timeout):
+        super().__init__(mail)
+        self.timeout = timeout
+
+    def configure_host(self):
+        smtp = smtplib.SMTP_SSL if self.mail.use_ssl else smtplib.SMTP
+        host = smtp(self.mail.server, self.mail.port, timeout=self.timeout)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+
+class Dispatcher:
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config.get('KONBINI_MAIL_QUEUE_SIZE', QUEUE_SIZE))
+        self.batch_size = app.config.get('KONBINI_MAIL_BATCH', BATCH)
+        self.timeout = app.config.get('KONBINI_MAIL_TIMEOUT', SMTP_TIMEOUT)
+        self.attempts = app.config.get('KONBINI_MAIL_ATTEMPTS', ATTEMPTS)
+        self.enqueue_timeout = app.config.get('KONBINI_MAIL_ENQUEUE_TIMEOUT', ENQUEUE_TIMEOUT)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.send_seconds = 0.
+        self.wait_seconds = 0.
+        self.max_send_seconds = 0.
+        for i in range(app.config.get('KONBINI_MAIL_WORKERS', WORKERS)):
+            threading.Thread(target=self._run, daemon=True, name='konbini-mail-{}'.format(i)).start()
+        atexit.register(self.flush, FLUSH_TIMEOUT)
+
+    def enqueue(self, message):
+        # Blocks if the queue is full, which slows down requests rather
+        # than dropping their emails. If there's still no room after
+        # `KONBINI_MAIL_ENQUEUE_TIMEOUT` seconds, raises `queue.Full`
+        self.queue.put((message, time.time()), timeout=self.enqueue_timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                metrics.start('mailer')
+                self._send(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _send(self, batch):
+        mail = self.app.extensions.get('mail')
+        # [message, queued at, failed attempts]
+        pending = [[message, queued_at, 0] for message, queued_at in batch]
+        delay = RETRY_DELAY
+        while pending:
+            sending = None
+            try:
+                with _Connection(mail, self.timeout) as conn:
+                    while pending:
+                        sending = pending[0]
+                        message, queued_at, _ = sending
+                        start = time.time()
+                        with metrics.timed('smtp', 'send'):
+                            conn.send(message)
+                        self._record(start - queued_at, time.time() - start)
+                        pending.pop(0)
+                delay = RETRY_DELAY
+            except Exception:
+                if sending is None:
+                    # Couldn't connect, so none of them were tried: keep them all
+                    self.app.logger.exception('Failed to connect to the mail server, retrying in {}s'.format(delay))
+                elif pending and pending[0] is sending:
+                    message = sending[0]
+                    sending[2] += 1
+                    if sending[2] >= self.attempts:
+                        pending.pop(0)
+                        with self._lock:
+                            self.failed += 1
+                        self.app.logger.exception('Giving up on email "{}" to {} after {} attempts'.format(
+                            message.subject, ', '.join(message.recipients), sending[2]))
+                        continue
+                    self.app.logger.exception('Failed to send email "{}" to {}, retrying in {}s'.format(
+                        message.subject, ', '.join(message.recipients), delay))
+                else:
+                    # Everything went out, closing the connection failed
+                    continue
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def _record(self, wait, send):
+        with self._lock:
+            self.sent += 1
+            self.wait_seconds += wait
+            self.send_seconds += send
+            self.max_send_seconds = max(self.max_send_seconds, send)
+
+    def flush(self, timeout=None):
+        """Wait for queued messages to be sent"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'avg_wait_seconds': self.wait_seconds/self.sent if self.sent else 0,
+                'avg_send_seconds': self.send_seconds/self.sent if self.sent else 0,
+                'max_send_seconds': self.max_send_seconds,
+            }
+
+
+_lock = threading.Lock()
+
+def get_dispatcher():
+    app = current_app._get_current_object()
+    with _lock:
+        if 'konbini_mailer' not in app.extensions:
+            app.extensions['konbini_mailer'] = Dispatcher(app)
+    return app.extensions['konbini_mailer']
+
+def enqueue(message):
+    get_dispatcher().enqueue(message)
+
+def stats():
+    dispatcher = current_app.extensions.get('konbini_mailer')
+    return dispatcher.stats() if dispatcher is not None else None
@@ -0,0 +1,209 @@
+"""Metrics for outbound API calls, exposed in Prometheus' text format at `/metrics`.
+
+Every call to Stripe, EasyPost, ShipBob, RPI, USPS and the mail server
+is counted and timed, labeled by `service`, `operation` (e.g. `GET /v1/prices/{id}`)
+and the `route` that made it (the view, e.g. `pay`, or `job:<kind>`
+for background jobs). The number of outbound calls each request made is
+kept too, and sent back in an `X-Outbound-Calls` header.
+
+Set `KONBINI_METRICS_TOKEN` to require `Authorization: Bearer <token>`
+to read `/metrics`.
+"""
+import re
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from flask import g, request, has_app_context, has_request_context
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALLS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Path segments that are ids, e.g. `prod_Hk2...` or `12345`
+ID_SEGMENT = re.compile(r'^(\d+|[a-z]+_(?=[A-Za-z0-9_]*[A-Z0-9])[A-Za-z0-9_]+)$')
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            for labels, value in self.values.items():
+                yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            for labels, counts in self.values.items():
+                labels = dict(zip(self.labels, labels))
+                for bound, count in zip(self.buckets, counts):
+                    yield self.name + '_bucket', dict(labels, le=str(bound)), count
+                yield self.name + '_bucket', dict(labels, le='+Inf'), counts[-1]
+                yield self.name + '_sum', labels, counts[-2]
+                yield self.name + '_count', labels, counts[-1]
+
+
+class Gauge:
+    """Reads its values from `fn` when the metrics are collected"""
+    type = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        for labels, value in self.fn():
+            yield self.name, labels, value
+
+
+outbound_calls = Counter('konbini_outbound_calls_total',
+    'Outbound API calls', ('service', 'operation', 'route', 'outcome'))
+outbound_seconds = Histogram('konbini_outbound_call_seconds',
+    'Outbound API call latency', ('service', 'operation', 'route'), LATENCY_BUCKETS)
+request_calls = Histogram('konbini_request_outbound_calls',
+    'Outbound API calls made while handling a request', ('route',), CALLS_BUCKETS)
+
+METRICS = [outbound_calls, outbound_seconds, request_calls]
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def start(route):
+    """Start tracking the outbound calls made on behalf of `route`
+    in the current app context"""
+    g.konbini_metrics = {'route': route, 'calls': 0}
+    return g.konbini_metrics
+
+def current():
+    """What's being tracked in the current app context, to be handed
+    to `adopt()` in threads that make calls on its behalf"""
+    if has_app_context():
+        return g.get('konbini_metrics')
+    return None
+
+def adopt(tracking):
+    if tracking is not None:
+        g.konbini_metrics = tracking
+
+def _tracking():
+    tracking = current()
+    if tracking is None and has_request_context():
+        tracking = start((request.endpoint or 'unknown').rsplit('.', 1)[-1])
+    return tracking
+
+
+_calls_lock = threading.Lock()
+
+def record(service, operation, seconds, ok=True):
+    tracking = _tracking()
+    route = tracking['route'] if tracking is not None else 'background'
+    outbound_calls.inc((service, operation, route, 'ok' if ok else 'error'))
+    outbound_seconds.observe((service, operation, route), seconds)
+    if tracking is not None:
+        with _calls_lock:
+            tracking['calls'] += 1
+
+@contextmanager
+def timed(service, operation):
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record(service, operation, time.time() - start, ok)
+
+
+def operation(method, url):
+    """Name an operation by its method and path, with ids taken out"""
+    path = urlparse(url).path
+    path = '/'.join('{id}' if ID_SEGMENT.match(s) else s for s in path.split('/'))
+    return '{} {}'.format(method.upper(), path or '/')
+
+
+def finish_request(response):
+    tracking = current()
+    if tracking is not None:
+        request_calls.observe((tracking['route'],), tracking['calls'])
+        response.headers['X-Outbound-Calls'] = str(tracking['calls'])
+    return response
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+def install():
+    """Time every call the Stripe library makes"""
+    global _installed
+    import stripe
+    with _install_lock:
+        if _installed:
+            return
+        request_with_retries = stripe.http_client.HTTPClient.request_with_retries
+
+        def timed_request(self, method, url, *args, **kwargs):
+            with timed('stripe', operation(method, url)):
+                return request_with_retries(self, method, url, *args, **kwargs)
+        stripe.http_client.HTTPClient.request_with_retries = timed_request
+        _installed = True
+
+def instrument_easypost(client):
+    """Time every call made with an EasyPost client"""
+    def on_response(**kwargs):
+        seconds = (kwargs['response_timestamp'] - kwargs['request_timestamp']).total_seconds()
+        # The method comes as an enum (`RequestMethod.POST`)
+        method = getattr(kwargs['method'], 'value', kwargs['method'])
+        record('easypost', operation(method, kwargs['path']),
+               seconds, ok=kwargs['http_status'] < 400)
+    client.subscribe_to_response_hook(on_response)
+    return client
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            if labels:
+                name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()) + '}'
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,175 @@
+"""On-disk mirror of the Stripe catalog (products, prices, SKUs and tax rates).
+
+The mirror is filled by `flask konbini sync-catalog` and kept current
+by webhook events sent to the `/sync` endpoint. Once it has been synced
+it is the source of truth for catalog reads, so request handlers never
+have to go to Stripe for them.
+"""
+import json
+import time
+import stripe
+from . import db
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS catalog (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    product TEXT,
+    active INTEGER NOT NULL,
+    created INTEGER,
+    event_created INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS catalog_kind ON catalog (kind, active, created);
+CREATE INDEX IF NOT EXISTS catalog_product ON catalog (product, kind, active);
+''')
+
+KINDS = {
+    'product': stripe.Product,
+    'price': stripe.Price,
+    'sku': stripe.SKU,
+    'tax_rate': stripe.TaxRate,
+}
+
+
+def generation():
+    """The mirror's current generation, or `None` if it hasn't been synced.
+    The generation is bumped on every write, so processes can
+    tell when anything they have cached from it is out of date."""
+    if not db.enabled():
+        return None
+    rows = db.connect().execute(
+        "SELECT key, value FROM meta WHERE key IN ('catalog_synced_at', 'catalog_generation')").fetchall()
+    meta = {r['key']: r['value'] for r in rows}
+    if 'catalog_synced_at' not in meta:
+        return None
+    return int(meta.get('catalog_generation', 0))
+
+def ready():
+    return generation() is not None
+
+def _bump(conn):
+    conn.execute('''INSERT INTO meta (key, value) VALUES ('catalog_generation', 1)
+                    ON CONFLICT(key) DO UPDATE SET value = value + 1''')
+
+
+def _product_id(obj):
+    product = obj.get('product')
+    if isinstance(product, dict):
+        product = product['id']
+    return product
+
+def _upsert(conn, obj, event_created):
+    # Store expanded default prices by id only; they are
+    # mirrored separately and re-expanded on read
+    obj = dict(obj)
+    if isinstance(obj.get('default_price'), dict):
+        obj['default_price'] = obj['default_price']['id']
+    conn.execute('''INSERT INTO catalog (id, kind, product, active, created, event_created, data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        product = excluded.product,
+                        active = excluded.active,
+                        created = excluded.created,
+                        event_created = excluded.event_created,
+                        data = excluded.data
+                    WHERE excluded.event_created >= catalog.event_created''',
+                 (obj['id'], obj['object'], _product_id(obj), bool(obj.get('active', True)),
+                  obj.get('created'), event_created, json.dumps(obj)))
+
+def sync():
+    """Do a full sync of the catalog from Stripe"""
+    started = int(time.time())
+    counts = {}
+    conn = db.connect()
+    for kind, cls in KINDS.items():
+        params = {'limit': 100}
+        if kind == 'product':
+            params['expand'] = ['data.default_price']
+        objs = list(cls.list(**params).auto_paging_iter())
+
+        # Replace everything of this kind, so that
+        # objects deleted in Stripe are dropped too
+        with db.transaction(conn):
+            conn.execute('DELETE FROM catalog WHERE kind = ?', (kind,))
+            for obj in objs:
+                _upsert(conn, obj, started)
+            _bump(conn)
+        counts[kind] = len(objs)
+
+    with db.transaction(conn):
+        db.set_meta('catalog_synced_at', started, conn=conn)
+        _bump(conn)
+    return counts
+
+def apply_event(event):
+    """Apply a `product.*`, `price.*`, `sku.*` or `tax_rate.*` webhook event"""
+    obj = event['data']['object']
+    if obj['object'] not in KINDS:
+        return False
+    conn = db.connect()
+    with db.transaction(conn):
+        if event['type'].endswith('.deleted'):
+            conn.execute('DELETE FROM catalog WHERE id = ?', (obj['id'],))
+        else:
+            _upsert(conn, obj, event['created'])
+        _bump(conn)
+    return True
+
+
+def _load(data):
+    return stripe.util.convert_to_stripe_object(json.loads(data), stripe.api_key)
+
+def _expand_default_prices(products):
+    """Products are listed with their default price expanded;
+    webhook payloads only carry the price id"""
+    ids = [p['default_price'] for p in products if isinstance(p.get('default_price'), str)]
+    if not ids:
+        return products
+    prices = {p.id: p for p in _select(
+        'SELECT data FROM catalog WHERE id IN ({})'.format(','.join('?'*len(ids))), ids)}
+    for p in products:
+        if isinstance(p.get('default_price'), str):
+            p['default_price'] = prices.get(p['default_price'], p['default_price'])
+    return products
+
+def _select(query, params=()):
+    return [_load(r['data']) for r in db.connect().execute(query, params)]
+
+def get(id):
+    objs = _select('SELECT data FROM catalog WHERE id = ?', (id,))
+    if not objs:
+        return None
+    obj = objs[0]
+    if obj['object'] == 'product':
+        _expand_default_prices([obj])
+    return obj
+
+def products():
+    return _expand_default_prices(_select(
+        "SELECT data FROM catalog WHERE kind = 'product' AND active = 1 ORDER BY created DESC"))
+
+def products_by_id(ids):
+    if not ids:
+        return {}
+    products = _expand_default_prices(_select(
+        "SELECT data FROM catalog WHERE kind = 'product' AND id IN ({})".format(','.join('?'*len(ids))), ids))
+    return {p.id: p for p in products}
+
+def prices(product_id):
+    return _select(
+        "SELECT data FROM catalog WHERE product = ? AND kind = 'price' AND active = 1 ORDER BY created DESC",
+        (product_id,))
+
+def skus(product_id):
+    return _select(
+        "SELECT data FROM catalog WHERE product = ? AND kind = 'sku' AND active = 1 ORDER BY created DESC",
+        (product_id,))
+
+def active(kind):
+    """All active prices or SKUs (`kind`), newest first"""
+    return _select(
+        "SELECT data FROM catalog WHERE kind = ? AND active = 1 ORDER BY created DESC", (kind,))
+
+def tax_rates():
+    return _select("SELECT data FROM catalog WHERE kind = 'tax_rate' ORDER BY created DESC")
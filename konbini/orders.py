@@ -0,0 +1,145 @@
+"""Fulfillment of completed checkouts: buying shipping labels
+and notifying the customer and `NEW_ORDER_RECIPIENTS`.
+
+If `KONBINI_DB_PATH` is set, this runs in background workers
+(`flask konbini worker`) instead of in the webhook request.
+"""
+import stripe
+from . import db, jobs, ledger, shipping
+from flask import current_app
+from .util import render_email, deliver_email, dispatch_email
+
+
+def notify(tos, subject, template, **kwargs):
+    """Send an email, through the job queue if there is one,
+    so that it's retried independently of the rest of the order"""
+    message = render_email(tos, subject, template, **kwargs)
+    if db.enabled():
+        jobs.enqueue('email', message)
+    else:
+        dispatch_email(message)
+
+
+@jobs.handler('email')
+def email_job(message):
+    deliver_email(message)
+
+
+def handle_checkout_completed(event):
+    """Process a `checkout.session.completed` event now,
+    or queue it up if there's a job queue"""
+    # The checkout's shipping quotes are used up now
+    scope = (event['data']['object'].get('metadata') or {}).get('quote_scope')
+    if scope:
+        shipping.retire_scope(scope, **current_app.config)
+
+    if db.enabled():
+        with db.transaction():
+            ledger.queued(event['id'])
+            jobs.enqueue('checkout.session.completed', event)
+    else:
+        checkout_completed(event)
+
+
+@jobs.handler('checkout.session.completed')
+def checkout_completed_job(event):
+    with ledger.handling(event['id']):
+        checkout_completed(event)
+
+
+def checkout_completed(event):
+    new_order_recipients = current_app.config['NEW_ORDER_RECIPIENTS']
+    session = event['data']['object']
+
+    # If subscription is set,
+    # assume that this is a checkout
+    # for a subscription only
+    if session['subscription'] is not None:
+        sub_id = session['subscription']
+        cus_id = session['customer']
+        line_items = [li for li in session['display_items'] if li['type'] == 'custom']
+        sub = stripe.Subscription.retrieve(sub_id)
+        meta = sub.metadata
+        if meta:
+            name = meta.pop('name')
+            addr = meta
+            shipping_info = {'name': name, 'address': addr}
+            stripe.Customer.modify(cus_id, name=name, shipping=shipping_info)
+        else:
+            name = ''
+            shipping_info = {}
+
+        default_shipper = current_app.config['KONBINI_DEFAULT_SHIPPER']
+        meta = session['metadata']
+        shipment_meta = {}
+        if meta.get(default_shipper+'_shipment_id') is not None:
+            # shipment_id = meta['shipment_id']
+            exists, tracking_url = shipping.shipment_exists(meta[default_shipper + '_shipment_id'], default_shipper)
+            if not exists:
+                shipment_meta = shipping.buy_shipment(name=name, shipper=default_shipper, **meta) # shipment_id already in meta
+            else:
+                shipment_meta = {'tracking_url': tracking_url}
+
+        notify(new_order_recipients,
+               'New subscription', 'new_subscription',
+               subscription=sub, line_items=line_items, shipping=shipping_info, label_url=shipment_meta.get('label_url'))
+
+        # Notify customer
+        customer = stripe.Customer.retrieve(cus_id)
+        customer_email = customer['email']
+        notify([customer_email], 'Thank you for your subscription', 'complete_subscription',
+               subscription=sub, line_items=line_items, tracking_url=shipment_meta.get('tracking_url'))
+
+    else:
+        # Get associated payment,
+        # check its state
+        pi = stripe.PaymentIntent.retrieve(session['payment_intent'])
+        if pi['status'] != 'succeeded' or pi['charges']['data'][0]['refunded']:
+            return
+
+        completed = pi['metadata'].get('completed')
+        if completed:
+            return
+
+        customer_id = session['customer']
+        customer = stripe.Customer.retrieve(customer_id)
+        customer_email = customer['email']
+
+        line_items = stripe.checkout.Session.list_line_items(session['id'], limit=100)['data']
+        items = [{
+            'amount': i['amount_total'],
+            'quantity': i['quantity'],
+            'description': i['description']
+        } for i in line_items]
+
+        # Purchase shipping label
+        meta = session['metadata']
+        shippers = meta['shippers'].split()
+        shipment_meta = {}
+        # shipment_id = meta['shipment_id']
+        for shipper in shippers:
+            exists = False
+            if meta.get(shipper+"_shipment_id") is not None:
+                exists, tracking_url = shipping.shipment_exists(meta[shipper+"_shipment_id"], shipper)
+                shipment_meta[shipper] = {'tracking_url': tracking_url}
+
+            if not exists:
+                shipment_meta[shipper] = shipping.buy_shipment(shipper=shipper, **meta) # shipment_id already in meta
+
+        easypost_meta = shipment_meta.get('easypost') or {}
+        label_url = easypost_meta.get('label_url')
+        tracking_url = easypost_meta.get('tracking_url')
+        # customerOrderId = shipment_meta['rpi'].get('customerOrderId') if shipment_meta.get('rpi') else None
+
+        # Mark as completed
+        stripe.PaymentIntent.modify(session['payment_intent'], metadata={'completed': True})
+
+        # Notify fulfillment person
+        notify(new_order_recipients,
+               'New order placed', 'new_order',
+               order=pi, items=items, label_url=label_url, label_urls=easypost_meta.get('label_urls'),
+               rpi_status=shipment_meta.get('rpi'))
+
+        # Notify customer
+        notify([customer_email], 'Thank you for your order', 'complete_order',
+               order=pi, items=items, tracking_url=tracking_url, tracking_urls=easypost_meta.get('tracking_urls'))
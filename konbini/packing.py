@@ -0,0 +1,132 @@
+"""Packing cart items into boxes for shipping.
+
+Boxes are configured with `KONBINI_BOXES`, a list of dicts with `length`,
+`width` and `height` (inches) and optionally a `name`, the `weight` of the
+empty box and the `max_weight` it can carry (ounces), e.g.:
+
+    KONBINI_BOXES = [
+        {'name': 'mailer', 'length': 12, 'width': 9, 'height': 2, 'weight': 2},
+        {'name': 'small', 'length': 12, 'width': 12, 'height': 6, 'weight': 6, 'max_weight': 640},
+    ]
+
+Items are laid flat (smallest side up) and packed in layers of shelves,
+largest first. Everything goes in the smallest box it all fits in; if no
+box holds everything, the box that takes the most is filled and the rest is
+packed into further parcels. Items too big for any box ship on their own.
+Results are memoized per cart and set of boxes.
+"""
+import numpy as np
+from functools import lru_cache
+
+# How many distinct carts to remember packings for
+CACHE_SIZE = 1024
+
+
+def _shelf_pack(box, sizes, weights, candidates, capacity):
+    """Pack as many of the `candidates` (indices into `sizes`, in order)
+    as will go into a box of the given (sorted) dimensions.
+    Returns the indices of the items that were packed"""
+    L, W, H = box
+    x = y = z = 0.         # position along the shelf, depth of closed shelves, height of closed layers
+    shelf = layer = 0.     # depth of the current shelf, height of the current layer
+    load = 0.
+    packed = []
+    for i in candidates:
+        l, w, h = sizes[i]
+        if load + weights[i] > capacity or l > L or w > W or h > H:
+            continue
+
+        # Try next to the last item on the current shelf,
+        # then on a new shelf, then on a new layer
+        for x0, y0, z0, shelf0, layer0 in ((x, y, z, shelf, layer),
+                                           (0., y + shelf, z, 0., layer),
+                                           (0., 0., z + layer, 0., 0.)):
+            if z0 + max(layer0, h) > H:
+                continue
+            if x0 + l <= L and y0 + max(shelf0, w) <= W:
+                x, y, z, shelf, layer = x0 + l, y0, z0, max(shelf0, w), max(layer0, h)
+                break
+            if x0 + w <= L and y0 + max(shelf0, l) <= W:
+                x, y, z, shelf, layer = x0 + w, y0, z0, max(shelf0, l), max(layer0, h)
+                break
+        else:
+            continue
+        load += weights[i]
+        packed.append(i)
+    return packed
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _pack(items, boxes):
+    dims = np.array([d for d, _ in items], dtype=float).reshape(-1, 4)
+    dims = np.repeat(dims, [q for _, q in items], axis=0)
+    sizes = -np.sort(-dims[:, :3], axis=1)      # longest side first
+    weights = dims[:, 3]
+    volumes = sizes.prod(axis=1)
+
+    box_dims = np.array([b[1:] for b in boxes], dtype=float).reshape(-1, 5)
+    box_sizes = -np.sort(-box_dims[:, :3], axis=1)
+    box_volumes = box_sizes.prod(axis=1)
+    capacities = box_dims[:, 4] - box_dims[:, 3]
+    box_order = np.argsort(box_volumes, kind='stable')
+
+    # Which items fit in which boxes on their own, by (sorted) dimensions and weight
+    fits = (sizes[:, None, :] <= box_sizes[None, :, :]).all(axis=2) & (weights[:, None] <= capacities[None, :])
+
+    # Tallest items first, so layers come out even, then the largest footprint
+    order = np.lexsort((-sizes[:, 1], -sizes[:, 0], -sizes[:, 2]))
+
+    parcels = []
+    oversize = ~fits.any(axis=1)
+    for i in order[oversize[order]]:
+        parcels.append((None, tuple(dims[i, :3]), weights[i], 1))
+
+    sizes_, weights_ = sizes.tolist(), weights.tolist()
+    box_sizes_ = box_sizes.tolist()
+    remaining = order[~oversize[order]]
+    while len(remaining):
+        total_volume, total_weight = volumes[remaining].sum(), weights[remaining].sum()
+        candidates = fits[remaining].all(axis=0) & (box_volumes >= total_volume) & (capacities >= total_weight)
+
+        # The smallest box everything goes into
+        best = None
+        for b in box_order[candidates[box_order]]:
+            packed = _shelf_pack(box_sizes_[b], sizes_, weights_, remaining.tolist(), capacities[b])
+            if len(packed) == len(remaining):
+                best = b, packed
+                break
+
+        # Otherwise, the box that takes the most (by volume), and on to the next parcel
+        if best is None:
+            best_taken = None
+            for b in box_order[fits[remaining].any(axis=0)[box_order]]:
+                packed = _shelf_pack(box_sizes_[b], sizes_, weights_, remaining.tolist(), capacities[b])
+                taken = volumes[packed].sum(), len(packed)
+                if best_taken is None or taken > best_taken:
+                    best, best_taken = (b, packed), taken
+
+        b, packed = best
+        parcels.append((boxes[b][0], tuple(box_dims[b, :3]), weights[packed].sum() + box_dims[b, 3], len(packed)))
+        remaining = remaining[~np.isin(remaining, packed)]
+    return tuple(parcels)
+
+
+def pack(items, boxes):
+    """Pack `items`, a list of `((length, width, height, weight), quantity)`,
+    into `boxes` (as configured in `KONBINI_BOXES`).
+    Returns a list of parcels, each with the `box` used (`None` for an item
+    shipped on its own), its `length`, `width`, `height` and `weight`,
+    and how many `items` are in it"""
+    items = tuple(sorted((tuple(float(x) for x in dims), int(q)) for dims, q in items if q > 0))
+    boxes = tuple((b.get('name'), float(b['length']), float(b['width']), float(b['height']),
+                   float(b.get('weight', 0)), float(b.get('max_weight', float('inf')))) for b in boxes)
+    if not items:
+        return []
+    return [{
+        'box': box,
+        'length': float(length),
+        'width': float(width),
+        'height': float(height),
+        'weight': float(weight),
+        'items': count,
+    } for box, (length, width, height), weight, count in _pack(items, boxes)]
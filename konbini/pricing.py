@@ -0,0 +1,141 @@
+"""Active prices and SKUs, indexed by product.
+
+Every active price and SKU is loaded in one go (from the catalog mirror
+if it has been synced, otherwise by listing them from Stripe) and the index
+is rebuilt after `price.*`, `sku.*` or `product.*` events come in on the
+`/sync` webhook. Without the mirror it's also rebuilt every
+`KONBINI_CATALOG_TTL` seconds, so changes aren't missed if webhooks are.
+Only the first build happens inline; after that the old index is served
+while a background thread rebuilds it.
+"""
+import time
+import stripe
+import threading
+from . import mirror
+from flask import current_app
+
+# Default for how many seconds the index is kept without the mirror
+CATALOG_TTL = 60
+
+# (index, objects, mirror generation, loaded at, version) of the last build
+_state = None
+# Bumped by `invalidate()`, so builds from before it count as stale
+_version = 0
+_refreshing = False
+_lock = threading.Lock()
+
+EMPTY = {'prices': [], 'skus': [], 'in_stock': False}
+
+
+def is_in_stock(sku):
+    return sku.metadata.get('sold_out') != 'true'
+
+
+def _load(generation):
+    if generation is not None:
+        prices = mirror.active('price')
+        skus = mirror.active('sku')
+    else:
+        prices = stripe.Price.list(limit=100, active=True).auto_paging_iter()
+        skus = stripe.SKU.list(limit=100, active=True).auto_paging_iter()
+
+    # Both are listed newest first, which is the order they're kept in
+    index, objects = {}, {}
+    for price in prices:
+        index.setdefault(price['product'], {'prices': [], 'skus': []})['prices'].append(price)
+        objects[price['id']] = price
+    for sku in skus:
+        sku['in_stock'] = is_in_stock(sku)
+        index.setdefault(sku['product'], {'prices': [], 'skus': []})['skus'].append(sku)
+        objects[sku['id']] = sku
+    for entry in index.values():
+        entry['in_stock'] = any(s['in_stock'] for s in entry['skus']) if entry['skus'] else bool(entry['prices'])
+    return index, objects
+
+
+def _build(generation):
+    version = _version
+    index, objects = _load(generation)
+    return index, objects, generation, time.time(), version
+
+
+def _is_stale(state, generation, ttl):
+    _, _, built_generation, loaded_at, version = state
+    if version != _version or generation != built_generation:
+        return True
+    return generation is None and time.time() - loaded_at >= ttl
+
+
+def _refresh(generation):
+    """Rebuild the index in the background, unless that's already happening"""
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    app = current_app._get_current_object()
+    def refresh():
+        global _state, _refreshing
+        try:
+            with app.app_context():
+                _state = _build(generation)
+        except Exception:
+            # Keep serving the old index, we'll try again on the next request
+            app.logger.exception('Failed to rebuild the price index')
+        finally:
+            with _lock:
+                _refreshing = False
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _get_index():
+    """The index and the objects in it, by id"""
+    global _state
+    ttl = current_app.config.get('KONBINI_CATALOG_TTL', CATALOG_TTL)
+    generation = mirror.generation()
+
+    state = _state
+    if state is None:
+        with _lock:
+            # Another thread may have built it while we waited
+            if _state is None:
+                _state = _build(generation)
+            state = _state
+    elif _is_stale(state, generation, ttl):
+        _refresh(generation)
+    return state[0], state[1]
+
+
+def get(product_id):
+    """The product's active prices and SKUs, and whether any of it is in stock"""
+    index, _ = _get_index()
+    return index.get(product_id, EMPTY)
+
+def prices(product_id):
+    return get(product_id)['prices']
+
+def skus(product_id):
+    return get(product_id)['skus']
+
+def find(id):
+    """An active price or SKU by its id, if it's in the index"""
+    _, objects = _get_index()
+    return objects.get(id)
+
+def amount(product_id):
+    """What the product sells for, in cents: the price of
+    its first active SKU if it has any, otherwise its first active price"""
+    entry = get(product_id)
+    if entry['skus']:
+        return entry['skus'][0]['price']
+    if entry['prices']:
+        return entry['prices'][0]['unit_amount']
+    return None
+
+
+def invalidate():
+    """Have the index rebuilt (in the background) on the next request"""
+    global _version
+    with _lock:
+        _version += 1
@@ -0,0 +1,62 @@
+"""Recording of webhook deliveries, so they can be replayed
+against a local instance later (see `bench/replay.py`).
+
+If `KONBINI_WEBHOOK_RECORD_DIR` is set, every delivery whose signature checks
+out is saved there as a JSON file, with the webhook it came in on and when.
+Unless `KONBINI_WEBHOOK_RECORD_SCRUB` is set to `False`, emails, names,
+phone numbers and street addresses are scrubbed from them first.
+"""
+import os
+import json
+import time
+import hashlib
+from flask import request, current_app
+
+# Keys whose values are scrubbed, wherever they are in an event
+SCRUBBED_KEYS = {'email', 'customer_email', 'receipt_email', 'name', 'phone',
+                 'line1', 'line2', 'address_line1', 'address_line2'}
+
+
+def _placeholder(key, value):
+    """The same value always gets the same placeholder,
+    so e.g. repeat customers still look like repeat customers"""
+    digest = hashlib.sha1(value.encode('utf8')).hexdigest()[:10]
+    if 'email' in key:
+        return '{}@example.com'.format(digest)
+    return 'scrubbed-{}'.format(digest)
+
+
+def scrub(obj):
+    """Copy of an event with personal details replaced by placeholders"""
+    if isinstance(obj, dict):
+        return {k: _placeholder(k, v) if k in SCRUBBED_KEYS and isinstance(v, str) and v else scrub(v)
+                for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [scrub(v) for v in obj]
+    return obj
+
+
+def record(payload):
+    """Save a webhook delivery's payload, if recording is on.
+    Failing to save it doesn't fail the delivery"""
+    config = current_app.config
+    path = config.get('KONBINI_WEBHOOK_RECORD_DIR')
+    if not path:
+        return
+    try:
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf8')
+        event = json.loads(payload)
+        if config.get('KONBINI_WEBHOOK_RECORD_SCRUB', True):
+            payload = json.dumps(scrub(event))
+        received = time.time()
+        os.makedirs(path, exist_ok=True)
+        fname = os.path.join(path, '{:.6f}-{}.json'.format(received, event.get('id')))
+        with open(fname, 'w') as f:
+            json.dump({
+                'hook': request.endpoint.rsplit('.', 1)[-1],
+                'received': received,
+                'payload': payload,
+            }, f)
+    except Exception:
+        current_app.logger.exception('Failed to record webhook delivery')
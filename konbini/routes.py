@@ -1,26 +1,25 @@
 import math
 import stripe
-from . import core, shipping
+from . import core, carts, taxes, ledger, mailer, metrics, orders, shipping, recording
 from .util import send_email
 from .auth import auth_required
+from .shipping import pool
+from .address import normalize_address
 from .forms import EmailForm, ShippingForm
-from pyusps import address_information
 from urllib.parse import urlparse, urljoin
-from flask import Blueprint, render_template, redirect, request, session, abort, url_for, flash, current_app, jsonify
-
-USPS_ADDRESS_KEYS = {
-    'address': 'line1',
-    'address_extended': 'line2',
-    'state': 'state',
-    'city': 'city',
-    'zip5': 'postal_code'
-}
+from flask import Blueprint, Response, render_template, redirect, request, abort, url_for, flash, current_app, jsonify
 
 bp = Blueprint('shop', __name__, template_folder='templates')
 
+bp.after_request(metrics.finish_request)
+
+metrics.register(metrics.Gauge('konbini_catalog_cache', 'Catalog cache lookups and entries',
+    lambda: [({'stat': k}, v) for k, v in core.catalog_stats().items()]))
+metrics.register(metrics.Gauge('konbini_mail', 'Background mail dispatcher',
+    lambda: [({'stat': k}, v) for k, v in (mailer.stats() or {}).items()]))
+metrics.register(metrics.Gauge('konbini_http_pool', 'Pooled HTTP requests and connections per host',
+    lambda: [({'host': host, 'stat': k}, v) for host, stats in pool.stats().items() for k, v in stats.items()]))
 
-def is_in_stock(sku):
-    return sku.metadata.get('sold_out') != 'true'
 
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
@@ -28,32 +27,30 @@ def is_safe_url(target):
     return test_url.scheme in ('http', 'https') and \
            ref_url.netloc == test_url.netloc
 
-def normalize_address(address):
-    """Normalize a domestic (US) address"""
-    if address['country'] != 'US':
-        return address, False
+def handle_event(event, handler):
+    """Handle a webhook event once, however many times Stripe delivers it"""
+    claimed = ledger.claim(event)
+    if claimed == 'busy':
+        return '', 409
+    if claimed != 'done':
+        with ledger.handling(event['id'], claimed):
+            handler(event)
+    return '', 200
+
+@bp.before_request
+def track_outbound_calls():
+    metrics.start(request.endpoint.rsplit('.', 1)[-1])
 
-    addr = {
-        'zip_code': address['postal_code'],
-        'state': address['state'],
-        'city': address['city'],
-        'address': address['line1']
-    }
-    line2 = address.get('line2')
-    if line2:
-        addr['address_extended'] = line2
-    try:
-        usps_addr = address_information.verify(current_app.config['USPS_USER_ID'], addr)
-        norm_addr = {}
-        changed = False
-        for k_frm, k_to in USPS_ADDRESS_KEYS.items():
-            norm_addr[k_to] = usps_addr.get(k_frm)
-            if (norm_addr[k_to] or '').lower() != (address[k_to] or '').lower():
-                changed = True
-        norm_addr['country'] = 'US'
-        return norm_addr, changed
-    except ValueError:
-        return None, True
+@bp.route('/metrics')
+def metrics_endpoint():
+    token = current_app.config.get('KONBINI_METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer {}'.format(token):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.context_processor
+def cart_context():
+    return {'cart_size': carts.get_cart().size}
 
 @bp.route('/')
 def index():
@@ -67,22 +64,20 @@ def index():
 def product(id):
     id = 'prod_{}'.format(id)
     try:
-        product = stripe.Product.retrieve(id, expand=['default_price'])
+        product = core.get_product(id)
     except stripe.error.InvalidRequestError as err:
         current_app.logger.debug(str(err))
         abort(404)
     if product is None or not product.active: abort(404)
     if product.type == 'good':
-        skus = stripe.SKU.list(limit=100, product=id, active=True)['data']
+        skus = core.get_skus(id)
         images = product.images + [s.image for s in skus if s.image and s.image not in product.images]
-        for sku in skus:
-            sku['in_stock'] = is_in_stock(sku)
         if request.args.get('format') == 'json':
             return jsonify(product=product, skus=skus, images=images)
         else:
             return render_template('shop/product.html', product=product, skus=skus, images=images)
     else:
-        prices = stripe.Price.list(limit=100, product=id, active=True)['data']
+        prices = core.get_prices(id)
         if request.args.get('format') == 'json':
             return jsonify(product=product, prices=prices, images=product.images)
         else:
@@ -91,75 +86,97 @@ def product(id):
 
 @bp.route('/cart', methods=['GET', 'POST'])
 def cart():
+    cart = carts.get_cart()
     if request.method == 'GET':
-        subtotal = sum((int(session['meta'][id]['price']) * q for id, q in session.get('cart', {}).items() if q), 0)
-        return render_template('shop/cart.html', subtotal=subtotal)
+        return render_template('shop/cart.html', cart=cart, subtotal=cart.subtotal)
 
     name = request.form['name']
     sku_id = request.form['sku']
-    product_id = request.form['product']
     quantity = request.form.get('quantity')
     if quantity and quantity is not None:
         quantity = int(quantity)
 
-    if 'cart' not in session:
-        session['cart'] = {}
-
     # If no quantity specified, add one
     if quantity is None:
         added = True
-        session['cart'][sku_id] = session['cart'].get(sku_id, 0) + 1
+        quantity = cart.quantity(sku_id) + 1
     else:
         added = False
-        session['cart'][sku_id] = quantity
-
-    if 'meta' not in session:
-        session['meta'] = {}
 
     # Delete item from cart if quantity is 0
     if quantity == 0 or quantity == '':
-        del session['cart'][sku_id]
+        cart.remove(sku_id)
 
     # Otherwise, update product info
     else:
-        if sku_id.startswith('sku_'):
-            sku = stripe.SKU.retrieve(sku_id)
-            price = sku.price
-            interval = None
-            interval_count = None
-            exclude_tax = sku.metadata.get('exclude_tax') == 'true'
-        elif sku_id.startswith('price_'):
-            sku = stripe.Price.retrieve(sku_id)
-            exclude_tax = sku.metadata.get('exclude_tax') == 'true'
-            price = sku.unit_amount
-            if sku.recurring:
-                interval = sku.recurring.interval
-                interval_count = sku.recurring.interval_count
-            else:
-                interval = None
-                interval_count = None
-
-        session['meta'][sku_id] = {
-            'name': name,
-            'price': price,
-            'interval': interval,
-            'interval_count': interval_count,
-            'product_id': product_id,
-            'exclude_tax': exclude_tax,
-        }
+        try:
+            details = carts.line_details(sku_id)
+        except (ValueError, stripe.error.InvalidRequestError):
+            abort(400)
+        cart.set(sku_id, quantity, name=name, **details)
+    carts.save_cart(cart)
 
     if added:
         flash('Added "{}" to cart.'.format(name), category='cart')
     else:
         flash('Cart updated.')
 
-    if is_safe_url(request.referrer):
+    if request.referrer and is_safe_url(request.referrer):
         return redirect(request.referrer)
     return redirect(url_for('shop.index'))
 
+@bp.route('/cart/update', methods=['POST'])
+def update_cart():
+    """Change the quantities of several cart lines at once, given either as
+    JSON, `{"quantities": {"sku_...": 2, "price_...": 0}}`, or as form
+    fields named `quantity-<sku or price id>`. A quantity of 0 removes the line"""
+    cart = carts.get_cart()
+    if request.is_json:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+        quantities = body.get('quantities') or {}
+        if not isinstance(quantities, dict):
+            abort(400)
+    else:
+        quantities = {k[len('quantity-'):]: v for k, v in request.form.items() if k.startswith('quantity-')}
+
+    for sku_id, quantity in quantities.items():
+        try:
+            quantity = int(quantity or 0)
+        except (TypeError, ValueError):
+            abort(400)
+        if quantity < 0:
+            abort(400)
+
+        if not quantity:
+            cart.remove(sku_id)
+        elif cart.get(sku_id) is not None:
+            cart.set_quantity(sku_id, quantity)
+        else:
+            try:
+                details = carts.line_details(sku_id)
+            except (ValueError, stripe.error.InvalidRequestError):
+                abort(400)
+            try:
+                product = core.get_product(details['product_id'])
+            except stripe.error.InvalidRequestError:
+                abort(400)
+            if product is None or not product.get('active', True):
+                abort(400)
+            cart.set(sku_id, quantity, name=product.name, **details)
+    carts.save_cart(cart)
+
+    if request.is_json:
+        return jsonify(lines=[line._asdict() for line in cart.items()],
+                       subtotal=cart.subtotal, size=cart.size)
+    flash('Cart updated.')
+    return redirect(url_for('shop.cart'))
+
 @bp.route('/checkout', methods=['GET', 'POST'])
 def checkout():
-    if not session.get('cart'):
+    cart = carts.get_cart()
+    if not cart:
         return redirect(url_for('shop.index'))
 
     form = ShippingForm()
@@ -168,32 +185,37 @@ def checkout():
         form.address.country.validators = []
 
     if form.validate_on_submit():
-        session['email'] = form.data['email']
+        cart.checkout['email'] = form.data['email']
         address = {k: form.data['address'][k] for k in
                    ['line1', 'line2', 'city', 'state', 'postal_code', 'country']}
         address, changed = normalize_address(address)
         if address is None:
+            carts.save_cart(cart)
             return render_template('shop/shipping.html', form=form, invalid_address=True)
 
-        session['shipping'] = {
+        cart.checkout['shipping'] = {
             'name': form.data['name'],
             'address': address
         }
+        carts.save_cart(cart)
 
         return redirect(url_for('shop.pay', address_changed=True))
     return render_template('shop/shipping.html', form=form)
 
 @bp.route('/checkout/pay')
 def pay():
-    if not session.get('shipping'):
+    cart = carts.get_cart()
+    shipping_info = cart.checkout.get('shipping')
+    if not cart or not shipping_info:
         return redirect(url_for('shop.cart'))
 
     # Sort out print on demand products before sending them to calculate shipping rate
     items = []
     shipper_products = dict((el,[]) for el in current_app.config.get('KONBINI_SHIPPERS'))
     default_shipper = current_app.config.get('KONBINI_DEFAULT_SHIPPER')
-    for sku_id, q in session['cart'].items():
-        p = stripe.Product.retrieve(session['meta'][sku_id]['product_id'], expand=['default_price'])
+    products = core.get_products_by_id([line.product_id for line in cart.items()])
+    for line in cart.items():
+        p, q = products[line.product_id], line.quantity
         shipper = p.metadata.get('shipper')
         if shipper is not None:
             shipper = shipper.lower()
@@ -201,29 +223,36 @@ def pay():
 
         items.append({
             'currency': 'usd',
-            'name': session['meta'][sku_id]['name'],
-            'amount': session['meta'][sku_id]['price'],
+            'name': line.name,
+            'amount': line.price,
             'quantity': q,
-            'exclude_tax': session['meta'][sku_id]['exclude_tax'],
+            'exclude_tax': line.exclude_tax,
         })
 
     # calculate shipping rates for every shipper
-    order_meta, total_shipping_rate = {'shippers':[]}, 0
-    for shipper, products in shipper_products.items():
-        if products:
-            rate, shipper_meta = shipping.get_shipping_rate(products, session['shipping'], shipper, **current_app.config)
-            order_meta.update(shipper_meta)
-            order_meta['shippers'].append(shipper)
-            total_shipping_rate += rate
+    # (quotes are scoped to the cart, so they aren't reused across orders,
+    # and the scope is retired when the checkout completes)
+    order_meta, total_shipping_rate = {'shippers':[], 'quote_scope': cart.id}, 0
+    try:
+        quotes = shipping.get_shipping_rates(shipper_products, shipping_info,
+                                             scope=cart.id, **current_app.config)
+    except shipping.QuoteTimeout as err:
+        current_app.logger.warning(str(err))
+        flash('We couldn\'t get a shipping quote right now. Please try again in a moment.', category='error')
+        return redirect(url_for('shop.cart'))
+    for shipper, rate, shipper_meta in quotes:
+        order_meta.update(shipper_meta)
+        order_meta['shippers'].append(shipper)
+        total_shipping_rate += rate
     order_meta['shippers'] = " ".join(order_meta['shippers'])
 
     # if rpi returns an error then show a sorry page
     if order_meta.get('rpi_error'):
         return render_template('shop/sorry.html', products=shipper_products['rpi'])
 
-    for k, v in session['shipping']['address'].items():
+    for k, v in shipping_info['address'].items():
         order_meta['address_{}'.format(k)] = v
-    order_meta['name'] = session['shipping']['name']
+    order_meta['name'] = shipping_info['name']
 
     items.append({
         'currency': 'usd',
@@ -240,15 +269,14 @@ def pay():
     for i in items:
         del i['exclude_tax']
 
-    tax_rates = stripe.TaxRate.list(limit=10)
-    for tax in tax_rates:
-        if tax['jurisdiction'] == session['shipping']['address']['state']:
-            items.append({
-                'name': 'Tax',
-                'amount': math.ceil((tax.percentage/100) * tax_total),
-                'currency': 'usd',
-                'quantity': 1
-            })
+    tax_rate = taxes.get_rate(shipping_info['address']['state'])
+    if tax_rate is not None:
+        items.append({
+            'name': 'Tax',
+            'amount': math.ceil((tax_rate.percentage/100) * tax_total),
+            'currency': 'usd',
+            'quantity': 1
+        })
 
     kwargs = {
         'payment_method_types': ['card'],
@@ -258,25 +286,27 @@ def pay():
         'metadata': order_meta
     }
     # Try to find customer with existing email
-    customers = core.get_customers(session['email'])
+    email = cart.checkout['email']
+    customers = core.get_customers(email)
     if customers:
         kwargs['customer'] = customers[0].id
     else:
-        kwargs['customer_email'] = session['email']
+        kwargs['customer_email'] = email
 
     address_changed = request.args.get('address_changed')
-    session['stripe'] = stripe.checkout.Session.create(**kwargs)
+    cart.checkout['stripe_session_id'] = stripe.checkout.Session.create(**kwargs).id
+    carts.save_cart(cart)
 
     return render_template('shop/pay.html',
             total=total,
             items=items,
-            shipping=session['shipping'],
+            shipping=shipping_info,
+            stripe_session_id=cart.checkout['stripe_session_id'],
             address_changed=address_changed)
 
 @bp.route('/checkout/success')
 def checkout_success():
-    for k in ['cart', 'plan', 'stripe', 'shipping']:
-        if k in session: del session[k]
+    carts.clear_cart()
     return render_template('shop/thanks.html')
 
 @bp.route('/checkout/cancel')
@@ -290,175 +320,95 @@ def subscribe_invoice_hook():
     event = stripe.Webhook.construct_event(
         payload, sig_header, current_app.config['STRIPE_WEBHOOK_SECRETS']['invoice.created']
     )
+    recording.record(payload)
 
     if event['type'] == 'invoice.created':
-        invoice = event['data']['object']
-
-        # This event still gets called even if the invoice
-        # is no longer in draft form, ignore to avoid errors
-        # We have to manually retrieve the latest invoice object,
-        # because the one sent to the endpoint may not be up-to-date
-        invoice = stripe.Invoice.retrieve(invoice['id'])
-        if invoice['status'] != 'draft': return '', 200
-
-        cus = stripe.Customer.retrieve(invoice['customer'])
-        has_payment_method = cus['default_source'] is not None
-
-        # Only do the following if we can even charge
-        if has_payment_method:
-            sub = stripe.Subscription.retrieve(invoice['subscription'])
-            prod = stripe.Product.retrieve(sub['plan']['product'], expand=['default_price'])
-            if prod['metadata'].get('shipped') == 'true':
-                # Check that there is a valid address for the customer
-                shipping_info = cus['shipping'] or {}
-                sub_metadata = sub.get('metadata', {})
-                addr = shipping_info.get('address', sub_metadata)
-                name = shipping_info.get('name', sub_metadata.get('name', None))
-                has_customer_address = name is not None and addr and all(v != 'nan' for v in addr.values())
-                if has_customer_address:
-                    shipping_info = {
-                        'name': name,
-                        'address': addr
-                    }
-
-                    # Check for applicable tax rates
-                    if not prod['metadata'].get('exclude_tax') == 'true':
-                        tax_rates = stripe.TaxRate.list(limit=10)
-                        app_tax = None
-                        for tax in tax_rates:
-                            if tax['jurisdiction'] == shipping_info['address']['state']:
-                                app_tax = tax
-                                break
-                        if app_tax is not None:
-                            stripe.Invoice.modify(invoice['id'], default_tax_rates=[app_tax.id])
-
-                    if current_app.config.get('KONBINI_INVOICE_SUB_SHIPPING'):
-                        # Calculate shipping estimate
-                        prod_id = prod['metadata']['shipped_product_id']
-                        product = stripe.Product.retrieve(prod_id)
-                        rate, _ = shipping.get_shipping_rate([(product, 1)], shipping_info, current_app.config.get('KONBINI_DEFAULT_SHIPPER'), **current_app.config)
-
-                        # Add the item to this invoice
-                        stripe.InvoiceItem.create(
-                            customer=cus['id'],
-                            invoice=invoice['id'],
-                            amount=rate,
-                            currency='usd',
-                            description='Shipping',
-                        )
-
+        return handle_event(event, add_subscription_charges)
     return '', 200
 
+def add_subscription_charges(event):
+    """Add tax and shipping to a subscription's draft invoice"""
+    invoice = event['data']['object']
+
+    # This event still gets called even if the invoice
+    # is no longer in draft form, ignore to avoid errors
+    # We have to manually retrieve the latest invoice object,
+    # because the one sent to the endpoint may not be up-to-date
+    invoice = stripe.Invoice.retrieve(invoice['id'])
+    if invoice['status'] != 'draft': return
+
+    cus = stripe.Customer.retrieve(invoice['customer'])
+    has_payment_method = cus['default_source'] is not None
+
+    # Only do the following if we can even charge
+    if has_payment_method:
+        sub = stripe.Subscription.retrieve(invoice['subscription'])
+        prod = stripe.Product.retrieve(sub['plan']['product'], expand=['default_price'])
+        if prod['metadata'].get('shipped') == 'true':
+            # Check that there is a valid address for the customer
+            shipping_info = cus['shipping'] or {}
+            sub_metadata = sub.get('metadata', {})
+            addr = shipping_info.get('address', sub_metadata)
+            name = shipping_info.get('name', sub_metadata.get('name', None))
+            has_customer_address = name is not None and addr and all(v != 'nan' for v in addr.values())
+            if has_customer_address:
+                shipping_info = {
+                    'name': name,
+                    'address': addr
+                }
+
+                # Check for applicable tax rates
+                if not prod['metadata'].get('exclude_tax') == 'true':
+                    app_tax = taxes.get_rate(shipping_info['address']['state'])
+                    if app_tax is not None:
+                        stripe.Invoice.modify(invoice['id'], default_tax_rates=[app_tax.id])
+
+                if current_app.config.get('KONBINI_INVOICE_SUB_SHIPPING'):
+                    # Calculate shipping estimate
+                    prod_id = prod['metadata']['shipped_product_id']
+                    product = stripe.Product.retrieve(prod_id)
+                    rate, _ = shipping.get_shipping_rate([(product, 1)], shipping_info, current_app.config.get('KONBINI_DEFAULT_SHIPPER'), **current_app.config)
+
+                    # Add the item to this invoice
+                    stripe.InvoiceItem.create(
+                        customer=cus['id'],
+                        invoice=invoice['id'],
+                        amount=rate,
+                        currency='usd',
+                        description='Shipping',
+                    )
+
 @bp.route('/checkout/completed', methods=['POST'])
 def checkout_completed_hook():
-    new_order_recipients = current_app.config['NEW_ORDER_RECIPIENTS']
     payload = request.data
     sig_header = request.headers['Stripe-Signature']
     event = stripe.Webhook.construct_event(
         payload, sig_header, current_app.config['STRIPE_WEBHOOK_SECRETS']['checkout.session.completed']
     )
+    recording.record(payload)
 
     # Handle the checkout.session.completed event
     if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-
-        # If subscription is set,
-        # assume that this is a checkout
-        # for a subscription only
-        if session['subscription'] is not None:
-            sub_id = session['subscription']
-            cus_id = session['customer']
-            line_items = [li for li in session['display_items'] if li['type'] == 'custom']
-            sub = stripe.Subscription.retrieve(sub_id)
-            meta = sub.metadata
-            if meta:
-                name = meta.pop('name')
-                addr = meta
-                shipping_info = {'name': name, 'address': addr}
-                stripe.Customer.modify(cus_id, name=name, shipping=shipping_info)
-            else:
-                name = ''
-                shipping_info = {}
-
-            default_shipper = current_app.config['KONBINI_DEFAULT_SHIPPER']
-            meta = session['metadata']
-            shipment_meta = {}
-            if meta.get(default_shipper+'_shipment_id') is not None:
-                # shipment_id = meta['shipment_id']
-                exists, tracking_url = shipping.shipment_exists(meta[default_shipper + '_shipment_id'], default_shipper)
-                if not exists:
-                    shipment_meta = shipping.buy_shipment(name=name, shipper=default_shipper, **meta) # shipment_id already in meta
-                else:
-                    shipment_meta = {'tracking_url': tracking_url}
-
-            send_email(new_order_recipients,
-                       'New subscription', 'new_subscription',
-                       subscription=sub, line_items=line_items, shipping=shipping_info, label_url=shipment_meta.get('label_url'))
-
-            # Notify customer
-            customer = stripe.Customer.retrieve(cus_id)
-            customer_email = customer['email']
-            send_email([customer_email], 'Thank you for your subscription', 'complete_subscription',
-                       subscription=sub, line_items=line_items, tracking_url=shipment_meta.get('tracking_url'))
-            return '', 200
-
-        else:
-            # Get associated payment,
-            # check its state
-            pi = stripe.PaymentIntent.retrieve(session['payment_intent'])
-            if pi['status'] != 'succeeded' or pi['charges']['data'][0]['refunded']:
-                return '', 200
-
-            completed = pi['metadata'].get('completed')
-            if completed:
-                return '', 200
-
-            customer_id = session['customer']
-            customer = stripe.Customer.retrieve(customer_id)
-            customer_email = customer['email']
-
-            line_items = stripe.checkout.Session.list_line_items(session['id'], limit=100)['data']
-            items = [{
-                'amount': i['amount_total'],
-                'quantity': i['quantity'],
-                'description': i['description']
-            } for i in line_items]
-
-            # Purchase shipping label
-            meta = session['metadata']
-            shippers = meta['shippers'].split()
-            shipment_meta = {}
-            # shipment_id = meta['shipment_id']
-            for shipper in shippers:
-                exists = False
-                if meta.get(shipper+"_shipment_id") is not None:
-                    exists, tracking_url = shipping.shipment_exists(meta[shipper+"_shipment_id"], shipper)
-                    shipment_meta[shipper] = {'tracking_url': tracking_url}
-
-                if not exists:
-                    shipment_meta[shipper] = shipping.buy_shipment(shipper=shipper, **meta) # shipment_id already in meta
-
-            label_url = shipment_meta['easypost'].get('label_url') if shipment_meta.get('easypost') else None
-            tracking_url = shipment_meta['easypost'].get('tracking_url') if shipment_meta.get('easypost') else None
-            # customerOrderId = shipment_meta['rpi'].get('customerOrderId') if shipment_meta.get('rpi') else None
-
-            # Mark as completed
-            stripe.PaymentIntent.modify(session['payment_intent'], metadata={'completed': True})
-
-            # Notify fulfillment person
-            send_email(new_order_recipients,
-                       'New order placed', 'new_order',
-                       order=pi, items=items, label_url=label_url, rpi_status=shipment_meta.get('rpi'))
-
-            # Notify customer
-            send_email([customer_email], 'Thank you for your order', 'complete_order',
-                    order=pi, items=items, tracking_url=tracking_url)
+        return handle_event(event, orders.handle_checkout_completed)
 
     return '', 200
 
 
+@bp.route('/sync', methods=['POST'])
+def sync_hook():
+    """Keep local caches current with changes made in Stripe"""
+    payload = request.data
+    sig_header = request.headers['Stripe-Signature']
+    event = stripe.Webhook.construct_event(
+        payload, sig_header, current_app.config['STRIPE_WEBHOOK_SECRETS']['sync']
+    )
+    recording.record(payload)
+    return handle_event(event, core.sync)
+
+
 @bp.route('/subscribe', methods=['GET', 'POST'])
 def subscribe():
+    cart = carts.get_cart()
     if request.method == 'POST':
         name = request.form['name']
         price_id = request.form['sku']
@@ -470,43 +420,46 @@ def subscribe():
         product = stripe.Product.retrieve(price.product)
 
         shipped = product.metadata.get('shipped') == 'true'
-        session['plan'] = {
+        cart.checkout['plan'] = {
             'name': name,
             'amount': price.unit_amount,
             'prod_id': product.id,
             'price_id': price_id,
             'shipped': shipped
         }
+        carts.save_cart(cart)
 
-    if not session.get('plan'):
+    plan = cart.checkout.get('plan')
+    if not plan:
         return redirect(url_for('shop.index'))
 
-    if session['plan']:
+    if plan:
         # If the session requires shipping info,
         # ensure that the address has been set
-        if session['plan'].get('shipped') \
-            and not session['plan'].get('address'):
+        if plan.get('shipped') \
+            and not plan.get('address'):
             return redirect(url_for('shop.subscribe_address'))
 
         # Otherwise, just ensure that we have an email
-        elif not session.get('email'):
+        elif not cart.checkout.get('email'):
             return redirect(url_for('shop.subscribe_email'))
 
     line_items = []
     shipment_id = None
-    if session['plan'].get('shipped'):
-        addr = session['plan']['address']
+    if plan.get('shipped'):
+        addr = plan['address']
         addr = {
             'name': addr['name'],
             'address': addr
         }
 
         if current_app.config.get('KONBINI_INVOICE_SUB_SHIPPING'):
-            prod_id = session['plan']['prod_id']
+            prod_id = plan['prod_id']
             plan_prod = stripe.Product.retrieve(prod_id)
             prod_id = plan_prod['metadata']['shipped_product_id']
             product = stripe.Product.retrieve(prod_id)
-            rate, order_meta = shipping.get_shipping_rate([(product, 1)], addr, current_app.config.get('KONBINI_DEFAULT_SHIPPER'), **current_app.config)
+            rate, order_meta = shipping.get_shipping_rate([(product, 1)], addr, current_app.config.get('KONBINI_DEFAULT_SHIPPER'),
+                                                          scope=cart.id, **current_app.config)
             shipment_id = order_meta['shipment_id']
             line_items.append({
                 'name': 'Shipping',
@@ -516,29 +469,29 @@ def subscribe():
                 'quantity': 1
             })
 
-        tax_rates = stripe.TaxRate.list(limit=10)
-        for tax in tax_rates:
-            if tax['jurisdiction'] == addr['address']['state']:
-                line_items.append({
-                    'name': 'Tax',
-                    'description': 'Tax',
-                    'amount': math.ceil((tax.percentage/100) * session['plan']['amount']),
-                    'currency': 'usd',
-                    'quantity': 1
-                })
+        tax_rate = taxes.get_rate(addr['address']['state'])
+        if tax_rate is not None:
+            line_items.append({
+                'name': 'Tax',
+                'description': 'Tax',
+                'amount': math.ceil((tax_rate.percentage/100) * plan['amount']),
+                'currency': 'usd',
+                'quantity': 1
+            })
 
     kwargs = {
         'payment_method_types': ['card'],
         'line_items': line_items,
         'subscription_data' :{
             'items': [{
-                'plan':  session['plan']['price_id']
+                'plan':  plan['price_id']
             }],
-            'metadata': session['plan'].get('address')
+            'metadata': plan.get('address')
         },
         'metadata': {
             'shipment_id': shipment_id,
-            'address': session['plan'].get('address')
+            'address': plan.get('address'),
+            'quote_scope': cart.id
         },
         'allow_promotion_codes': True,
         'success_url': url_for('shop.checkout_success', _external=True),
@@ -546,25 +499,29 @@ def subscribe():
     }
 
     # Try to find customer with existing email
-    customers = core.get_customers(session['email'])
+    email = cart.checkout['email']
+    customers = core.get_customers(email)
     if customers:
         kwargs['customer'] = customers[0].id
     else:
-        kwargs['customer_email'] = session['email']
+        kwargs['customer_email'] = email
 
-    session['stripe'] = stripe.checkout.Session.create(**kwargs)
+    cart.checkout['stripe_session_id'] = stripe.checkout.Session.create(**kwargs).id
+    carts.save_cart(cart)
 
-    total = sum(i['amount'] for i in line_items) + session['plan']['amount']
+    total = sum(i['amount'] for i in line_items) + plan['amount']
     address_changed = request.args.get('address_changed')
     return render_template('shop/subscribe.html',
             total=total,
             address_changed=address_changed,
-            line_items=line_items, **session['plan'])
+            stripe_session_id=cart.checkout['stripe_session_id'],
+            line_items=line_items, **plan)
 
 
 @bp.route('/subscribe/address', methods=['GET', 'POST'])
 def subscribe_address():
-    if not session.get('plan'):
+    cart = carts.get_cart()
+    if not cart.checkout.get('plan'):
         return redirect(url_for('shop.index'))
 
     form = ShippingForm()
@@ -574,18 +531,17 @@ def subscribe_address():
         form.address.country.validators = []
 
     if form.validate_on_submit():
-        session['email'] = form.data['email']
+        cart.checkout['email'] = form.data['email']
         address = {k: form.data['address'][k] for k in
                    ['line1', 'line2', 'city', 'state', 'postal_code', 'country']}
         address, changed = normalize_address(address)
         if address is None:
+            carts.save_cart(cart)
             return render_template('shop/shipping.html', form=form, invalid_address=True)
         address['name'] = form.data['name']
 
-        # So the session update property persists
-        plan = session['plan']
-        plan['address'] = address
-        session['plan'] = plan
+        cart.checkout['plan']['address'] = address
+        carts.save_cart(cart)
 
         return redirect(url_for('shop.subscribe', address_changed=True))
     return render_template('shop/shipping.html', form=form)
@@ -593,12 +549,14 @@ def subscribe_address():
 
 @bp.route('/subscribe/email', methods=['GET', 'POST'])
 def subscribe_email():
-    if not session.get('plan'):
+    cart = carts.get_cart()
+    if not cart.checkout.get('plan'):
         return redirect(url_for('shop.index'))
 
     form = EmailForm()
     if form.validate_on_submit():
-        session['email'] = form.data['email']
+        cart.checkout['email'] = form.data['email']
+        carts.save_cart(cart)
         return redirect(url_for('shop.subscribe', address_changed=False))
     return render_template('shop/email.html', form=form)
 
@@ -1,18 +1,243 @@
-import importlib
+import json
+import time
+import hashlib
+import importlib.util
+import threading
+from konbini import db, metrics
 from flask import current_app
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-def get_shipping_rate(products, addr, shipper, **config):
-    shipper_module = importlib.import_module('.' + shipper, 'konbini.shipping')
-    return shipper_module.get_shipping_rate(products, addr, **config)
+# Default number of seconds to wait for each shipper's quote
+SHIPPER_TIMEOUT = 20
+
+# Default number of seconds a quote is reused for
+QUOTE_TTL = 300
+
+# Checkouts expected to be getting quotes at the same time, for the default
+# size of the quote pool (this many threads for each shipper)
+SHIPPING_CONCURRENCY = 16
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS shipping_quotes (
+    key TEXT PRIMARY KEY,
+    rate INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shipping_quote_scopes (
+    scope TEXT PRIMARY KEY,
+    retired REAL NOT NULL
+);
+''')
+
+# Used when there's no database to share quotes through
+_quotes = {}
+_quotes_lock = threading.Lock()
+
+# Quote metadata that a shipment is bought with, so only one order may use it
+BUYABLE_META = ['easypost_shipment_id', 'shipment_id']
+
+_executor_lock = threading.Lock()
+
+class QuoteTimeout(Exception):
+    """A shipper didn't quote within `KONBINI_SHIPPER_TIMEOUT`"""
+    pass
+
+_registry_lock = threading.Lock()
+
+class Registry:
+    """The shippers an app uses (`KONBINI_SHIPPERS` and `KONBINI_DEFAULT_SHIPPER`),
+    resolved when the app is set up. Their modules (and the SDKs they use)
+    are only imported when first used, or all at once with `preload()`"""
+    def __init__(self, names):
+        self.names = list(dict.fromkeys(n for n in names if n))
+        for name in self.names:
+            if importlib.util.find_spec('.' + name, __name__) is None:
+                raise Exception('Unknown shipper "{}" in KONBINI_SHIPPERS'.format(name))
+        self._modules = {}
+
+    def get(self, name):
+        module = self._modules.get(name)
+        if module is None:
+            if name not in self.names:
+                raise Exception('Shipper "{}" isn\'t in KONBINI_SHIPPERS'.format(name))
+            with _registry_lock:
+                if name not in self._modules:
+                    self._modules[name] = importlib.import_module('.' + name, __name__)
+            module = self._modules[name]
+        return module
+
+    def preload(self):
+        for name in self.names:
+            self.get(name)
+
+def init_app(app):
+    """Set up the app's shippers. With `KONBINI_PRELOAD_SHIPPERS`,
+    their modules are imported now instead of on first use
+    (e.g. before a preforking server forks its workers)"""
+    registry = Registry(app.config.get('KONBINI_SHIPPERS', []) + [app.config.get('KONBINI_DEFAULT_SHIPPER')])
+    app.extensions['konbini_shippers'] = registry
+    if app.config.get('KONBINI_PRELOAD_SHIPPERS'):
+        registry.preload()
+    return registry
+
+def get_shipper(name):
+    """The module of one of the current app's shippers"""
+    registry = current_app.extensions.get('konbini_shippers')
+    if registry is None:
+        raise Exception('Shipping isn\'t set up for this app, see `konbini.shipping.init_app`')
+    return registry.get(name)
+
+def _get_executor(app):
+    """The app's pool for getting quotes, of `KONBINI_SHIPPING_WORKERS` threads
+    (by default enough for `SHIPPING_CONCURRENCY` checkouts at a time)"""
+    with _executor_lock:
+        if 'konbini_shipping_pool' not in app.extensions:
+            workers = app.config.get('KONBINI_SHIPPING_WORKERS',
+                                     SHIPPING_CONCURRENCY * max(1, len(app.config.get('KONBINI_SHIPPERS', []))))
+            app.extensions['konbini_shipping_pool'] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='konbini-shipping')
+    return app.extensions['konbini_shipping_pool']
+
+def _retired_at(scope):
+    """When the scope's quotes were last used up by a completed checkout, if ever"""
+    if scope is None:
+        return None
+    if db.enabled():
+        row = db.connect().execute('SELECT retired FROM shipping_quote_scopes WHERE scope = ?',
+                                   (scope,)).fetchone()
+        return row['retired'] if row is not None else None
+    return None
+
+def retire_scope(scope, **config):
+    """Stop reusing a scope's quotes, e.g. once its checkout has been paid for.
+    Their metadata (e.g. shipment ids) belongs to that order now, so another
+    checkout from the same cart has to be quoted anew.
+
+    This is kept in the database, so that every worker sees it. Without one,
+    quotes like that aren't reused at all (see `get_shipping_rate`)"""
+    if not db.enabled():
+        return
+    now = time.time()
+    # Quotes from before then have expired by this long after
+    expired = now - config.get('KONBINI_QUOTE_TTL', QUOTE_TTL)
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM shipping_quote_scopes WHERE retired <= ?', (expired,))
+        conn.execute('INSERT OR REPLACE INTO shipping_quote_scopes (scope, retired) VALUES (?, ?)',
+                     (scope, now))
+
+def _quote_key(products, addr, shipper, scope):
+    """Fingerprint a quote request by its (normalized) destination,
+    shipper and the products being shipped. Quotes from before
+    the scope was retired don't match"""
+    def norm(val):
+        return ' '.join(str(val or '').lower().split())
+    address = addr['address']
+    destination = [norm(addr.get('name'))] + [norm(address.get(k)) for k in
+                   ['line1', 'line2', 'city', 'state', 'postal_code', 'country']]
+    items = sorted((p['id'], q, p.get('updated'), sorted(p['metadata'].items())) for p, q in products)
+    key = json.dumps([shipper, scope, _retired_at(scope), destination, items], default=str)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+def _get_quote(key):
+    if db.enabled():
+        row = db.connect().execute('SELECT rate, meta FROM shipping_quotes WHERE key = ? AND expires > ?',
+                                   (key, time.time())).fetchone()
+        return (row['rate'], json.loads(row['meta'])) if row is not None else None
+    quote = _quotes.get(key)
+    if quote is not None and quote[2] > time.time():
+        return quote[0], dict(quote[1])
+    return None
+
+def _set_quote(key, rate, shipper_meta, ttl):
+    now = time.time()
+    if db.enabled():
+        with db.transaction() as conn:
+            conn.execute('DELETE FROM shipping_quotes WHERE expires <= ?', (now,))
+            conn.execute('INSERT OR REPLACE INTO shipping_quotes (key, rate, meta, expires) VALUES (?, ?, ?, ?)',
+                         (key, rate, json.dumps(shipper_meta), now + ttl))
+    else:
+        with _quotes_lock:
+            for k in [k for k, q in _quotes.items() if q[2] <= now]:
+                del _quotes[k]
+            _quotes[key] = (rate, dict(shipper_meta), now + ttl)
+
+def get_shipping_rate(products, addr, shipper, scope=None, **config):
+    """Get a quote from a shipper. Quotes are reused for `KONBINI_QUOTE_TTL`
+    seconds for the same destination, shipper and products.
+
+    The shipper metadata that comes with a quote (e.g. `easypost_shipment_id`)
+    is used to buy the shipment later, so it shouldn't be shared across orders.
+    Pass a `scope` (e.g. an id for the current checkout) to keep quotes
+    from being reused outside of it, and `retire_scope` it once the
+    checkout is paid for. Without a database, retiring a scope couldn't
+    reach the other workers' quotes, so quotes with metadata like that
+    (`BUYABLE_META`) aren't reused."""
+    key = _quote_key(products, addr, shipper, scope)
+    quote = _get_quote(key)
+    if quote is not None:
+        return quote
+
+    rate, shipper_meta = get_shipper(shipper).get_shipping_rate(products, addr, **config)
+    if not db.enabled() and any(k in shipper_meta for k in BUYABLE_META):
+        return rate, shipper_meta
+    _set_quote(key, rate, shipper_meta, config.get('KONBINI_QUOTE_TTL', QUOTE_TTL))
+    return rate, shipper_meta
+
+def get_shipping_rates(shipper_products, addr, scope=None, **config):
+    """Get quotes from several shippers in parallel.
+    `shipper_products` maps each shipper to the (product, quantity) pairs it ships;
+    shippers without any products are skipped. Returns a list of
+    `(shipper, rate, shipper_meta)` in the same order as `shipper_products`.
+
+    `KONBINI_SHIPPER_TIMEOUT` sets how many seconds to wait on each shipper,
+    either as a single number or as a dict of shipper -> seconds, counted from
+    when its quote starts. If all the pool's threads are busy, a quote waits
+    up to as long again to start. Raises `QuoteTimeout` if a shipper doesn't
+    quote in time."""
+    app = current_app._get_current_object()
+    timeouts = config.get('KONBINI_SHIPPER_TIMEOUT', SHIPPER_TIMEOUT)
+    tracking = metrics.current()
+    started, began = {}, {}
+
+    def quote(shipper, products):
+        began[shipper] = time.time()
+        started[shipper].set()
+        with app.app_context():
+            metrics.adopt(tracking)
+            start = time.time()
+            try:
+                return get_shipping_rate(products, addr, shipper, scope=scope, **config)
+            finally:
+                app.logger.info('Shipping quote from {} took {:.0f}ms'.format(shipper, (time.time() - start)*1000))
+
+    executor = _get_executor(app)
+    submitted = time.time()
+    futures = []
+    for shipper, products in shipper_products.items():
+        if products:
+            started[shipper] = threading.Event()
+            futures.append((shipper, executor.submit(quote, shipper, products)))
+
+    results = []
+    for shipper, future in futures:
+        timeout = timeouts.get(shipper, SHIPPER_TIMEOUT) if isinstance(timeouts, dict) else timeouts
+        try:
+            if not started[shipper].wait(max(0, submitted + timeout - time.time())):
+                raise TimeoutError
+            rate, shipper_meta = future.result(timeout=max(0, began[shipper] + timeout - time.time()))
+        except TimeoutError:
+            future.cancel()
+            raise QuoteTimeout('Timed out after {}s waiting for a shipping quote from {}'.format(timeout, shipper))
+        results.append((shipper, rate, shipper_meta))
+    return results
 
 def buy_shipment(shipper, **kwargs):
-    shipper_module = importlib.import_module('.' + shipper, 'konbini.shipping')
-    return shipper_module.buy_shipment(**kwargs)
+    return get_shipper(shipper).buy_shipment(**kwargs)
 
 def shipment_exists(shipment_id, shipper):
-    shipper_module = importlib.import_module('.' + shipper, 'konbini.shipping')
-    return shipper_module.shipment_exists(shipment_id)
+    return get_shipper(shipper).shipment_exists(shipment_id)
 
 def confirmation_email_text(shipper, **kwargs):
-    shipper_module = importlib.import_module('.' + shipper, 'konbini.shipping')
-    return shipper_module.confirmation_email(**kwargs)
+    return get_shipper(shipper).confirmation_email(**kwargs)
@@ -1,41 +1,101 @@
 import math
-import stripe
 import json
 import easypost
+import threading
 from flask import current_app
+from konbini import db, metrics, pricing, packing
 from konbini.util import send_email
 
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS easypost_customs (
+    key TEXT PRIMARY KEY,
+    id TEXT NOT NULL
+);
+''')
+
+# Used when there's no database to keep customs object ids in
+_customs = {}
+
+_lock = threading.Lock()
+
+
+def client():
+    """The current app's EasyPost client, configured from
+    `EASYPOST_API_KEY` (and `EASYPOST_API_BASE`, if set)"""
+    app = current_app._get_current_object()
+    with _lock:
+        if 'konbini_easypost' not in app.extensions:
+            kwargs = {'api_base': app.config['EASYPOST_API_BASE']} if 'EASYPOST_API_BASE' in app.config else {}
+            app.extensions['konbini_easypost'] = metrics.instrument_easypost(
+                easypost.EasyPostClient(app.config['EASYPOST_API_KEY'], **kwargs))
+    return app.extensions['konbini_easypost']
+
+
+def _cached_customs_id(key, create):
+    """Get the id of a customs object we've already created at EasyPost
+    for this key, or create it. Repeated quotes for the same products
+    then don't create anything new"""
+    key = json.dumps(key, sort_keys=True)
+    if db.enabled():
+        row = db.connect().execute('SELECT id FROM easypost_customs WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            return row['id']
+    elif key in _customs:
+        return _customs[key]
+
+    id = create().id
+    if db.enabled():
+        db.connect().execute('INSERT OR REPLACE INTO easypost_customs (key, id) VALUES (?, ?)', (key, id))
+    else:
+        _customs[key] = id
+    return id
+
+
+def _customs_info(products, customs):
+    customs_items = []
+    for product, quantity in products:
+        price = pricing.amount(product.id)/100 # cents to USD
+        hs_tariff_number = product.metadata.get("hs_tariff_number")
+
+        # Create customs item. We are making a few assumptions here
+        item_id = _cached_customs_id(['item', product.id, product.get('updated'), price, quantity],
+            lambda: client().customs_item.create(
+                quantity=quantity,
+                description=product.description,
+                value=price,
+                weight=product.metadata.get('weight'),
+                code=product.id,
+                origin_country='US', # NOTE assumed to be US
+                hs_tariff_number=hs_tariff_number
+            ))
+        customs_items.append({'id': item_id})
+
+    info_id = _cached_customs_id(['info', sorted(i['id'] for i in customs_items), customs],
+        lambda: client().customs_info.create(
+            customs_items=customs_items,
+            **customs
+        ))
+    return {'id': info_id}
+
 
 def get_shipping_rate(products, addr, **config):
     """Estimate a shipping rate for a product.
     This does not actually purchase shipping, this is just to figure out
     how much to charge for it."""
     metadata_fields = ['height', 'weight', 'length', 'width']
-    total_weight, total_length, total_width, total_height = 0, 0, 0, 0
-
     for p, q in products:
         missing_fields = [k for k in metadata_fields if k not in p.metadata]
         if missing_fields:
             new_order_recipients = current_app.config['NEW_ORDER_RECIPIENTS']
             send_email(new_order_recipients, "Missing product metadata", "admin_msg", message="Product {} is missing metadata fields in Stripe: {}".format(p.name, ", ".join(missing_fields)))
 
-        # current bin packing algorithm assumes products are flat books, takes the largest width and heights
-        # and calculates the height as a sum based on the assumption all books will be stacked flat on top of one another
-        # find the width and height needed to fit all books flat
-        length = max(float(p.metadata.get('length')),float(p.metadata.get('width')))
-        width = min(float(p.metadata.get('length')),float(p.metadata.get('width')))
-        if length > total_length:
-            total_length = length
-        if width > total_width:
-            total_width = width
-
-        # sum the heights
-        total_height += float(p.metadata.get('height'))*q
-
-        # sum the weights
-        total_weight += float(p.metadata.get('weight'))*q
-
-    dimensions = {'height':total_height,'width':total_width,'length':total_length,'weight':total_weight}
+    if config.get('KONBINI_BOXES'):
+        items = [(tuple(float(p.metadata.get(k)) for k in ('length', 'width', 'height', 'weight')), q)
+                 for p, q in products]
+        parcels = [{k: parcel[k] for k in ('length', 'width', 'height', 'weight')}
+                   for parcel in packing.pack(items, config['KONBINI_BOXES'])]
+    else:
+        parcels = [_stack_flat(products)]
 
     kwargs = {
         'from_address': config['KONBINI_SHIPPING_FROM'],
@@ -48,45 +108,25 @@ def get_shipping_rate(products, addr, **config):
             'zip': addr['address']['postal_code'],
             'country': addr['address']['country']
         },
-        'parcel': dimensions,
     }
 
     # https://www.easypost.com/customs-guide
+    customs_info = None
     if addr['address']['country'] != 'US' and 'KONBINI_CUSTOMS' in config:
-        customs_items = []
-        for product, quantity in products:
-            # ENH this can be improved
-            # Grab first SKU to get price
-            if product['type'] == 'good':
-                skus = stripe.SKU.list(limit=100, product=product.id, active=True)['data']
-                if skus:
-                    price = skus[0].price/100 # cents to USD
-                else:
-                    prices = stripe.Price.list(limit=100, product=product.id, active=True)['data']
-                    price = prices[0].unit_amount/100 # cents to USD
-            else:
-                prices = stripe.Price.list(limit=100, product=product.id, active=True)['data']
-                price = prices[0].unit_amount/100 # cents to USD
-
-            hs_tariff_number = product.metadata.get("hs_tariff_number")
-
-            # Create customs item. We are making a few assumptions here
-            customs_item = easypost.client.customs_item.create(
-                quantity=quantity,
-                description=product.description,
-                value=price,
-                weight=product.metadata.get('weight'),
-                code=product.id,
-                origin_country='US', # NOTE assumed to be US
-                hs_tariff_number=hs_tariff_number
-            )
-            customs_items.append(customs_item)
-        customs_info = easypost.client.customs_info.create(
-            customs_items=customs_items,
-            **config['KONBINI_CUSTOMS']
-        )
-        kwargs['customs_info'] = customs_info
-    shipment = easypost.client.shipment.create(**kwargs)
+        customs_info = _customs_info(products, config['KONBINI_CUSTOMS'])
+
+    if len(parcels) == 1:
+        if customs_info is not None:
+            kwargs['customs_info'] = customs_info
+        shipment = client().shipment.create(parcel=parcels[0], **kwargs)
+    else:
+        # Several parcels are quoted (and later bought) together as an order.
+        # NOTE each parcel carries the customs declaration for the whole cart
+        shipments = [{'parcel': parcel} for parcel in parcels]
+        if customs_info is not None:
+            for s in shipments:
+                s['customs_info'] = customs_info
+        shipment = client().order.create(shipments=shipments, **kwargs)
 
     # Get cheapest rate
     lowest_rate = shipment.lowest_rate()
@@ -94,16 +134,58 @@ def get_shipping_rate(products, addr, **config):
     # Convert to cents
     return math.ceil(float(lowest_rate.rate) * 100), {'easypost_shipment_id': shipment.id}
 
+def _stack_flat(products):
+    """Parcel for products without any configured boxes"""
+    total_weight, total_length, total_width, total_height = 0, 0, 0, 0
+    for p, q in products:
+        # this assumes products are flat books, takes the largest width and heights
+        # and calculates the height as a sum based on the assumption all books will be stacked flat on top of one another
+        # find the width and height needed to fit all books flat
+        length = max(float(p.metadata.get('length')),float(p.metadata.get('width')))
+        width = min(float(p.metadata.get('length')),float(p.metadata.get('width')))
+        if length > total_length:
+            total_length = length
+        if width > total_width:
+            total_width = width
+
+        # sum the heights
+        total_height += float(p.metadata.get('height'))*q
+
+        # sum the weights
+        total_weight += float(p.metadata.get('weight'))*q
+
+    return {'height':total_height,'width':total_width,'length':total_length,'weight':total_weight}
+
 def buy_shipment(**kwargs):
-    shipment = easypost.client.shipment.retrieve(kwargs['easypost_shipment_id'])
-    shipment = easypost.client.shipment.buy(shipment.id, rate=shipment.lowest_rate())
+    id = kwargs['easypost_shipment_id']
+    if id.startswith('order_'):
+        order = client().order.retrieve(id)
+        rate = order.lowest_rate()
+        order = client().order.buy(order.id, carrier=rate.carrier, service=rate.service)
+        label_urls = [s.postage_label.label_url for s in order.shipments]
+        tracking_urls = [s.tracker.public_url for s in order.shipments]
+        return {
+            'label_url': label_urls[0],
+            'tracking_url': tracking_urls[0],
+            'label_urls': label_urls,
+            'tracking_urls': tracking_urls
+        }
+
+    shipment = client().shipment.retrieve(id)
+    shipment = client().shipment.buy(shipment.id, rate=shipment.lowest_rate())
     return {
         'label_url': shipment.postage_label.label_url,
         'tracking_url': shipment.tracker.public_url
     }
 
 def shipment_exists(shipment_id):
-    shipment = easypost.client.shipment.retrieve(shipment_id)
+    if shipment_id.startswith('order_'):
+        order = client().order.retrieve(shipment_id)
+        if order is not None and all(s.tracking_code for s in order.shipments):
+            return True, order.shipments[0].tracker.public_url
+        return False, None
+
+    shipment = client().shipment.retrieve(shipment_id)
     if shipment is not None and shipment.tracking_code:
         return True, shipment.tracker.public_url
     else:
@@ -0,0 +1,113 @@
+"""Shared, pooled HTTP client for the shipper modules.
+
+Each app has its own session, whose connections are kept alive
+and reused across requests (and threads).
+Requests get a default timeout, and idempotent requests that fail to
+connect or come back with a 502/503/504 are retried.
+
+Configured with:
+
+    KONBINI_HTTP_POOL_SIZE      connections kept open per host (default 10)
+    KONBINI_HTTP_TIMEOUT        seconds, or a (connect, read) tuple (default (5, 30))
+    KONBINI_HTTP_RETRIES        retries per request (default 2)
+"""
+import time
+import atexit
+import requests
+import threading
+from konbini import metrics
+from flask import current_app
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 10
+TIMEOUT = (5, 30)
+RETRIES = 2
+
+_lock = threading.Lock()
+
+
+def get_session():
+    """The current app's session, configured from its config"""
+    app = current_app._get_current_object()
+    with _lock:
+        if 'konbini_http' not in app.extensions:
+            config = app.config
+            pool_size = config.get('KONBINI_HTTP_POOL_SIZE', POOL_SIZE)
+
+            # Retry is only applied to idempotent methods by default,
+            # except for connection errors, where the request never went out
+            retry = Retry(total=config.get('KONBINI_HTTP_RETRIES', RETRIES),
+                          backoff_factor=0.3,
+                          status_forcelist=(502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            app.extensions['konbini_http'] = session
+            atexit.register(close, app)
+    return app.extensions['konbini_http']
+
+
+def close(app):
+    """Close the app's session and its pooled connections"""
+    with _lock:
+        session = app.extensions.pop('konbini_http', None)
+    if session is not None:
+        session.close()
+
+
+def _service(url):
+    """Which shipper a request is for, for metrics"""
+    parsed = urlparse(url)
+    host = parsed.hostname or ''
+    config = current_app.config
+    if 'shipbob' in host or _same_host(parsed, config.get('SHIPBOB_API_URL')):
+        return 'shipbob'
+    if _same_host(parsed, config.get('RPI_URL')):
+        return 'rpi'
+    return host
+
+def _same_host(parsed, url):
+    if not url:
+        return False
+    other = urlparse(url)
+    return (other.hostname, other.port) == (parsed.hostname, parsed.port)
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', current_app.config.get('KONBINI_HTTP_TIMEOUT', TIMEOUT))
+    start = time.time()
+    ok = False
+    try:
+        response = get_session().request(method, url, **kwargs)
+        ok = response.status_code < 400
+        return response
+    finally:
+        metrics.record(_service(url), metrics.operation(method, url), time.time() - start, ok)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def stats():
+    """Requests made and connections opened per host;
+    requests beyond the connections opened reused a connection"""
+    session = current_app.extensions.get('konbini_http')
+    if session is None:
+        return {}
+    hosts = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+            stat = hosts.setdefault(host, {'requests': 0, 'connections': 0, 'reused': 0})
+            stat['requests'] += pool.num_requests
+            stat['connections'] += pool.num_connections
+            stat['reused'] += pool.num_requests - pool.num_connections
+    return hosts
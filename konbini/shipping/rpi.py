@@ -1,12 +1,15 @@
 import math
-import stripe
 import json
-import requests
+from . import pool
 from flask import current_app
+from konbini import pricing
 from konbini.util import send_email, check_state
 
-url = current_app.config['RPI_URL']
-auth = {'Authorization': current_app.config['RPI_AUTH_HEADER']}
+def _url(path):
+    return current_app.config['RPI_URL'] + path
+
+def _auth():
+    return {'Authorization': current_app.config['RPI_AUTH_HEADER']}
 
 def get_shipping_rate(products, addr, **config):
     """Estimate a shipping rate for a product.
@@ -44,9 +47,9 @@ def get_shipping_rate(products, addr, **config):
             },
             "orderItems": order_items
     }
-    estimate_url = url + '/orders/shipping/estimate'
+    estimate_url = _url('/orders/shipping/estimate')
 
-    response = requests.post(estimate_url, json=request_body, headers=auth)
+    response = pool.post(estimate_url, json=request_body, headers=_auth())
     rates = response.json()
 
     # Get cheapest rate
@@ -71,8 +74,7 @@ def buy_shipment(**kwargs):
         i += 1
 
     for p in products:
-        prices = stripe.Price.list(limit=100, product=product['id'], active=True)['data']
-        price = prices[0].unit_amount/100
+        price = pricing.amount(p['id'])/100
         order_items.append({
             "sku": p['sku'],
             "quantity": p['quantity'],
@@ -102,13 +104,13 @@ def buy_shipment(**kwargs):
         },
         "orderItems": order_items
     }
-    create_url = url + '/orders/create'
-    response = requests.post(create_url, json=request_body, headers=auth)
+    create_url = _url('/orders/create')
+    response = pool.post(create_url, json=request_body, headers=_auth())
     return response.json()
 
 def shipment_exists(shipment_id):
-    exists_url = url + '/orders/' + shipment_id
-    response = requests.get(exists_url, headers=auth)
+    exists_url = _url('/orders/' + shipment_id)
+    response = pool.get(exists_url, headers=_auth())
     order = response.json()
 
     if order is not None and order.tracking_code:
@@ -1,68 +1,199 @@
 import math
 import json
+import time
 import uuid
-import requests
+import threading
+from . import pool
+from konbini import db
 from flask import current_app
 
+# Default number of seconds between background refreshes
+# of the inventory item -> channel product mapping
+MAPPING_REFRESH = 60 * 60
 
-def inventory_items_to_products(inventory_items):
-    """There is a decent amount of overhead with
-    these extra network calls, but ShipBob does not provide
-    a more streamlined way (their entire API is horribly designed),
-    so this is how we have to do it.
-    """
+# Default number of seconds a quote's shipping method
+# and products can be used to place an order
+QUOTE_TTL = 24 * 60 * 60
 
-    # Fetch products from the Default ShipBob channel
-    product_data = {}
-    default_channel_headers = {
-        'shipbob_channel_id': current_app.config['SHIPBOB_DEFAULT_CHANNEL_ID'],
-        'Authorization': 'bearer {}'.format(current_app.config['SHIPBOB_API_KEY'])
-    }
-    resp = requests.get('https://api.shipbob.com/1.0/product', headers=default_channel_headers)
-    all_products = resp.json()
-    for p in all_products:
-        for item in p['fulfillable_inventory_items']:
-            inv_id = item['id']
-            product_data[inv_id] = {'sku': p['sku'], 'name': p['name']}
-
-    # Fetch products from the store-specific ShipBob channel
-    mapping = {}
-    headers = {
-        'shipbob_channel_id': current_app.config['SHIPBOB_CHANNEL_ID'],
+# ShipBob's largest page size
+PAGE_SIZE = 250
+
+# Override with `SHIPBOB_API_URL`, e.g. to point at ShipBob's sandbox
+API_URL = 'https://api.shipbob.com/1.0'
+
+SCHEMA = db.schema('''
+CREATE TABLE IF NOT EXISTS shipbob_products (
+    channel TEXT NOT NULL,
+    inventory_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    sku TEXT,
+    name TEXT,
+    PRIMARY KEY (channel, inventory_id)
+);
+CREATE TABLE IF NOT EXISTS shipbob_orders (
+    reference_id TEXT PRIMARY KEY,
+    order_id INTEGER NOT NULL,
+    created_date TEXT,
+    shipped INTEGER NOT NULL,
+    tracking TEXT
+);
+''')
+
+# Used when there's no database to keep the mapping
+# and order index in
+_mapping = {}
+_refreshed = {}
+_orders = {}
+_orders_state = {}
+
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+
+def _url(path):
+    return current_app.config.get('SHIPBOB_API_URL', API_URL) + path
+
+
+def _headers(channel_id):
+    return {
+        'shipbob_channel_id': channel_id,
         'Authorization': 'bearer {}'.format(current_app.config['SHIPBOB_API_KEY'])
     }
-    resp = requests.get('https://api.shipbob.com/1.0/product', headers=headers)
-    all_products = resp.json()
-    for p in all_products:
-        for item in p['fulfillable_inventory_items']:
-            inv_id = item['id']
-            mapping[inv_id] = p['id']
+
+
+def _store_products(channel_id, products):
+    _store_mapping([(str(channel_id), item['id'], p['id'], p['sku'], p['name'])
+                    for p in products for item in p['fulfillable_inventory_items']])
+
+
+def _store_mapping(rows):
+    """Store (channel, inventory_id, product_id, sku, name) rows"""
+    if db.enabled():
+        with db.transaction() as conn:
+            conn.executemany('''INSERT OR REPLACE INTO shipbob_products
+                                  (channel, inventory_id, product_id, sku, name)
+                                  VALUES (?, ?, ?, ?, ?)''', rows)
+    else:
+        for channel, inv_id, product_id, sku, name in rows:
+            _mapping[(channel, inv_id)] = {'product_id': product_id, 'sku': sku, 'name': name}
+
+
+def _lookup_product(channel_id, inventory_id):
+    """The channel's product for an inventory item, if we know of one"""
+    if db.enabled():
+        row = db.connect().execute('''SELECT product_id, sku, name FROM shipbob_products
+                                      WHERE channel = ? AND inventory_id = ?''',
+                                   (str(channel_id), inventory_id)).fetchone()
+        return dict(row) if row is not None else None
+    return _mapping.get((str(channel_id), inventory_id))
+
+
+def _last_refreshed(channel_id):
+    if db.enabled():
+        return float(db.get_meta('shipbob_products_refreshed:{}'.format(channel_id), 0))
+    return _refreshed.get(str(channel_id), 0)
+
+
+def refresh_products(channel_id):
+    """Refresh the mapping for a channel, storing each page as it comes in"""
+    started = time.time()
+    page = 1
+    while True:
+        resp = pool.get(_url('/product'),
+                        params={'Page': page, 'Limit': PAGE_SIZE},
+                        headers=_headers(channel_id))
+        try:
+            resp.raise_for_status()
+        except:
+            raise Exception('{} for {}: {}'.format(resp.status_code, resp.url, resp.content))
+        products = resp.json()
+        _store_products(channel_id, products)
+        if len(products) < PAGE_SIZE:
+            break
+        page += 1
+
+    if db.enabled():
+        db.set_meta('shipbob_products_refreshed:{}'.format(channel_id), started)
+    else:
+        _refreshed[str(channel_id)] = started
+
+
+def _refresh_in_background(channel_id):
+    """Refresh the mapping for a channel in a background thread
+    if it hasn't been refreshed in a while"""
+    interval = current_app.config.get('KONBINI_SHIPBOB_MAPPING_REFRESH', MAPPING_REFRESH)
+    if time.time() - _last_refreshed(channel_id) < interval:
+        return
+    with _refresh_lock:
+        if channel_id in _refreshing:
+            return
+        _refreshing.add(channel_id)
+
+    app = current_app._get_current_object()
+    def refresh():
+        try:
+            with app.app_context():
+                refresh_products(channel_id)
+        except Exception:
+            app.logger.exception('Failed to refresh ShipBob products for channel {}'.format(channel_id))
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(channel_id)
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def inventory_items_to_products(inventory_items):
+    """ShipBob orders and estimates need products from the store-specific
+    channel, while our Stripe products refer to inventory items.
+    ShipBob does not provide a more streamlined way to map between them
+    (their entire API is horribly designed), so we keep a local mapping,
+    refreshed in the background. Inventory items that aren't in the store
+    channel yet get a product created there, based on the product
+    for them in the Default ShipBob channel.
+    """
+    channel_id = current_app.config['SHIPBOB_CHANNEL_ID']
+    default_channel_id = current_app.config['SHIPBOB_DEFAULT_CHANNEL_ID']
+    for channel in [channel_id, default_channel_id]:
+        # The first time around we need the full mapping
+        if not _last_refreshed(channel):
+            refresh_products(channel)
+        else:
+            _refresh_in_background(channel)
 
     products = []
     for item in inventory_items:
-        try:
-            product_id = mapping[item['id']]
-        except KeyError:
-            # Get the default product id and then create a new one
+        product = _lookup_product(channel_id, item['id'])
+        if product is None:
+            # Get the default product and then create a new one
             # in the store channel
-            data = product_data[item['id']]
+            data = _lookup_product(default_channel_id, item['id'])
+            if data is None:
+                refresh_products(default_channel_id)
+                data = _lookup_product(default_channel_id, item['id'])
+                if data is None:
+                    raise Exception('No product found for inventory id "{}"'.format(item['id']))
 
             # Create the necessary product
-            resp = requests.post('https://api.shipbob.com/1.0/product', json={
+            resp = pool.post(_url('/product'), json={
                 'sku': data['sku'],
                 'reference_id': data['sku'],
                 'name': data['name']
-            }, headers=headers)
+            }, headers=_headers(channel_id))
             try:
                 resp.raise_for_status()
             except:
-                raise Exception('{} for {}: {}'.format(resp.status_code, resp.url, resp.content))
-            product_id = resp.json()['id']
-            mapping[item['id']] = product_id
+                # Our mapping may just be out of date
+                # and the product already exists
+                refresh_products(channel_id)
+                product = _lookup_product(channel_id, item['id'])
+                if product is None:
+                    raise Exception('{} for {}: {}'.format(resp.status_code, resp.url, resp.content))
+            else:
+                product = {'product_id': resp.json()['id'], 'sku': data['sku'], 'name': data['name']}
+                _store_mapping([(str(channel_id), item['id'], product['product_id'], data['sku'], data['name'])])
 
-            # raise Exception('No product found for inventory id "{}"'.format(item['id']))
         products.append({
-            'id': product_id,
+            'id': product['product_id'],
             'quantity': item['quantity']
         })
     return products
@@ -86,7 +217,7 @@ def _get_shipping_rates(products, addr):
         'products': products,
         'shipping_methods': None,
     }
-    resp = requests.post('https://api.shipbob.com/1.0/order/estimate', json=data, headers={
+    resp = pool.post(_url('/order/estimate'), json=data, headers={
         'shipbob_channel_id': current_app.config['SHIPBOB_CHANNEL_ID'],
         'Authorization': 'bearer {}'.format(current_app.config['SHIPBOB_API_KEY'])
     })
@@ -112,18 +243,20 @@ def get_shipping_rate(products, addr, **config):
     rates = _get_shipping_rates(shipped_products, addr)
 
     # Get cheapest rate
-    rate = min(r['estimated_price'] for r in rates)
-
-    # Convert to cents
-    rate = math.ceil(rate*100)
+    rate = min(rates, key=lambda r: r['estimated_price'])
 
     # Create shipment id
     shipment_id = str(uuid.uuid4()).replace('-', '')
-    return rate, {
+    return math.ceil(rate['estimated_price']*100), {
         'shipment_id': shipment_id,
 
-        # keep as inventory, will be converted again later
-        'products': json.dumps(shipped_inventory)
+        # keep as inventory, in case we need to quote again later
+        'products': json.dumps(shipped_inventory),
+
+        # what we need to place the order without quoting again
+        'shipbob_shipping_method': rate['shipping_method'],
+        'shipbob_products': json.dumps(shipped_products),
+        'shipbob_quoted_at': int(time.time())
     }
 
 
@@ -139,9 +272,19 @@ def buy_shipment(shipment_id, **kwargs):
     address = {'address': address}
 
     name = kwargs['name']
-    products = inventory_items_to_products(products)
-    rates = _get_shipping_rates(products, address)
-    rate = min(rates, key=lambda r: r['estimated_price'])
+
+    # Use the shipping method and products from the quote,
+    # unless it's too old to trust
+    quoted_at = int(kwargs.get('shipbob_quoted_at') or 0)
+    quote_ttl = current_app.config.get('KONBINI_SHIPBOB_QUOTE_TTL', QUOTE_TTL)
+    if kwargs.get('shipbob_shipping_method') and kwargs.get('shipbob_products') \
+            and time.time() - quoted_at < quote_ttl:
+        shipping_method = kwargs['shipbob_shipping_method']
+        products = json.loads(kwargs['shipbob_products'])
+    else:
+        products = inventory_items_to_products(products)
+        rates = _get_shipping_rates(products, address)
+        shipping_method = min(rates, key=lambda r: r['estimated_price'])['shipping_method']
 
     addr = {
         'address1': address['address']['line1'],
@@ -153,7 +296,7 @@ def buy_shipment(shipment_id, **kwargs):
     }
 
     data = {
-        'shipping_method': rate['shipping_method'],
+        'shipping_method': shipping_method,
         'recipient': {
             'name': name,
             'address': addr,
@@ -162,7 +305,7 @@ def buy_shipment(shipment_id, **kwargs):
         'reference_id': shipment_id
 
     }
-    resp = requests.post('https://api.shipbob.com/1.0/order', json=data, headers={
+    resp = pool.post(_url('/order'), json=data, headers={
         'shipbob_channel_id': current_app.config['SHIPBOB_CHANNEL_ID'],
         'Authorization': 'bearer {}'.format(current_app.config['SHIPBOB_API_KEY'])
     })
@@ -173,6 +316,7 @@ def buy_shipment(shipment_id, **kwargs):
 
     # We may not get a tracking url right away
     data = resp.json()
+    _index_orders([data])
     shipments = data['shipments']
     if shipments and shipments[0] is not None:
         tracking_data = shipments[0].get('tracking', None) or {}
@@ -184,22 +328,98 @@ def buy_shipment(shipment_id, **kwargs):
     }
 
 
-def shipment_exists(shipment_id):
-    # Shipbob's API docs say this will filter by reference ids,
-    # the endpoint actually just returns all orders...but
-    # using this just in case they ever get around to fixing that.
-    data = {'ReferenceIds': [shipment_id]}
-    resp = requests.get('https://api.shipbob.com/1.0/order', json=data, headers={
-        'shipbob_channel_id': current_app.config['SHIPBOB_CHANNEL_ID'],
-        'Authorization': 'bearer {}'.format(current_app.config['SHIPBOB_API_KEY'])
-    })
-    orders = resp.json()
-    matches = [order for order in orders if order['reference_id'] == shipment_id]
-    if matches:
-        order = matches[0]
-        if order['shipments']:
-            return True, order['shipments'][0]['tracking']
-        else:
-            return True, None
+def _index_orders(orders):
+    """Index orders by their reference id (our shipment id)"""
+    rows = []
+    for order in orders:
+        if not order.get('reference_id'):
+            continue
+        shipments = order.get('shipments') or []
+        tracking = shipments[0].get('tracking') if shipments and shipments[0] is not None else None
+        rows.append((order['reference_id'], order['id'], order.get('created_date'),
+                     bool(shipments), json.dumps(tracking)))
+    if db.enabled():
+        with db.transaction() as conn:
+            conn.executemany('''INSERT OR REPLACE INTO shipbob_orders
+                                  (reference_id, order_id, created_date, shipped, tracking)
+                                  VALUES (?, ?, ?, ?, ?)''', rows)
     else:
-        return False, None
+        for reference_id, order_id, created_date, shipped, tracking in rows:
+            _orders[reference_id] = {'order_id': order_id, 'created_date': created_date,
+                                     'shipped': shipped, 'tracking': tracking}
+
+
+def _lookup_order(reference_id):
+    if db.enabled():
+        row = db.connect().execute('''SELECT order_id, shipped, tracking FROM shipbob_orders
+                                      WHERE reference_id = ?''', (reference_id,)).fetchone()
+        return dict(row) if row is not None else None
+    return _orders.get(reference_id)
+
+
+def _orders_cursor():
+    if db.enabled():
+        return db.get_meta('shipbob_orders_cursor')
+    return _orders_state.get('cursor')
+
+
+def sync_orders():
+    """Index orders created since the last sync (or all of them, the first time).
+    The last order's creation date is kept as a cursor; since the start date
+    filter is inclusive, a few orders get fetched again, which is harmless"""
+    channel_id = current_app.config['SHIPBOB_CHANNEL_ID']
+    params = {'SortOrder': 'Oldest', 'Limit': PAGE_SIZE}
+    cursor = _orders_cursor()
+    if cursor:
+        params['StartDate'] = cursor
+
+    page = 1
+    while True:
+        params['Page'] = page
+        resp = pool.get(_url('/order'), params=params, headers=_headers(channel_id))
+        try:
+            resp.raise_for_status()
+        except:
+            raise Exception('{} for {}: {}'.format(resp.status_code, resp.url, resp.content))
+        orders = resp.json()
+        _index_orders(orders)
+
+        dates = [o['created_date'] for o in orders if o.get('created_date')]
+        if dates:
+            cursor = max(dates + ([cursor] if cursor else []))
+            if db.enabled():
+                db.set_meta('shipbob_orders_cursor', cursor)
+            else:
+                _orders_state['cursor'] = cursor
+        if len(orders) < PAGE_SIZE:
+            break
+        page += 1
+
+
+def shipment_exists(shipment_id):
+    # Shipbob's API docs say the order list can be filtered by reference ids,
+    # but the endpoint actually just returns all orders. So we keep our own
+    # index of orders by reference id, and only catch up on new orders
+    # when we don't find one.
+    order = _lookup_order(shipment_id)
+    if order is None:
+        sync_orders()
+        order = _lookup_order(shipment_id)
+        if order is None:
+            return False, None
+
+    tracking = json.loads(order['tracking'])
+    if tracking is None:
+        # The order may have shipped, or its tracking info come in,
+        # since we indexed it
+        resp = pool.get(_url('/order/{}'.format(order['order_id'])),
+                        headers=_headers(current_app.config['SHIPBOB_CHANNEL_ID']))
+        try:
+            resp.raise_for_status()
+        except:
+            raise Exception('{} for {}: {}'.format(resp.status_code, resp.url, resp.content))
+        latest = resp.json()
+        _index_orders([latest])
+        shipments = latest.get('shipments') or []
+        tracking = shipments[0].get('tracking') if shipments and shipments[0] is not None else None
+    return True, tracking
@@ -0,0 +1,48 @@
+"""Stripe tax rates, indexed by jurisdiction.
+
+All rates are loaded once (from the catalog mirror if it has been synced,
+otherwise from Stripe) and reloaded when a `tax_rate.*` event
+comes in on the `/sync` webhook.
+"""
+import stripe
+import threading
+from . import mirror
+
+_rates = None
+_generation = None
+_lock = threading.Lock()
+
+
+def _load(generation):
+    if generation is not None:
+        rates = mirror.tax_rates()
+    else:
+        rates = stripe.TaxRate.list(limit=100).auto_paging_iter()
+
+    index = {}
+    for rate in rates:
+        if not rate.get('active', True):
+            continue
+        # Rates are listed newest first; keep the first one for each jurisdiction
+        index.setdefault(rate['jurisdiction'], rate)
+    return index
+
+
+def get_rate(jurisdiction):
+    """Get the tax rate for a jurisdiction (e.g. a US state), if there is one"""
+    global _rates, _generation
+    generation = mirror.generation()
+    rates = _rates
+    if rates is None or generation != _generation:
+        with _lock:
+            # Another thread may have reloaded them while we waited
+            if _rates is None or generation != _generation:
+                _rates = _load(generation)
+                _generation = generation
+            rates = _rates
+    return rates.get(jurisdiction)
+
+
+def invalidate():
+    global _rates
+    _rates = None
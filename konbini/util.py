@@ -1,16 +1,35 @@
+from . import mailer, metrics
 from flask_mail import Message
 from flask import current_app, render_template
 
-def send_email(tos, subject, template, reply_to=None, bcc=None, **kwargs):
-    reply_to = reply_to or current_app.config['MAIL_REPLY_TO']
-    msg = Message(subject,
-                body=render_template('shop/email/{}.txt'.format(template), **kwargs),
-                html=render_template('shop/email/{}.html'.format(template), **kwargs),
-                recipients=tos,
-                reply_to=reply_to,
-                bcc=bcc)
+def render_email(tos, subject, template, reply_to=None, bcc=None, **kwargs):
+    """Render an email into the fields for a `Message`,
+    so it can be stored and sent later"""
+    return {
+        'subject': subject,
+        'body': render_template('shop/email/{}.txt'.format(template), **kwargs),
+        'html': render_template('shop/email/{}.html'.format(template), **kwargs),
+        'recipients': tos,
+        'reply_to': reply_to or current_app.config['MAIL_REPLY_TO'],
+        'bcc': bcc
+    }
+
+def deliver_email(message):
+    """Send an email rendered with `render_email`"""
     mail = current_app.extensions.get('mail')
-    mail.send(msg)
+    with metrics.timed('smtp', 'send'):
+        mail.send(Message(**message))
+
+def dispatch_email(message):
+    """Hand an email rendered with `render_email` to the background
+    mail dispatcher, or send it right away if `KONBINI_MAIL_ASYNC` is off"""
+    if current_app.config.get('KONBINI_MAIL_ASYNC', True):
+        mailer.enqueue(Message(**message))
+    else:
+        deliver_email(message)
+
+def send_email(tos, subject, template, reply_to=None, bcc=None, **kwargs):
+    dispatch_email(render_email(tos, subject, template, reply_to=reply_to, bcc=bcc, **kwargs))
 
 def check_state(state):
     abbreviation_to_name = {
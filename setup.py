@@ -19,6 +19,7 @@ setup(
         'easypost==8.2.1',
         'six==1.12.0',
         'pyusps==0.0.7',
-        'country-list==0.1.3'
+        'country-list==0.1.3',
+        'numpy>=1.26,<3'
     ]
 )
@@ -0,0 +1,48 @@
+"""Adding unknown SKUs and prices to the cart, with and without the
+catalog mirror, against the local fakes in `bench.fakes`"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bench import fakes as fakes_
+from bench import harness
+from konbini import mirror
+
+
+@pytest.fixture(scope='module')
+def fakes():
+    with fakes_.Fakes() as fakes:
+        yield fakes
+
+
+@pytest.fixture(params=['stripe', 'mirror'])
+def client(request, fakes, tmp_path):
+    if request.param == 'mirror':
+        app = harness.make_app(fakes, db_path=str(tmp_path / 'konbini.db'))
+        with app.app_context():
+            mirror.sync()
+    else:
+        app = harness.make_app(fakes)
+    return app.test_client()
+
+
+@pytest.mark.parametrize('id', ['sku_bogus1', 'price_bogus1', 'prod_bogus1'])
+def test_add_unknown(client, id):
+    resp = client.post('/shop/cart', data={'sku': id, 'name': 'Bogus'})
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('id', ['sku_bogus1', 'price_bogus1', 'prod_bogus1'])
+def test_update_unknown(client, id):
+    resp = client.post('/shop/cart/update', json={'quantities': {id: 1}})
+    assert resp.status_code == 400
+
+
+def test_add_and_update(client, fakes):
+    sku = fakes.stripe.skus[0]
+    resp = client.post('/shop/cart', data={'sku': sku['id'], 'name': 'Product 0'})
+    assert resp.status_code == 302
+    resp = client.post('/shop/cart/update', json={'quantities': {sku['id']: 3}})
+    assert resp.status_code == 200
+    assert resp.get_json()['size'] == 3